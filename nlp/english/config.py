@@ -15,10 +15,21 @@ config = {
         "GENDERIZE_ENABLED": False,
         "GENDERAPI_ENABLED": True,
         "GENDERAPI_TOKEN": "JSON_AUTH_TOKEN",
+        "GENDERAPI_URL": "https://gender-api.com/v2/gender",
+        "GENDERIZE_URL": "https://api.genderize.io/",
+        "SERVICE_CONCURRENCY": 4,
+        "SERVICE_RATE_LIMIT": 5,
+        "SERVICE_RETRIES": 3,
+        "SERVICE_TIMEOUT": 30,
         "MANUAL_CACHE": "manual",
         "GENDERAPI_CACHE": "genderAPICleaned",
         "GENDERIZE_CACHE": "genderizeCleaned",
         "FIRSTNAME_CACHE": "firstNamesCleaned",
+        "CACHE_UPDATES": "cacheUpdates",
+        "NAME_CACHE_SIZE": 100000,
+        "NAME_CACHE_TTL": 86400,
+        "NEGATIVE_CACHE": "unknownNames",
+        "NEGATIVE_CACHE_TTL": 2592000,
     },
     "NLP": {
         "MAX_BODY_LENGTH": 20000,
@@ -0,0 +1,218 @@
+"""
+On-disk cache of parsed spaCy documents, so that downstream stages (quote extraction,
+named entity merging, quote assignment and gender lookup) can be rerun without parsing
+the same article text again.
+
+Parsed docs are serialized with `Doc.to_bytes` and stored in one file per doc, spread over
+256 shard directories. Each doc is keyed by a hash of its (preprocessed) text, along with
+the name and version of the spaCy model and the components in its pipeline, so changing
+or upgrading the model never returns stale parses. Coreference clusters from neuralcoref
+are stored alongside the doc as token offsets, and restored when reading from the cache.
+
+Cached docs are never removed while a pipeline runs, so the cache grows by one file per new
+article text and model. Reading a doc updates its file's modification time, and `prune_cache()`
+removes the docs that were not used for a while (e.g., all docs of a replaced model), and then
+the least recently used docs until the cache fits in a maximum size. The pipelines prune the
+cache to `--doc_cache_max_gb` after each run, and it can also be pruned or cleared with:
+    python3 doc_cache.py --doc_cache ./doc_cache --max_gb 20 --max_age_days 30
+    python3 doc_cache.py --doc_cache ./doc_cache --clear
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import srsly
+from spacy.tokens import Doc
+
+
+TMP_SUFFIX = ".tmp"
+# Temporary files that are older than this were left behind by interrupted writes
+TMP_MAX_AGE = 3600
+
+
+class CachedCluster:
+    """Minimal stand-in for a neuralcoref cluster, restored from the cache"""
+
+    def __init__(self, i, main, mentions):
+        self.i = i
+        self.main = main
+        self.mentions = mentions
+
+    def __iter__(self):
+        return iter(self.mentions)
+
+    def __len__(self):
+        return len(self.mentions)
+
+
+class DocCache:
+    """Wrap a spaCy Language object so that texts are parsed only if their parse is not
+    cached already. Calling the cache, or its pipe() method, works just like calling the
+    Language object itself; all other attributes are passed through to it.
+    """
+
+    def __init__(self, cache_dir, nlp):
+        self.cache_dir = cache_dir
+        self.nlp = nlp
+        self.hits = 0
+        self.misses = 0
+        meta = nlp.meta
+        self.model_key = "{0}_{1}-{2}|{3}".format(
+            meta.get("lang"), meta.get("name"), meta.get("version"), ",".join(nlp.pipe_names)
+        )
+        self.has_coref = "neuralcoref" in nlp.pipe_names
+
+    def __getattr__(self, name):
+        if name == "nlp":
+            raise AttributeError(name)
+        return getattr(self.nlp, name)
+
+    def __call__(self, text):
+        doc = self.get(text)
+        if doc is None:
+            doc = self.nlp(text)
+            self.put(text, doc)
+        return doc
+
+    def pipe(self, texts, batch_size=1000, **kwargs):
+        """Yield parsed docs in the same order as the texts, parsing only the cache misses with nlp.pipe"""
+        if kwargs:
+            # Pipelines with disabled components are not cached
+            yield from self.nlp.pipe(texts, batch_size=batch_size, **kwargs)
+            return
+        texts = list(texts)
+        docs = [self.get(text) for text in texts]
+        missing = [i for i, doc in enumerate(docs) if doc is None]
+        parsed = self.nlp.pipe((texts[i] for i in missing), batch_size=batch_size)
+        for i, doc in zip(missing, parsed):
+            self.put(texts[i], doc)
+            docs[i] = doc
+        yield from docs
+
+    def _path(self, text):
+        key = hashlib.sha1((self.model_key + "\n" + text).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".bin")
+
+    def get(self, text):
+        """Return the cached doc for a text, or None if it isn't cached"""
+        path = self._path(text)
+        try:
+            with open(path, "rb") as f:
+                data = srsly.msgpack_loads(f.read())
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            # Keep track of when the doc was last used, for pruning
+            os.utime(path)
+        except OSError:
+            pass
+        doc = Doc(self.nlp.vocab).from_bytes(data["doc"])
+        if self.has_coref and Doc.has_extension("coref_clusters"):
+            clusters = [
+                CachedCluster(i, doc[main[0] : main[1]], [doc[start:end] for start, end in mentions])
+                for i, (main, mentions) in enumerate(data["coref"])
+            ]
+            doc._.set("coref_clusters", clusters or None)
+            doc._.set("has_coref", bool(clusters))
+        self.hits += 1
+        return doc
+
+    def put(self, text, doc):
+        """Store a parsed doc in the cache"""
+        data = {"doc": doc.to_bytes(exclude=["tensor", "user_data"]), "coref": []}
+        if self.has_coref and doc._.coref_clusters:
+            data["coref"] = [
+                (
+                    (cluster.main.start, cluster.main.end),
+                    [(mention.start, mention.end) for mention in cluster.mentions],
+                )
+                for cluster in doc._.coref_clusters
+            ]
+        path = self._path(text)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=TMP_SUFFIX)
+        with os.fdopen(fd, "wb") as f:
+            f.write(srsly.msgpack_dumps(data))
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = 100 * self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)"
+
+
+def shard_dirs(cache_dir):
+    """Return the paths of the shard directories of a cache directory"""
+    if not os.path.isdir(cache_dir):
+        return []
+    return [
+        entry.path
+        for entry in os.scandir(cache_dir)
+        if entry.is_dir() and len(entry.name) == 2 and all(c in "0123456789abcdef" for c in entry.name)
+    ]
+
+
+def prune_cache(cache_dir, max_bytes=None, max_age=None):
+    """Remove the cached docs that were not used for `max_age` seconds, and then the least recently used docs
+    until the cache is at most `max_bytes`. Return the number and total size of the removed files.
+    """
+    now = time.time()
+    docs = []
+    stale = []
+    for shard_dir in shard_dirs(cache_dir):
+        for entry in os.scandir(shard_dir):
+            stat = entry.stat()
+            if entry.name.endswith(".bin"):
+                docs.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith(TMP_SUFFIX) and now - stat.st_mtime > TMP_MAX_AGE:
+                stale.append((stat.st_mtime, stat.st_size, entry.path))
+    # Keep the most recently used docs first
+    docs.sort(reverse=True)
+    kept_bytes = 0
+    for i, (used, size, _) in enumerate(docs):
+        if (max_age is not None and now - used > max_age) or (max_bytes is not None and kept_bytes + size > max_bytes):
+            stale.extend(docs[i:])
+            break
+        kept_bytes += size
+    num_removed = 0
+    removed_bytes = 0
+    for _, size, path in stale:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Already removed by another process
+            continue
+        num_removed += 1
+        removed_bytes += size
+    return num_removed, removed_bytes
+
+
+def clear_cache(cache_dir):
+    """Remove all cached docs (only the cache's shard directories are removed, not other files)"""
+    for shard_dir in shard_dirs(cache_dir):
+        shutil.rmtree(shard_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prune or clear an on-disk cache of parsed documents")
+    parser.add_argument("--doc_cache", type=str, required=True, help="Path to the doc cache directory")
+    parser.add_argument("--max_gb", type=float, default=0, help="Remove the least recently used docs until the cache is at most this size")
+    parser.add_argument("--max_age_days", type=float, default=0, help="Remove the docs that were not used for this many days")
+    parser.add_argument("--clear", action="store_true", help="Remove all cached docs")
+    args = vars(parser.parse_args())
+
+    if args["clear"]:
+        clear_cache(args["doc_cache"])
+        print(f"Cleared the doc cache in {args['doc_cache']}")
+    else:
+        num_removed, removed_bytes = prune_cache(
+            args["doc_cache"],
+            max_bytes=int(args["max_gb"] * 1e9) if args["max_gb"] else None,
+            max_age=args["max_age_days"] * 86400 if args["max_age_days"] else None,
+        )
+        print(f"Removed {num_removed} docs ({removed_bytes / 1e9:.2f} GB) from the doc cache in {args['doc_cache']}")
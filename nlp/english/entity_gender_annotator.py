@@ -1,11 +1,15 @@
 import argparse
+import bisect
+import copy
 import importlib
 import json
 import logging
-import re
+import os
 import traceback
 from datetime import datetime, timedelta
-from multiprocessing import Pool, cpu_count
+from functools import partial
+from itertools import islice
+from multiprocessing import Barrier, Pool, cpu_count
 
 import neuralcoref
 import requests
@@ -16,6 +20,7 @@ from spacy.pipeline import EntityRuler
 import gender_predictor
 import utils
 from config import config
+from doc_cache import DocCache, prune_cache
 from quote_extractor import QuoteExtractor
 
 logger = utils.create_logger(
@@ -27,38 +32,138 @@ logger = utils.create_logger(
 
 
 def chunker(iterable, chunksize):
-    """Yield a smaller chunk of a large iterable"""
-    for i in range(0, len(iterable), chunksize):
-        yield iterable[i: i + chunksize]
+    """Yield a smaller chunk of a large iterable (which can also be a lazily-evaluated stream)"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunksize))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunksize))
+
+
+def load_nlp(spacy_model, name_patterns):
+    """Load a spaCy language model and attach the custom entity ruler and coreference pipes downstream"""
+    nlp = spacy.load(spacy_model)
+    # Add custom named entity rules for non-standard person names that spaCy doesn't automatically identify
+    ruler = EntityRuler(nlp, overwrite_ents=True).from_disk(name_patterns)
+    nlp.add_pipe(ruler)
+    coref = neuralcoref.NeuralCoref(nlp.vocab, max_dist=200)
+    nlp.add_pipe(coref, name="neuralcoref")
+    return nlp
+
+
+def init_worker(spacy_model, barrier):
+    """Load the spaCy pipeline, annotator, HTTP session, MongoDB client and writers once per worker
+    process, so that they can be reused for every chunk the worker processes.
+    """
+    global nlp, annotator, quote_extractor, db_client, writer, write_writer, flush_barrier
+    nlp = load_nlp(spacy_model, NAME_PATTERNS)
+    if DOC_CACHE:
+        # Reuse parses of previously processed article bodies from the on-disk cache
+        nlp = DocCache(DOC_CACHE, nlp)
+    annotator = EntityGenderAnnotator({**config, "spacy_lang": nlp, "session": requests.Session()})
+    quote_extractor = QuoteExtractor({**config, "spacy_lang": nlp})
+    db_client = utils.init_client(MONGO_ARGS)
+    # Writes to both collections are buffered across chunks, and each chunk is committed once all
+    # its writes are written
+    writer = utils.BulkWriter(db_client[DB_NAME][READ_COL], WRITE_BATCH_SIZE, WRITE_INTERVAL, logger)
+    write_writer = writer.for_collection(db_client[DB_NAME][WRITE_COL]) if WRITE_COL else None
+    flush_barrier = barrier
+    logger.info(f"Worker {os.getpid()} loaded spaCy language model: {spacy_model}")
 
 
 def process_chunks(chunk):
     """Pass through a chunk of document IDs and extract quotes"""
-    db_client = utils.init_client(MONGO_ARGS)
     read_collection = db_client[DB_NAME][READ_COL]
+    # Process all articles in the chunk first, and then resolve the genders of all their names at once
+    resolver = gender_predictor.GenderResolver(annotator.session, db_client)
+    pending = []
+    num_failed = 0
     for idx in chunk:
         mongo_doc = read_collection.find_one({"_id": idx})
-        process_mongo_doc(db_client, read_collection, mongo_doc)
+        if mongo_doc is None:
+            logger.error(f'Document "{idx}" not found.')
+            num_failed += 1
+            continue
+        result = process_mongo_doc(db_client, writer, write_writer, mongo_doc, resolver)
+        if callable(result):
+            pending.append(result)
+        elif not result:
+            num_failed += 1
+    # Documents whose names' genders could not be resolved fail to write, and are logged
+    resolver.resolve()
+    for write in pending:
+        num_failed += not write()
+    # Chunks with failed documents are not committed, so that they are processed again with --resume
+    writer.mark(chunk[-1], num_failed)
+    logger.info(f"Worker {os.getpid()} name gender cache: {gender_predictor.NAME_CACHE.stats()}")
+    return chunk, writer.pop_committed()
+
+
+def flush_worker(_):
+    """Flush the writes that a worker still buffers at the end of a run, and return the chunks this commits.
+    Each worker waits for all other workers first, so that every worker runs exactly one of these tasks.
+    """
+    flush_barrier.wait()
+    writer.close()
+    return writer.pop_committed()
 
 
 def run_pool(poolsize, chunksize):
     """Concurrently perform quote extraction based on a filter query"""
-    # Find ALL ids in the database within the query bounds (one-time only)
+    # Stream the ids of all documents within the query bounds from a sorted cursor, so that
+    # processing starts right away and memory use does not grow with the size of the backlog
     client = utils.init_client(MONGO_ARGS)
     id_collection = client[DB_NAME][READ_COL]
     query = utils.prepare_query(FILTERS)
-    document_ids = id_collection.find(query).distinct("_id")
-    logger.info(f"Obtained ID list for {len(document_ids)} articles.")
 
-    # Check for doc limit
-    if DOC_LIMIT > 0:
-        document_ids = document_ids[:DOC_LIMIT]
-    logger.info(f"Processing {len(document_ids)} articles...")
-
-    # Process quotes using a pool of executors
-    pool = Pool(processes=poolsize)
-    pool.map(process_chunks, chunker(document_ids, chunksize=chunksize))
-    pool.close()
+    # Record progress in a checkpoint, and optionally resume from the last committed ID of an interrupted run
+    # (chunks are only handed out in ID order, which checkpoints rely on, when they are not scheduled by length)
+    checkpoint = None
+    if UPDATE_DB and SCHEDULE == "ids":
+        checkpoint = utils.RunCheckpoint(client[DB_NAME][CHECKPOINT_COL], "entity_gender_annotator", RUN_PARAMS)
+        last_id = checkpoint.last_committed_id() if RESUME else None
+        if last_id is not None:
+            logger.info(f"Resuming interrupted run after document ID {last_id}")
+            query = {"$and": [query, {"_id": {"$gt": last_id}}]}
+        elif RESUME:
+            logger.warning("No interrupted run found with the same parameters, starting from the beginning.")
+        checkpoint.start(last_id)
+
+    scheduler = None
+    if SCHEDULE == "length":
+        # Balance the work in each chunk by the length of the articles, and hand out the longest chunks first
+        id_lengths = utils.fetch_body_lengths(id_collection, query, limit=DOC_LIMIT)
+        scheduler = utils.LengthScheduler(id_lengths, chunksize, logger=logger)
+        chunks = scheduler.chunks()
+        logger.info(f"Scheduled {len(id_lengths)} articles in {len(scheduler.work)} chunks by length.")
+    else:
+        document_ids = utils.stream_ids(id_collection, query, limit=DOC_LIMIT)
+        logger.info("Streaming article IDs from the database...")
+        chunks = chunker(document_ids, chunksize=chunksize)
+
+    # Process documents using a pool of persistent workers, handing out chunks as workers become free
+    # Only a few chunks are queued for the workers at any time (bounded queue)
+    if checkpoint:
+        chunks = checkpoint.track(chunks)
+    num_processed = 0
+    barrier = Barrier(poolsize)
+    with Pool(processes=poolsize, initializer=init_worker, initargs=(SPACY_MODEL, barrier)) as pool:
+        chunk_func = partial(utils.run_timed, process_chunks)
+        for (chunk, committed), seconds in utils.imap_bounded(pool, chunk_func, chunks, max_pending=2 * poolsize):
+            num_processed += len(chunk)
+            if scheduler:
+                scheduler.report(chunk, seconds)
+            if checkpoint:
+                for last_id in committed:
+                    checkpoint.mark_done(last_id)
+        # Flush the writes that the workers still buffer
+        for committed in pool.map(flush_worker, range(poolsize), chunksize=1):
+            if checkpoint:
+                for last_id in committed:
+                    checkpoint.mark_done(last_id)
+    if checkpoint and not checkpoint.finish():
+        logger.warning("Some chunks were not written due to errors. Rerun with --resume to process them again.")
+    logger.info(f"Processed {num_processed} articles.")
 
 
 class EntityGenderAnnotator:
@@ -66,10 +171,12 @@ class EntityGenderAnnotator:
         self.nlp = config["spacy_lang"]
         self.session = config["session"]
         self.blocklist = utils.get_author_blocklist(config["NLP"]["AUTHOR_BLOCKLIST"])
+        # Kept across articles, so that recurring author strings are only resolved once per process
+        self.author_cleaner = utils.CleanAuthors(self.nlp)
 
     def has_coverage(self, s1, s2):
-        """Check if one span covers another"""
-        return len(s1.intersection(s2)) >= 2
+        """Check if one (start, end) span covers another"""
+        return utils.has_coverage(s1, s2)
 
     def merge_nes(self, doc_coref):
         """
@@ -86,37 +193,38 @@ class EntityGenderAnnotator:
         # in this for loop we try to merge clusters detected in coreference clustering
 
         # ----- Part A: assign clusters to person named entities
+        # Index the mentions of all coreference clusters by their character offsets
+        coref_clusters = doc_coref._.coref_clusters
+        if coref_clusters is not None:
+            mention_index = utils.SpanIndex(
+                ((ment.start_char, ment.end_char), cluster)
+                for cluster in coref_clusters
+                for ment in cluster.mentions
+            )
         for ent in person_nes:
             # Sometimes we get noisy characters in name entities
             ent_cleaned = utils.clean_ne(str(ent))
             if (len(ent_cleaned) == 0) or utils.string_contains_digit(ent_cleaned):
                 continue
 
-            ent_set = set(range(ent.start_char, ent.end_char))
-            found = False
             # if no coreference clusters is detected in the document
-            if doc_coref._.coref_clusters is None:
+            if coref_clusters is None:
                 ne_dict[ent] = []
                 ne_clust[ent] = -1
 
             else:
-                for cluster in doc_coref._.coref_clusters:
-                    for ment in cluster.mentions:
-                        ment_set = set(range(ment.start_char, ment.end_char))
-                        if self.has_coverage(ent_set, ment_set):
-                            ne_dict[ent] = cluster
-                            ne_clust[ent] = cluster.i
-                            found = True
-                            break
-                    if found:
-                        break
-                if not found:
+                # Find the first cluster with a mention that covers the named entity
+                cluster = mention_index.first_overlapping((ent.start_char, ent.end_char), min_overlap=2)
+                if cluster is not None:
+                    ne_dict[ent] = cluster
+                    ne_clust[ent] = cluster.i
+                else:
                     ne_dict[ent] = []
                     ne_clust[ent] = -1
 
         # ----- Part B: Merge clusters in ne_dict based on exact match of their representative (PERSON named entities)
         merged_nes = {}
-        for ne, cluster in zip(ne_dict.keys(), ne_dict.values()):
+        for ne, cluster in ne_dict.items():
             ne_clean_text = utils.clean_ne(str(ne))
             if not cluster:
                 cluster_id = [-1]
@@ -126,16 +234,14 @@ class EntityGenderAnnotator:
                 mentions = cluster.mentions
 
             # check if we already have a unique cluster with same representative
-            if ne_clean_text in merged_nes.keys():
-                retrieved = merged_nes[ne_clean_text]
-                lst = retrieved["mentions"]
-                lst = lst + [ne] + mentions
-                cls = retrieved["cluster_id"]
-                cls = cls + cluster_id
-                merged_nes[ne_clean_text] = {"mentions": lst, "cluster_id": cls}
+            retrieved = merged_nes.get(ne_clean_text)
+            if retrieved is not None:
+                # Extend the lists in place, instead of copying them for every repeated name
+                retrieved["mentions"].append(ne)
+                retrieved["mentions"].extend(mentions)
+                retrieved["cluster_id"].extend(cluster_id)
             else:
-                tmp = [ne] + mentions
-                merged_nes[ne_clean_text] = {"mentions": tmp, "cluster_id": cluster_id}
+                merged_nes[ne_clean_text] = {"mentions": [ne] + mentions, "cluster_id": cluster_id}
 
         # ----- Part C: do a complex merge
         complex_merged_nes, _ = self.complex_merge(merged_nes)
@@ -143,28 +249,71 @@ class EntityGenderAnnotator:
 
     def complex_merge(self, ne_dict):
         """
-        Last try to merge named entities based on multi-part ne merge policy
+        Last try to merge named entities based on multi-part ne merge policy.
+        Each name is merged into the first name already merged (in insertion order) that it can be merged with.
+        Since can_merge_nes only merges names that share their first token, or their last one or two tokens,
+        the merged names are indexed by these tokens, and each name is only compared against the names
+        that share them, rather than against all merged names.
         """
         merged_nes = {}
         changed = {}
+        # Insertion sequence of each merged name, to find the first candidate in merged_nes order
+        seq = {}
+        # (token count, tokens) -> merged names with these first (for 2 part names) or last tokens
+        candidates = {}
+
+        def index_keys(name):
+            tokens = name.strip().split(" ")
+            if len(tokens) == 1:
+                return [(1, tuple(tokens))]
+            if len(tokens) == 2:
+                return [(2, tokens[0]), (2, tuple(tokens))]
+            if len(tokens) == 3:
+                return [(3, tokens[-1]), (3, tuple(tokens[-2:]))]
+            return []
+
+        def lookup_keys(name):
+            tokens = name.strip().split(" ")
+            if len(tokens) == 1:
+                return [(2, tokens[0]), (3, tokens[0])]
+            if len(tokens) == 2:
+                return [(1, (tokens[0],)), (3, tuple(tokens))]
+            if len(tokens) == 3:
+                return [(2, tuple(tokens[-2:])), (1, (tokens[-1],))]
+            return []
+
+        def add(name, mentions):
+            merged_nes[name] = mentions
+            seq[name] = len(seq)
+            for key in index_keys(name):
+                candidates.setdefault(key, set()).add(name)
+
+        def remove(name):
+            del merged_nes[name]
+            for key in index_keys(name):
+                candidates[key].discard(name)
+
         for ne in ne_dict.keys():
             found = False
-            for merged in merged_nes.keys():
+            matches = set()
+            for key in lookup_keys(str(ne)):
+                matches.update(candidates.get(key, ()))
+            for merged in sorted(matches, key=seq.__getitem__):
                 if self.can_merge_nes(str(ne), str(merged)):
                     if len(ne) > len(merged):
-                        merged_nes[ne] = merged_nes[merged] + ne_dict[ne]["mentions"]
+                        mentions = merged_nes[merged]
+                        mentions.extend(ne_dict[ne]["mentions"])
                         changed[ne] = 1
-                        del merged_nes[merged]
+                        remove(merged)
+                        add(ne, mentions)
                     elif len(ne) < len(merged):
                         changed[merged] = 1
-                        merged_nes[merged] = (
-                            merged_nes[merged] + ne_dict[ne]["mentions"]
-                        )
+                        merged_nes[merged].extend(ne_dict[ne]["mentions"])
                     found = True
                     break
             if not found:
                 changed[ne] = 0
-                merged_nes[ne] = ne_dict[ne]["mentions"]
+                add(ne, list(ne_dict[ne]["mentions"]))
 
         return merged_nes, changed
 
@@ -227,14 +376,15 @@ class EntityGenderAnnotator:
                 final_nes[key] = value
         return final_nes
 
-    def get_named_entity(self, doc_coref, span_start, span_end):
-        span_set = set(range(span_start, span_end))
-        for x in doc_coref.ents:
-            x_start = x.start_char
-            x_end = x.end_char
-            x_set = set(range(x_start, x_end))
-            if self.has_coverage(span_set, x_set):
-                return str(x), x.label_
+    def get_named_entity(self, doc_coref, span_start, span_end, ent_index=None):
+        """Return the text and label of the first named entity that covers a span.
+        An index of the doc's entities can be passed in when looking up many spans in the same doc.
+        """
+        if ent_index is None:
+            ent_index = utils.SpanIndex(((x.start_char, x.end_char), x) for x in doc_coref.ents)
+        x = ent_index.first_overlapping((span_start, span_end), min_overlap=2)
+        if x is not None:
+            return str(x), x.label_
         return None, None
 
     def write_unknown_genders_to_log(self, gender_results):
@@ -244,52 +394,48 @@ class EntityGenderAnnotator:
                 "Unknown gender names after trying in all caches and services: {0}".format(str(unknown_gender_names))
             )
 
-    def quote_assign(self, nes, quotes, doc_coref):
+    def quote_assign(self, nes, quotes, doc_coref, offset=0):
         """
-        Assign quotes to named entities based on overlap of quote's speaker span and the named entity span
+        Assign quotes to named entities based on overlap of quote's speaker span and the named entity span.
+        If doc_coref is a window of a longer text, `offset` is the position of the window in that text.
         """
         quote_nes = {}
         quote_no_nes = []
-        index_finder_pattern = re.compile(r".*\((\d+),(\d+)\).*")
 
         aligned_quotes_indices = []
 
+        # Index the mentions of all named entities (in order), and the doc's entities, by their character offsets
+        mention_index = utils.SpanIndex(
+            ((mention.start_char + offset, mention.end_char + offset), ne)
+            for ne, mentions in zip(nes.keys(), nes.values())
+            for mention in mentions
+        )
+        ent_index = utils.SpanIndex(((x.start_char + offset, x.end_char + offset), x) for x in doc_coref.ents)
+
         for q in quotes:
-            regex_match = index_finder_pattern.match(q["speaker_index"])
-            q_start = int(regex_match.groups()[0])
-            q_end = int(regex_match.groups()[1])
-            q_set = set(range(q_start, q_end))
+            q_start, q_end = utils.get_span(q, "speaker")
 
             quote_aligned = False
             # search in all of the named entity mentions in it's cluster for the speaker span.
-            for ne, mentions in zip(nes.keys(), nes.values()):
-                if quote_aligned:
-                    break
-                for mention in mentions:
-                    mention_start = mention.start_char
-                    mention_end = mention.end_char
-                    mention_set = set(range(mention_start, mention_end))
-
-                    if self.has_coverage(q_set, mention_set):
-                        alignment_key = f"{q_start}-{q_end}"
-                        aligned_quotes_indices.append(alignment_key)
-                        q["is_aligned"] = True
-                        q["named_entity"] = str(ne)
-                        q["named_entity_type"] = "PERSON"
-                        quote_aligned = True
-
-                        if ne in quote_nes.keys():
-                            current_ne_quotes = quote_nes[ne]
-                            current_ne_quotes.append(q)
-                            quote_nes[ne] = current_ne_quotes
-                        else:
-                            quote_nes[ne] = [q]
-
-                        break  # Stop searching in mentions. Go for next quote
+            ne = mention_index.first_overlapping((q_start, q_end), min_overlap=2)
+            if ne is not None:
+                alignment_key = f"{q_start}-{q_end}"
+                aligned_quotes_indices.append(alignment_key)
+                q["is_aligned"] = True
+                q["named_entity"] = str(ne)
+                q["named_entity_type"] = "PERSON"
+                quote_aligned = True
+
+                if ne in quote_nes.keys():
+                    current_ne_quotes = quote_nes[ne]
+                    current_ne_quotes.append(q)
+                    quote_nes[ne] = current_ne_quotes
+                else:
+                    quote_nes[ne] = [q]
 
             if not quote_aligned:
                 q["is_aligned"] = False
-                ne_text, ne_type = self.get_named_entity(doc_coref, q_start, q_end)
+                ne_text, ne_type = self.get_named_entity(doc_coref, q_start, q_end, ent_index)
                 if ne_text is not None:
                     q["named_entity"] = ne_text
                     q["named_entity_type"] = ne_type
@@ -307,14 +453,96 @@ class EntityGenderAnnotator:
 
         return quote_nes, quote_no_nes, all_quotes
 
-    def run(self, db_client, text, authors, quotes, article_url):
-        """Return gender annotations based on names of people and quotes"""
+    def run(self, db_client, text, authors, quotes, article_url, doc_coref=None, resolver=None):
+        """Return gender annotations based on names of people and quotes.
+        If the preprocessed text was already parsed with the full pipeline (e.g., to extract quotes
+        from the same doc), pass it in as `doc_coref` so that it isn't parsed again.
+        If a gender resolver shared by many articles is passed in, a function that returns the
+        annotations once the resolver has resolved the genders is returned instead (see annotate()).
+        """
+        if doc_coref is None:
+            text_preprocessed = utils.preprocess_text(text)
+            doc_coref = self.nlp(text_preprocessed)
+        unified_nes = self.merge_nes(doc_coref)
+        final_nes = self.remove_invalid_nes(unified_nes)
+        nes_quotes, quotes_no_nes, all_quotes = self.quote_assign(
+            final_nes, quotes, doc_coref
+        )
+        return self.annotate(
+            db_client, authors, list(final_nes.keys()), quotes, nes_quotes, quotes_no_nes, all_quotes, article_url,
+            resolver,
+        )
+
+    def run_windowed(self, db_client, text, authors, quotes, article_url, max_length, resolver=None, window_docs=None):
+        """Return gender annotations for a long text, like run(), but parse it in windows of paragraphs (of at most
+        `max_length` characters). If the windows were already parsed with the full pipeline (e.g., to extract quotes
+        from them), pass in their (offset in the preprocessed text, doc) as `window_docs`, so that they aren't parsed
+        again. Named entities are merged within each window and then across windows, so that the same person is one
+        named entity in the whole text. Each quote is assigned to the named entities of the window its speaker is in.
+        """
+        if window_docs is None:
+            window_docs = [
+                (offset, self.nlp(window))
+                for offset, window in utils.split_windows(utils.preprocess_text(text), max_length)
+            ]
+        window_starts = [offset for offset, _ in window_docs]
+        window_quotes = [[] for _ in window_docs]
+        for q in quotes:
+            speaker_start = utils.get_span(q, "speaker")[0]
+            window_quotes[max(0, bisect.bisect_right(window_starts, speaker_start) - 1)].append(q)
+
+        # Merge the named entities of all windows by exact and then partial match, like merge_nes does
+        # within a doc, and keep track of the window of each mention
+        window_nes = {}
+        for i, (_, doc_coref) in enumerate(window_docs):
+            for ne, mentions in self.merge_nes(doc_coref).items():
+                window_nes.setdefault(ne, {"mentions": []})["mentions"].extend((i, mention) for mention in mentions)
+        merged_nes, _ = self.complex_merge(window_nes)
+        final_nes = self.remove_invalid_nes(merged_nes)
+
+        nes_quotes, quotes_no_nes = {}, []
+        for i, ((offset, doc_coref), quotes_in_window) in enumerate(zip(window_docs, window_quotes)):
+            nes = {ne: [mention for j, mention in mentions if j == i] for ne, mentions in final_nes.items()}
+            window_nes_quotes, window_quotes_no_nes, _ = self.quote_assign(
+                nes, quotes_in_window, doc_coref, offset=offset
+            )
+            for ne, ne_quotes in window_nes_quotes.items():
+                nes_quotes.setdefault(ne, []).extend(ne_quotes)
+            quotes_no_nes.extend(window_quotes_no_nes)
+        all_quotes = [q for ne_quotes in nes_quotes.values() for q in ne_quotes] + quotes_no_nes
+        return self.annotate(
+            db_client, authors, list(final_nes), quotes, nes_quotes, quotes_no_nes, all_quotes, article_url, resolver
+        )
+
+    def annotate(
+        self, db_client, authors, people, quotes, nes_quotes, quotes_no_nes, all_quotes, article_url, resolver=None
+    ):
+        """Predict the genders of authors, people and sources, and return the annotations of an article.
+        The names of authors and people are added to a gender resolver, to look up all their genders at once.
+        If a resolver shared by many articles is passed in, the names are only added to it, and a function is
+        returned that builds the annotations after the genders of all articles' names have been resolved.
+        """
+        authors = self.author_cleaner.clean(authors, self.blocklist)
+        people = list(
+            filter(None, people)
+        )  # Make sure no empty values are sent for gender prediction
+        build = partial(
+            self.build_annotation, authors, people, quotes, nes_quotes, quotes_no_nes, all_quotes, article_url
+        )
+        if resolver is not None:
+            resolver.add(authors + people)
+            return partial(build, resolver)
+        resolver = gender_predictor.GenderResolver(self.session, db_client)
+        resolver.add(authors + people)
+        resolver.resolve()
+        return build(resolver)
+
+    def build_annotation(
+        self, authors, people, quotes, nes_quotes, quotes_no_nes, all_quotes, article_url, resolver
+    ):
+        """Return the annotations of an article, with the genders of its names from a gender resolver"""
         # Process authors
-        cleaner = utils.CleanAuthors(self.nlp)
-        authors = cleaner.clean(authors, self.blocklist)
-        author_genders = {}
-        if authors:
-            author_genders = gender_predictor.get_genders(self.session, db_client, authors)
+        author_genders = resolver.genders(authors)
         authors_female, authors_male, authors_unknown = [], [], []
 
         for person, gender in zip(author_genders.keys(), author_genders.values()):
@@ -326,19 +554,9 @@ class EntityGenderAnnotator:
                 if person:
                     authors_unknown.append(person)
 
-        text_preprocessed = utils.preprocess_text(text)
-        doc_coref = self.nlp(text_preprocessed)
-        unified_nes = self.merge_nes(doc_coref)
-        final_nes = self.remove_invalid_nes(unified_nes)
-
         # Process people
-        people = list(final_nes.keys())
-        people = list(
-            filter(None, people)
-        )  # Make sure no empty values are sent for gender prediction
-        people_genders = {}
+        people_genders = resolver.genders(people)
         if people:
-            people_genders = gender_predictor.get_genders(self.session, db_client, people)
             self.write_unknown_genders_to_log(people_genders)
         people_female, people_male, people_unknown = [], [], []
         for person, gender in zip(people_genders.keys(), people_genders.values()):
@@ -352,9 +570,6 @@ class EntityGenderAnnotator:
 
         # Expert fields are filled base on gender of speakers in the quotes
         sources_female, sources_male, sources_unknown = [], [], []
-        nes_quotes, quotes_no_nes, all_quotes = self.quote_assign(
-            final_nes, quotes, doc_coref
-        )
         sources = list(nes_quotes.keys())
 
         for speaker in sources:
@@ -402,19 +617,54 @@ class EntityGenderAnnotator:
         return annotation
 
 
-def process_mongo_doc(db_client, read_collection, mongo_doc):
-    """Write entity-gender annotation results to a new collection OR update the existing collection."""
-    write_collection = db_client[DB_NAME][WRITE_COL] if WRITE_COL else None
+def write_annotation(read_collection, write_collection, doc_id, annotation, extra_fields=None):
+    """Write the annotations of a document. `annotation` can also be a function that returns the annotations,
+    once the genders of the names in a chunk of documents have been resolved. Returns whether this succeeded.
+    """
+    try:
+        if callable(annotation):
+            annotation = annotation()
+        if extra_fields:
+            annotation = {**extra_fields, **annotation}
+        if UPDATE_DB:
+            if write_collection is not None:
+                # This logic is useful if we want to write to a different collection without affecting existing results
+                write_collection.insert_one(
+                    {"currentId": ObjectId(doc_id), **annotation}
+                )
+            else:
+                # Directly perform update on existing collection
+                read_collection.update_one(
+                    {"_id": ObjectId(doc_id)}, {"$set": annotation}
+                )
+        return True
+    except Exception:
+        logger.exception(
+            f"Failed to process {doc_id} due to runtime exception!"
+        )
+        traceback.print_exc()
+        return False
+
+
+def process_mongo_doc(db_client, read_collection, write_collection, mongo_doc, resolver=None):
+    """Write entity-gender annotation results to a new collection OR update the existing collection.
+    Both collections can also be writers (utils.BulkWriter or utils.CollectionWriter) that buffer their writes.
+    If a gender resolver shared by a chunk of documents is passed in, the results are not written right away.
+    Instead, a function is returned that writes them once the resolver has resolved the genders of the chunk
+    (and returns whether they were written). Otherwise, returns whether the document was processed without errors.
+    """
+    doc_id = str(mongo_doc["_id"]) if mongo_doc is not None else None
     try:
-        doc_id = str(mongo_doc["_id"])
         if mongo_doc is None:
-            logger.error(f'Document "{doc_id}" not found.')
+            logger.error("Document not found.")
+            return False
         else:
             text = mongo_doc["body"]
             text_length = len(text)
-            if text_length > MAX_BODY_LENGTH:
+            is_too_long = text_length > MAX_BODY_LENGTH
+            if is_too_long and not WINDOWED:
                 logger.warning(
-                    "Skipping document {doc_id} due to long length {text_length} characters"
+                    f"Skipping document {doc_id} due to long length {text_length} characters"
                 )
                 read_collection.update_one(
                     {"_id": ObjectId(doc_id)},
@@ -446,6 +696,7 @@ def process_mongo_doc(db_client, read_collection, mongo_doc):
                             "speakersNotCountedInSources": 1,
                             "quotesUpdated": 1,
                             "articleType": 1,
+                            **({"quotes": 1} if WITH_QUOTES else {}),
                             "lastModifier": "max_body_len",
                             "lastModified": datetime.now(),
                         }
@@ -454,25 +705,49 @@ def process_mongo_doc(db_client, read_collection, mongo_doc):
             else:
                 authors = mongo_doc.get("authors", [])
                 text = mongo_doc["body"]
-                quotes = mongo_doc["quotes"]
                 article_url = mongo_doc["url"]
-                annotation = annotator.run(db_client, text, authors, quotes, article_url)
-                if UPDATE_DB:
-                    if WRITE_COL:
-                        # This logic is useful if we want to write to a different collection without affecting existing results
-                        write_collection.insert_one(
-                            {"currentId": ObjectId(doc_id), **annotation}
+                extra_fields = None
+                if is_too_long:
+                    # Process long articles in windows of paragraphs
+                    if WITH_QUOTES:
+                        # Parse each window once, for both quote extraction and entity gender annotation
+                        window_docs = list(quote_extractor.parse_windows(utils.preprocess_text(text)))
+                        quotes = quote_extractor.extract_quotes_windowed(window_docs)
+                        annotation = annotator.run_windowed(
+                            db_client, text, authors, copy.deepcopy(quotes), article_url, MAX_BODY_LENGTH, resolver,
+                            window_docs=window_docs,
                         )
+                        extra_fields = {"quotes": quotes}
                     else:
-                        # Directly perform update on existing collection
-                        read_collection.update_one(
-                            {"_id": ObjectId(doc_id)}, {"$set": annotation}
+                        quotes = mongo_doc["quotes"]
+                        annotation = annotator.run_windowed(
+                            db_client, text, authors, quotes, article_url, MAX_BODY_LENGTH, resolver
                         )
-    except:
+                elif WITH_QUOTES:
+                    # Parse the article once with the full pipeline, and use the same doc for
+                    # quote extraction and entity gender annotation
+                    doc_coref = nlp(utils.preprocess_text(text))
+                    quotes = quote_extractor.extract_quotes(doc_coref)
+                    # Quotes are annotated in place, so keep the extracted quotes as they are
+                    annotation = annotator.run(
+                        db_client, text, authors, copy.deepcopy(quotes), article_url, doc_coref=doc_coref,
+                        resolver=resolver,
+                    )
+                    extra_fields = {"quotes": quotes}
+                else:
+                    quotes = mongo_doc["quotes"]
+                    annotation = annotator.run(db_client, text, authors, quotes, article_url, resolver=resolver)
+                write = partial(write_annotation, read_collection, write_collection, doc_id, annotation, extra_fields)
+                if resolver is not None:
+                    return write
+                return write()
+        return True
+    except Exception:
         logger.exception(
-            f"Failed to process {mongo_doc['_id']} due to runtime exception!"
+            f"Failed to process {doc_id} due to runtime exception!"
         )
         traceback.print_exc()
+        return False
 
 
 if __name__ == "__main__":
@@ -492,8 +767,18 @@ if __name__ == "__main__":
     parser.add_argument("--ids", type=str, help="Comma-separated list of document ids to process. \
                                                   By default, all documents in the collection are processed.")
     parser.add_argument("--spacy_model", type=str, default="en_core_web_lg", help="spaCy language model to use for NLP")
+    parser.add_argument("--doc_cache", type=str, default="", help="Path to a directory for caching parsed documents on disk")
+    parser.add_argument("--doc_cache_max_gb", type=float, default=20, help="Max. size of the doc cache, which is pruned to this size after each run (0 for no limit)")
     parser.add_argument("--poolsize", type=int, default=cpu_count(), help="Size of the concurrent process pool for the given task")
     parser.add_argument("--chunksize", type=int, default=20, help="Number of articles IDs per chunk being processed concurrently")
+    parser.add_argument("--schedule", type=str, default="ids", choices=["ids", "length"],
+                        help="Chunk articles by ID ('ids', streamed), or into chunks of similar total body length, longest first ('length')")
+    parser.add_argument("--write_batch_size", type=int, default=100, help="Max. number of buffered writes per bulk write to the database")
+    parser.add_argument("--write_interval", type=float, default=10.0, help="Max. number of seconds to buffer writes before a bulk write")
+    parser.add_argument("--windowed", action="store_true", help="Process documents longer than MAX_BODY_LENGTH in windows of paragraphs instead of skipping them")
+    parser.add_argument("--with_quotes", action="store_true", help="Also extract quotes, parsing each article only once for both stages")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run with the same arguments from its last checkpoint")
+    parser.add_argument("--checkpoint_col", type=str, default="nlpCheckpoints", help="Collection name to store run checkpoints in")
 
     dargs = parser.parse_args()
     args = vars(dargs)
@@ -517,6 +802,23 @@ if __name__ == "__main__":
     DOC_LIMIT = args["limit"]
     POOLSIZE = args["poolsize"]
     CHUNKSIZE = args["chunksize"]
+    SPACY_MODEL = args["spacy_model"]
+    DOC_CACHE = args["doc_cache"]
+    DOC_CACHE_MAX_GB = args["doc_cache_max_gb"]
+    WRITE_BATCH_SIZE = args["write_batch_size"]
+    WRITE_INTERVAL = args["write_interval"]
+    WITH_QUOTES = args["with_quotes"]
+    WINDOWED = args["windowed"]
+    RESUME = args["resume"]
+    SCHEDULE = args["schedule"]
+    if RESUME and SCHEDULE == "length":
+        parser.error("--resume relies on chunks being processed in ID order, and cannot be used with --schedule length")
+    CHECKPOINT_COL = args["checkpoint_col"]
+    # Arguments that identify a run, so that only a run with the same arguments is resumed
+    RUN_PARAMS = {
+        key: args[key]
+        for key in ["db", "readcol", "writecol", "with_quotes", "force_update", "limit", "begin_date", "end_date", "outlets", "ids", "spacy_model", "windowed"]
+    }
 
     DATE_BEGIN = utils.convert_date(args["begin_date"]) if args["begin_date"] else None
     DATE_END = utils.convert_date(args["end_date"]) if args["begin_date"] else None
@@ -527,7 +829,16 @@ if __name__ == "__main__":
     if DATE_END:
         DATE_FILTERS.append({"publishedAt": {"$lt": DATE_END + timedelta(days=1)}})
 
-    if FORCE_UPDATE:
+    if WITH_QUOTES:
+        # Process the same articles as the quote extractor would
+        if FORCE_UPDATE:
+            OTHER_FILTERS = []
+        else:
+            OTHER_FILTERS = [
+                {"quotes": {"$exists": False}},
+                {"lastModifier": "mediaCollectors"},
+            ]
+    elif FORCE_UPDATE:
         OTHER_FILTERS = [{"quotes": {"$exists": True}}]
     else:
         OTHER_FILTERS = [
@@ -547,33 +858,25 @@ if __name__ == "__main__":
         "other_filters": OTHER_FILTERS,
     }
 
-    print(f"Loading spaCy language model: {args['spacy_model']}...")
-    nlp = spacy.load(args["spacy_model"])
-    # Add custom named entity rules for non-standard person names that spaCy doesn't automatically identify
-    ruler = EntityRuler(nlp, overwrite_ents=True).from_disk(NAME_PATTERNS)
-    nlp.add_pipe(ruler)
-    coref = neuralcoref.NeuralCoref(nlp.vocab, max_dist=200)
-    nlp.add_pipe(coref, name="neuralcoref")
-    print("Finished loading")
-
-    args["spacy_lang"] = nlp
-    session = requests.Session()
-    args["session"] = session
     config = {**args, **config}
-    annotator = EntityGenderAnnotator(config)
 
     if IN_DIR:
         if OUT_DIR:
+            print(f"Loading spaCy language model: {SPACY_MODEL}...")
+            nlp = load_nlp(SPACY_MODEL, NAME_PATTERNS)
+            if DOC_CACHE:
+                nlp = DocCache(DOC_CACHE, nlp)
+            print("Finished loading")
+            annotator = EntityGenderAnnotator({**config, "spacy_lang": nlp, "session": requests.Session()})
             db_client = utils.init_client(MONGO_ARGS)
-            quote_extractor = QuoteExtractor(config)
+            quote_extractor = QuoteExtractor({**config, "spacy_lang": nlp})
             print("processing local files")
             file_dict = utils.get_files_from_folder(folder_path=IN_DIR, limit=DOC_LIMIT)
             for idx, text in file_dict.items():
                 print(idx)
-                quotes = quote_extractor.extract_quotes(
-                    nlp(utils.preprocess_text(text))
-                )
-                annotation = annotator.run(db_client, text, [], quotes, "")
+                doc_coref = nlp(utils.preprocess_text(text))
+                quotes = quote_extractor.extract_quotes(doc_coref)
+                annotation = annotator.run(db_client, text, [], quotes, "", doc_coref=doc_coref)
                 # json jump can't write datetime objects
                 annotation["lastModified"] = annotation["lastModified"].strftime(
                     "%m/%d/%Y, %H:%M:%S"
@@ -581,6 +884,12 @@ if __name__ == "__main__":
                 json.dump(annotation, open(f"{OUT_DIR}/{idx}.json", "w"))
     else:
         # Directly parse documents from the db, and write back to db
+        # (each worker process loads its own spaCy pipeline and database client)
         print("Running on database: ", DB_NAME)
         run_pool(POOLSIZE, CHUNKSIZE)
         logger.info("Finished processing documents.")
+
+    if DOC_CACHE and DOC_CACHE_MAX_GB:
+        # Remove the least recently used docs, so that the cache doesn't keep growing with every run
+        num_removed, removed_bytes = prune_cache(DOC_CACHE, max_bytes=int(DOC_CACHE_MAX_GB * 1e9))
+        logger.info(f"Removed {num_removed} docs ({removed_bytes / 1e9:.2f} GB) from the doc cache.")
@@ -1,12 +1,11 @@
 import json
 import os
 import argparse
-from ast import literal_eval
 import re
 from pathlib import Path
 from statistics import harmonic_mean
 
-from evaluate_quotes import evaluate_quotes
+from evaluate_quotes import evaluate_quotes, get_span
 
 """
 Display performance metrics for each stage of the gender annotation pipeline
@@ -24,9 +23,8 @@ def has_coverage(span_1: tuple, span_2: tuple) -> bool:
     Checks if span_1 has at least two overlapping characters
     with span_2
     """
-    span_1_char_indexes = set(range(*span_1))
-    span_2_char_indexes = set(range(*span_2))
-    return len(span_1_char_indexes & span_2_char_indexes) >= 2
+    overlap = min(span_1[1], span_2[1]) - max(span_1[0], span_2[0])
+    return overlap >= 2
 
 
 def clean_name(name):
@@ -81,8 +79,8 @@ def compare_speakers_and_verbs(target_quotes, pred_quotes):
                 target_quote["speaker_index"]
                 and pred_quote["speaker_index"]
                 and has_coverage(
-                    literal_eval(target_quote["speaker_index"]),
-                    literal_eval(pred_quote["speaker_index"]),
+                    get_span(target_quote, "speaker"),
+                    get_span(pred_quote, "speaker"),
                 )
             ):
                 speaker_true_pos += 1
@@ -92,8 +90,8 @@ def compare_speakers_and_verbs(target_quotes, pred_quotes):
                 target_quote["verb_index"]
                 and pred_quote["verb_index"]
                 and has_coverage(
-                    literal_eval(target_quote["verb_index"]),
-                    literal_eval(pred_quote["verb_index"]),
+                    get_span(target_quote, "verb"),
+                    get_span(pred_quote, "verb"),
                 )
             ):
                 verb_true_pos += 1
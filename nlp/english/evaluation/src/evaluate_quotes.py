@@ -19,31 +19,41 @@ def get_index(index_string):
         return None
 
 
+def get_span(quote, name):
+    """Get the span of a quote's `name` field ("quote", "speaker" or "verb"). Uses its integer
+    `<name>_start`/`<name>_end` fields if it has them, otherwise parses its `<name>_index` string.
+    """
+    if quote.get(f"{name}_start") is not None:
+        return [quote[f"{name}_start"], quote[f"{name}_end"]]
+    return get_index(quote.get(f"{name}_index", ""))
+
+
 def calc_index_match_score(indx1, indx2):
     if indx1 is None or indx2 is None:
         return 0
     else:
-        indx1_set = set(range(indx1[0], indx1[1]))
-        indx2_set = set(range(indx2[0], indx2[1]))
-        # score = len(indx1_set.intersection(indx2_set)) / len(indx1_set.union(indx2_set))
+        indx1_len = max(0, indx1[1] - indx1[0])
+        indx2_len = max(0, indx2[1] - indx2[0])
+        overlap = max(0, min(indx1[1], indx2[1]) - max(indx1[0], indx2[0]))
+        # score = overlap / (indx1_len + indx2_len - overlap)
         # We changed the score definition to make it assymetric and consider first item as reference.
-        if (len(indx1_set) == 0) or (len(indx2_set) == 0):
+        if (indx1_len == 0) or (indx2_len == 0):
             score = 0
         else:
-            score = len(indx1_set.intersection(indx2_set)) / len(indx1_set)
+            score = overlap / indx1_len
         return score
 
 
 def compare_quotes(q1, q2):
 
     # Compute Match Score
-    q1_index = get_index(q1["quote_index"])
-    q2_index = get_index(q2["quote_index"])
+    q1_index = get_span(q1, "quote")
+    q2_index = get_span(q2, "quote")
     quote_match_score = calc_index_match_score(q1_index, q2_index)
 
     # Compare speakers
-    s1_index = get_index(q1["speaker_index"])
-    s2_index = get_index(q2["speaker_index"])
+    s1_index = get_span(q1, "speaker")
+    s2_index = get_span(q2, "speaker")
     speaker_1 = q1["speaker"]
     # speaker_2 = q2['speaker']
     speaker_match_score = calc_index_match_score(s1_index, s2_index)
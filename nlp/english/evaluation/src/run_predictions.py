@@ -14,7 +14,9 @@ from tqdm import tqdm
 sys.path.insert(1, os.path.realpath(Path(__file__).resolve().parents[2]))
 
 from quote_extractor import QuoteExtractor
+from doc_cache import DocCache
 from entity_gender_annotator import EntityGenderAnnotator
+import gender_predictor
 from config import config
 import utils
 """
@@ -43,8 +45,14 @@ def chunker(iterable, chunksize):
         yield iterable[i: i + chunksize]
 
 
+def init_worker():
+    """Connect to the database once per worker process, rather than once per chunk"""
+    global db_client
+    # Genders are only looked up in the snapshot of the gender caches when one is given
+    db_client = None if GENDER_SNAPSHOT else utils.init_client(config["MONGO_ARGS"])
+
+
 def process_chunks(chunk):
-    db_client = utils.init_client(config["MONGO_ARGS"])
     for idx in chunk:
         rawtext = get_rawtexts_from_file(Path(IN_DIR) / f"{idx}.txt")
         text = utils.preprocess_text(rawtext)
@@ -63,8 +71,9 @@ def process_chunks(chunk):
                 open(os.path.join(extracted_quotes_dir, idx + ".json"), "w"),
             )
             print(f"Processed quotes for {idx}")
+            # Reuse the parsed doc from quote extraction instead of parsing the text again
             pred_annotation = entity_gender_annotator.run(
-                db_client, text, [], pred_extracted_quotes, []
+                db_client, text, [], pred_extracted_quotes, [], doc_coref=doc
             )
             pred_annotation["lastModified"] = pred_annotation["lastModified"].strftime(
                 "%m/%d/%Y, %H:%M:%S"
@@ -84,7 +93,7 @@ def run_predictions():
     num_chunks = len(list(chunker(common_ids, chunksize=CHUNKSIZE)))
     print(f"Organized {num_files} files into {num_chunks} chunks for concurrent processing...")
     # Process files using a pool of executors
-    with Pool(processes=POOLSIZE) as pool:
+    with Pool(processes=POOLSIZE, initializer=init_worker) as pool:
         for _ in tqdm(pool.imap(process_chunks, chunker(common_ids, chunksize=CHUNKSIZE)), total=num_chunks):
             pass
 
@@ -98,6 +107,8 @@ if __name__ == "__main__":
     parser.add_argument('--gender_annotation', action='store_true', help="run whole the whole pipeline on text on text input files")
     parser.add_argument('--all', action='store_true', help="compute all metrics")
     parser.add_argument('--spacy_model', type=str, default="en_core_web_lg", help="spacy language model")
+    parser.add_argument("--doc_cache", type=str, default="", help="Path to a directory for caching parsed documents on disk")
+    parser.add_argument("--gender_snapshot", type=str, default="", help="Path to a snapshot of the gender caches (see gender_snapshot.py) to look up genders in, instead of MongoDB and the gender services")
     parser.add_argument("--poolsize", type=int, default=cpu_count(), help="Size of the concurrent process pool for the given task")
     parser.add_argument("--chunksize", type=int, default=5, help="Number of articles per chunk being processed concurrently")
     args = vars(parser.parse_args())
@@ -108,6 +119,7 @@ if __name__ == "__main__":
     GENDER_ANNOTATION = args["gender_annotation"]
     POOLSIZE = args["poolsize"]
     CHUNKSIZE = args["chunksize"]
+    GENDER_SNAPSHOT = args["gender_snapshot"]
     if args["all"]:
         QUOTE_EXTRACTION = False  # No need to run quote extraction if we're running the whole pipeline
         GENDER_ANNOTATION = True
@@ -126,6 +138,12 @@ if __name__ == "__main__":
     nlp.add_pipe(ruler)
     coref = neuralcoref.NeuralCoref(nlp.vocab, max_dist=200)
     nlp.add_pipe(coref, name="neuralcoref")
+    if args["doc_cache"]:
+        # Skip parsing texts that were already parsed with the same model in an earlier run
+        nlp = DocCache(args["doc_cache"], nlp)
+    if GENDER_SNAPSHOT:
+        # Load the snapshot before forking the worker processes, so that they share its pages
+        gender_predictor.load_snapshot(GENDER_SNAPSHOT)
     print("Finished loading")
 
     args["spacy_lang"] = nlp
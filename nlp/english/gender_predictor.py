@@ -1,10 +1,18 @@
 #!flask/bin/python
 import json
 import logging
+import os
+import time
 import urllib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from urllib.request import urlopen
 
 import requests
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
+from requests.adapters import HTTPAdapter
 
 import utils
 from config import config
@@ -21,6 +29,13 @@ MANUAL_CACHE = config["GENDER_RECOGNITION"]["MANUAL_CACHE"]
 GENDERAPI_CACHE = config["GENDER_RECOGNITION"]["GENDERAPI_CACHE"]
 GENDERIZE_CACHE = config["GENDER_RECOGNITION"]["GENDERIZE_CACHE"]
 FIRSTNAME_CACHE = config["GENDER_RECOGNITION"]["FIRSTNAME_CACHE"]
+# Marker that is updated whenever names are written to the manual or first name caches
+CACHE_UPDATES = config["GENDER_RECOGNITION"]["CACHE_UPDATES"]
+NAME_CACHE_SIZE = config["GENDER_RECOGNITION"]["NAME_CACHE_SIZE"]
+NAME_CACHE_TTL = config["GENDER_RECOGNITION"]["NAME_CACHE_TTL"]
+# Names that no gender service could find a gender for, and how long (in seconds) to remember them
+NEGATIVE_CACHE = config["GENDER_RECOGNITION"]["NEGATIVE_CACHE"]
+NEGATIVE_CACHE_TTL = config["GENDER_RECOGNITION"]["NEGATIVE_CACHE_TTL"]
 # Services
 GENDERIZE_ENABLED = config["GENDER_RECOGNITION"]["GENDERIZE_ENABLED"]
 GENDERAPI_ENABLED = config["GENDER_RECOGNITION"]["GENDERAPI_ENABLED"]
@@ -28,6 +43,16 @@ GENDERAPI_ENABLED = config["GENDER_RECOGNITION"]["GENDERAPI_ENABLED"]
 # The V2 API uses JSON authentication tokens (and NOT the API key)
 # See the unified API docs: https://gender-api.com/en/api-docs/v2
 GENDERAPI_TOKEN = config["GENDER_RECOGNITION"]["GENDERAPI_TOKEN"]
+GENDERAPI_URL = config["GENDER_RECOGNITION"]["GENDERAPI_URL"]
+GENDERIZE_URL = config["GENDER_RECOGNITION"]["GENDERIZE_URL"]
+# Max. number of names per request, as limited by each service
+GENDERAPI_BATCH_SIZE = 100
+GENDERIZE_BATCH_SIZE = 10
+# Concurrency, rate limit (requests per second), retries and timeout (seconds) of service calls
+SERVICE_CONCURRENCY = config["GENDER_RECOGNITION"]["SERVICE_CONCURRENCY"]
+SERVICE_RATE_LIMIT = config["GENDER_RECOGNITION"]["SERVICE_RATE_LIMIT"]
+SERVICE_RETRIES = config["GENDER_RECOGNITION"]["SERVICE_RETRIES"]
+SERVICE_TIMEOUT = config["GENDER_RECOGNITION"]["SERVICE_TIMEOUT"]
 
 
 class CacheGenderizer:
@@ -56,12 +81,37 @@ class CacheGenderizer:
         self.genderapi_cache_col = db_client["genderCache"][genderapi_cache_col]
         self.genderize_cache_col = db_client["genderCache"][genderize_cache_col]
         self.firstname_cache_col = db_client["genderCache"][firstname_cache_col]
+        self.collections = {
+            "manual": self.manual_cache_col,
+            "genderapi_fullname": self.genderapi_cache_col,
+            "genderize_firstname": self.genderize_cache_col,
+            "genderapi_firstname": self.genderapi_cache_col,
+            "firstname": self.firstname_cache_col,
+        }
         # VIAF has been deprecated since early versions due to low accuracy
         # self.viaf_cache_col = db_client["genderCache"][viaf_cache_col]
 
-    def _find_query(self, names, query_field):
-        query = {"$or": [{query_field: name} for name in names]}
-        return query
+    def _find(self, collection, query_field, keys):
+        return list(collection.find({query_field: {"$in": keys}}, {"_id": 0}))
+
+    def _find_all(self, lookups):
+        """Query the caches of all tiers concurrently, and yield the matching cache entries of each tier in order"""
+        executor = get_executor()
+        futures = [
+            executor.submit(self._find, self.collections[tier], query_field, keys)
+            for tier, query_field, keys in lookups
+        ]
+        for future in futures:
+            yield future.result()
+
+    def _map_results(self, items, names_mapping, query_field):
+        """Map the gender of each cache entry that matches a key in names_mapping to the original names"""
+        return dict(
+            (name, item["gender"])
+            for item in items
+            if item[query_field] in names_mapping
+            for name in names_mapping[item[query_field]]
+        )
 
     def _update_unknowns(self, results):
         """Return a mapping of only those names that still have 'unknown' as their gender value"""
@@ -70,101 +120,174 @@ class CacheGenderizer:
         }
         return unknown_gender_names
 
-    def _get_manual_cache_gender(self, names_mapping, query_field="name"):
-        lowercased_names = list(names_mapping.keys())
-        result = self.manual_cache_col.find(
-            self._find_query(lowercased_names, query_field), {"_id": 0}
-        )
-        result_mapped = dict((names_mapping[item[query_field]], item["gender"]) for item in result)
-        return result_mapped
+    def _names_mapping(self, names):
+        """Return a mapping of lowercase, unaccented names to their original forms"""
+        names_mapping = {}
+        for name in names:
+            names_mapping.setdefault(utils.preprocess_text(name).lower(), []).append(name)
+        return names_mapping
+
+    def _first_name_mapping(self, names):
+        """Return a mapping of lowercase first names to the original names with that first name"""
+        names_mapping = {}
+        for name in names:
+            names_mapping.setdefault(name.split()[0].lower(), []).append(name)
+        return names_mapping
+
+    def resolve(self, names):
+        """Return the gender of each name (or "unknown"), along with the cache (tier) that each name's
+        gender was found in. All five caches are queried concurrently, for the full and first names
+        of all names at once, and the priority order of the caches is then applied to the results.
+        """
+        # Define initial results mapping (every gender is unknown at the beginning)
+        results = {name: "unknown" for name in names}
+        tiers = {}
+        # Obtain a mapping of lowercase, unaccented names to their original forms
+        names_mapping = self._names_mapping(names)
+        full_names = list(names_mapping)
+        first_names = list({token.lower() for name in names for token in name.split()[:1]})
+        lookups = [
+            ("manual", "name", full_names),
+            ("genderapi_fullname", "q", full_names),
+            ("genderize_firstname", "name", first_names),
+            ("genderapi_firstname", "name", first_names),
+            ("firstname", "name", first_names),
+        ]
+
+        for (tier, query_field, _), items in zip(lookups, self._find_all(lookups)):
+            # 1. Manual cache and 2. GenderAPI based on full name are matched by full name, while
+            # 3. Genderize, 4. GenderAPI and 5. first name cache are matched by first name
+            if tier == "manual":
+                mapping = names_mapping
+            else:
+                unknowns = self._update_unknowns(results)
+                if not unknowns:
+                    break
+                if query_field == "q":
+                    mapping = self._names_mapping(unknowns)
+                else:
+                    mapping = self._first_name_mapping(unknowns)
+            tier_results = self._map_results(items, mapping, query_field)
+            results.update(tier_results)
+            tiers.update((name, tier) for name, gender in tier_results.items() if gender != "unknown")
+        return results, tiers
 
-    def _get_genderapi_cache_gender(self, names_mapping, query_field="q"):
-        lowercased_names = list(names_mapping.keys())
-        result = self.genderapi_cache_col.find(
-            self._find_query(lowercased_names, query_field), {"_id": 0}
-        )
-        result_mapped = dict((names_mapping[item[query_field]], item["gender"]) for item in result)
-        return result_mapped
+    def run(self, names):
+        results, _ = self.resolve(names)
+        unknowns = self._update_unknowns(results)
+        return results, unknowns
 
-    def _get_genderize_cache_gender(self, names_mapping, query_field="name"):
-        lowercased_names = list(names_mapping.keys())
-        result = self.genderize_cache_col.find(
-            self._find_query(lowercased_names, query_field), {"_id": 0}
-        )
-        result_mapped = dict((names_mapping[item[query_field]], item["gender"]) for item in result)
-        return result_mapped
 
-    def _get_firstname_cache_gender(self, names_mapping, query_field="name"):
-        lowercased_names = list(names_mapping.keys())
-        result = self.firstname_cache_col.find(
-            self._find_query(lowercased_names, query_field), {"_id": 0}
-        )
-        result_mapped = dict((names_mapping[item[query_field]], item["gender"]) for item in result)
-        return result_mapped
+class SnapshotGenderizer(CacheGenderizer):
+    """
+    Look up genders in a read-only snapshot of the MongoDB caches (see gender_snapshot.py) instead of
+    the database, with the same priority order of the caches as CacheGenderizer.
+    """
 
-    def run(self, names):
-        # Define initial results mapping (every gender is unknown at the beginning)
-        results = {name: "unknown" for name in names}
-        # Obtain a mapping of lowercase, unaccented names to their original form
-        names_mapping = {utils.preprocess_text(name).lower(): name for name in names}
-        # 1. Try manual cache
-        manual_cache_results = self._get_manual_cache_gender(names_mapping, "name")
-        results.update(manual_cache_results)  # Update the results with the manual cache results
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
 
-        # 2. Try GenderAPI based on fullName
-        unknowns = self._update_unknowns(results)
-        if unknowns:
-            names_mapping = {utils.preprocess_text(name).lower(): name for name in unknowns}
-            genderapi_cache_fullname_results = self._get_genderapi_cache_gender(names_mapping, "q")
-            if genderapi_cache_fullname_results:
-                results.update(genderapi_cache_fullname_results)
-        else:
-            return results, unknowns
+    def _find_all(self, lookups):
+        for tier, query_field, keys in lookups:
+            yield [{query_field: key, "gender": gender} for key, gender in self.snapshot.find(tier, keys)]
 
-        # 3. Try Genderize based on first name
-        unknowns = self._update_unknowns(results)
-        if unknowns:
-            names_mapping = {utils.preprocess_text(name).lower(): name for name in unknowns}
-            first_name_mapping = {
-                name.split()[0].lower(): name for _, name in names_mapping.items()
-            }
-            genderize_cache_firstname_results = self._get_genderize_cache_gender(
-                first_name_mapping, "name"
-            )
-            if genderize_cache_firstname_results:
-                results.update(genderize_cache_firstname_results)
-        else:
-            return results, unknowns
 
-        # 4. Try GenderAPI based on first name
-        unknowns = self._update_unknowns(results)
-        if unknowns:
-            names_mapping = {utils.preprocess_text(name).lower(): name for name in unknowns}
-            first_name_mapping = {
-                name.split()[0].lower(): name for _, name in names_mapping.items()
-            }
-            genderapi_cache_firstname_results = self._get_genderapi_cache_gender(
-                first_name_mapping, "name"
-            )
-            if genderapi_cache_firstname_results:
-                results.update(genderapi_cache_firstname_results)
-        else:
-            return results, unknowns
+# Snapshot of the gender caches to use instead of MongoDB (and the gender services), see load_snapshot()
+SNAPSHOT = None
 
-        # 5. Try first name cache
-        unknowns = self._update_unknowns(results)
-        if unknowns:
-            names_mapping = {utils.preprocess_text(name).lower(): name for name in unknowns}
-            first_name_mapping = {
-                name.split()[0].lower(): name for _, name in names_mapping.items()
-            }
-            firstname_cache_results = self._get_firstname_cache_gender(first_name_mapping, "name")
-            if firstname_cache_results:
-                results.update(firstname_cache_results)
-        else:
-            return results, unknowns
-        unknowns = self._update_unknowns(results)
-        return results, unknowns
+
+def load_snapshot(path):
+    """Look up all genders in a snapshot of the gender caches from now on, without using the database or
+    the gender services. Load the snapshot before forking worker processes, so they share its pages.
+    """
+    global SNAPSHOT
+    from gender_snapshot import GenderSnapshot
+
+    SNAPSHOT = GenderSnapshot(path)
+    logger.info(f"Loaded snapshot of {len(SNAPSHOT)} names in the gender caches from {path}")
+    return SNAPSHOT
+
+
+_executor = None
+_executor_pid = None
+
+
+def get_executor():
+    """Return a thread pool for concurrent cache lookups, created once per (forked) process"""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=5)
+        _executor_pid = os.getpid()
+    return _executor
+
+
+class NameGenderCache:
+    """
+    Bounded LRU cache (per process) of the genders that were found for names in the MongoDB caches,
+    so that frequently occurring names are not looked up in the database for every article.
+    Only names with a known gender are cached, along with the cache (tier) the gender was found in.
+    Entries expire after `ttl` seconds, and the whole cache is cleared when the marker in the
+    cacheUpdates collection shows that the manual or first name caches were updated.
+    """
+
+    def __init__(self, max_size=NAME_CACHE_SIZE, ttl=NAME_CACHE_TTL, check_interval=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.version = None
+        self.checked_at = None
+        self.hits = 0
+        self.misses = 0
+        self.tier_hits = Counter()
+
+    def key(self, name):
+        # Names are matched by their normalized full name, and by their first name
+        return utils.preprocess_text(name).lower(), " ".join(name.split()[:1]).lower()
+
+    def check_updates(self, db_client):
+        """Clear the cache if the manual or first name caches were updated since the last check"""
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        marker = db_client["genderCache"][CACHE_UPDATES].find_one({"_id": "genderCache"})
+        version = marker["version"] if marker else 0
+        if version != self.version:
+            if self.entries:
+                logger.info(f"Gender caches were updated, clearing {len(self.entries)} cached names")
+            self.entries.clear()
+            self.version = version
+
+    def get(self, name):
+        """Return the cached gender of a name, or None if it isn't cached"""
+        key = self.key(name)
+        entry = self.entries.get(key)
+        if entry is None or entry[2] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.tier_hits[entry[1]] += 1
+        return entry[0]
+
+    def put(self, name, gender, tier):
+        key = self.key(name)
+        self.entries[key] = (gender, tier, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = 100 * self.hits / total if total else 0.0
+        tiers = ", ".join(f"{tier}: {count}" for tier, count in self.tier_hits.most_common())
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), {len(self.entries)} names cached ({tiers})"
+
+
+NAME_CACHE = NameGenderCache()
 
 
 # ========== Gender Service functions ==========
@@ -241,87 +364,181 @@ def get_viaf_gender(name, db_client, maximum_records=1000):
         return "unknown"
 
 
+class GenderServiceClient:
+    """
+    HTTP client for the external gender services. Requests are sent over one session (reusing its
+    connections) from a bounded pool of threads, rate limited with a token bucket, and retried with
+    exponential backoff on connection errors, timeouts, rate limiting (429) and server errors.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        session=None,
+        concurrency=SERVICE_CONCURRENCY,
+        rate_limit=SERVICE_RATE_LIMIT,
+        retries=SERVICE_RETRIES,
+        timeout=SERVICE_TIMEOUT,
+        backoff=0.5,
+    ):
+        self.session = session if session is not None else requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.bucket = utils.TokenBucket(rate_limit, capacity=concurrency)
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+
+    def request(self, method, url, **kwargs):
+        """Send a request, and return its response once it succeeds (or raise the last error)"""
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            delay = self.backoff * 2 ** attempt
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"{e}: Retrying {url} in {delay:.1f} seconds")
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                logger.warning(f"Status {response.status_code}: Retrying {url} in {delay:.1f} seconds")
+            time.sleep(delay)
+
+    def map(self, func, items):
+        """Call a function on each item concurrently, and return the results in the same order"""
+        return list(self.executor.map(func, items))
+
+
+_service_client = None
+_service_client_pid = None
+
+
+def get_service_client(session=None):
+    """Return the service client of this process, created (on the given session) once per (forked) process"""
+    global _service_client, _service_client_pid
+    if _service_client is None or _service_client_pid != os.getpid():
+        _service_client = GenderServiceClient(session)
+        _service_client_pid = os.getpid()
+    return _service_client
+
+
+def batches(items, batch_size):
+    return [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+
+
 class ServiceGenderizer:
-    def __init__(self, db_client, genderize_cache_col, genderapi_cache_col):
+    def __init__(self, db_client, genderize_cache_col, genderapi_cache_col, client=None):
         self.genderize_cache_col = db_client["genderCache"][genderize_cache_col]
         self.genderapi_cache_col = db_client["genderCache"][genderapi_cache_col]
+        self.client = client if client is not None else get_service_client()
+        # Names that each service returned a result for (even if it didn't find a gender)
+        self.checked = {"genderapi": set(), "genderize": set()}
 
-    def get_genderize_gender(self, full_name):
-        """Return ONE name's gender per API call"""
-        full_name = full_name.lower()
-        first_name = utils.extract_first_name(full_name)
-
-        if first_name is None:
-            return "unknown"
-        else:
+    def get_genderize_gender(self, names):
+        """Return multiple names' genders from their first names, with one Genderize call per 10 first names"""
+        results = {}
+        first_names = {}
+        for name in names:
+            first_name = utils.extract_first_name(name.lower())
+            if first_name is None:
+                results[name] = "unknown"
+                self.checked["genderize"].add(name)
+            else:
+                first_names.setdefault(first_name, []).append(name)
+
+        def get_batch(batch):
             try:
-                gender_payload = {"name": first_name}
-                # Create a requests session
-                session = requests.Session()
-                gender_return = session.get("https://api.genderize.io/?", params=gender_payload)
-                cache_obj = json.loads(gender_return.text)
-                gender = cache_obj["gender"]
-                logger.debug(
-                    'Genderize service call result for "{0}" ("{1}"): "{2}"'.format(
-                        first_name, full_name, gender
+                params = [("name[]", first_name) for first_name in batch]
+                response = self.client.request("GET", GENDERIZE_URL, params=params)
+                cache_objs = response.json()
+                for cache_obj in cache_objs:
+                    logger.debug(
+                        'Genderize service call result for "{0}": "{1}"'.format(
+                            cache_obj["name"], cache_obj["gender"]
+                        )
                     )
-                )
-                # Handle unknowns
-                if gender is None:
-                    gender = "unknown"
-                    cache_obj["gender"] = "unknown"
+                    # Handle unknowns
+                    if cache_obj["gender"] is None:
+                        cache_obj["gender"] = "unknown"
                 # Update Genderize cache
-                self.genderize_cache_col.insert_one(cache_obj)
-                return gender
+                if cache_objs:
+                    self.genderize_cache_col.insert_many(cache_objs)
+                return {cache_obj["name"]: cache_obj["gender"] for cache_obj in cache_objs}
             except Exception as e:
-                logger.exception("{e}: Failed to obtain gender from Genderize API call".format(e))
-                return "unknown"
+                logger.exception("{0}: Failed to obtain gender from Genderize API call".format(e))
+                return {}
+
+        for batch_results in self.client.map(get_batch, batches(list(first_names), GENDERIZE_BATCH_SIZE)):
+            for first_name, gender in batch_results.items():
+                results.update(dict.fromkeys(first_names.get(first_name, []), gender))
+                self.checked["genderize"].update(first_names.get(first_name, []))
+        return {name: results.get(name, "unknown") for name in names}
 
-    def get_genderapi_gender(self, session, names):
-        """Return multiple full names' genders with ONE Gender-API call"""
+    def get_genderapi_gender(self, names):
+        """Return multiple full names' genders, with one Gender-API call per 100 names"""
         assert all(
             name for name in names
         ), "Empty strings exist in name list, please clean prior to sending for gender prediction"
-        results = {}
-        try:
-            payload = [{"full_name": utils.preprocess_text(name)} for name in names]
-            # NOTE: As of March 2021, we switched to V2 of Gender-API's protocol
-            # The V2 API uses JSON authentication tokens (and NOT the API key)
-            url = "https://gender-api.com/v2/gender"
-            headers = {"Authorization": "Bearer {}".format(GENDERAPI_TOKEN)}
-            response = session.post(url, headers=headers, json=payload)
-            cache_obj = response.json()
-            for res in cache_obj:
-                full_name = res["input"]["full_name"]
-                if res["result_found"]:
-                    # Pop unnecessary fields from response JSON prior to storage
-                    for field in ["input", "details", "result_found"]:
-                        res.pop(field, None)
-                    logger.debug(
-                        'Obtained GenderAPI service result for "{0}": "{1}"'.format(
-                            full_name, res["gender"]
+        # Names are sent without accents, so map the names in the response back to the original names
+        original_names = {}
+        for name in names:
+            original_names.setdefault(utils.preprocess_text(name), []).append(name)
+
+        def get_batch(batch):
+            results = {}
+            checked = []
+            try:
+                payload = [{"full_name": full_name} for full_name in batch]
+                # NOTE: As of March 2021, we switched to V2 of Gender-API's protocol
+                # The V2 API uses JSON authentication tokens (and NOT the API key)
+                headers = {"Authorization": "Bearer {}".format(GENDERAPI_TOKEN)}
+                response = self.client.request("POST", GENDERAPI_URL, headers=headers, json=payload)
+                cache_updates = []
+                for res in response.json():
+                    full_name = res["input"]["full_name"]
+                    checked.extend(original_names.get(full_name, [full_name]))
+                    if res["result_found"]:
+                        # Pop unnecessary fields from response JSON prior to storage
+                        for field in ["input", "details", "result_found"]:
+                            res.pop(field, None)
+                        logger.debug(
+                            'Obtained GenderAPI service result for "{0}": "{1}"'.format(
+                                full_name, res["gender"]
+                            )
                         )
-                    )
-                    # Handle unknowns
-                    if res["gender"] not in ["male", "female"]:
-                        res["gender"] = "unknown"
-                    results[full_name] = res["gender"]
-                    # Update cache -- 'q' attribute stores the lowercased version of the full name
-                    res["q"] = full_name.lower()
-                    self.genderapi_cache_col.update_many(
-                        {"q": res["q"]}, {"$set": res}, upsert=True
-                    )
-                else:
-                    logger.warning(
-                        "No results found for GenderAPI service call for name: {0}".format(
-                            full_name
+                        # Handle unknowns
+                        if res["gender"] not in ["male", "female"]:
+                            res["gender"] = "unknown"
+                        results.update(dict.fromkeys(original_names.get(full_name, [full_name]), res["gender"]))
+                        # Update cache -- 'q' attribute stores the lowercased version of the full name
+                        res["q"] = full_name.lower()
+                        cache_updates.append(UpdateMany({"q": res["q"]}, {"$set": res}, upsert=True))
+                    else:
+                        logger.warning(
+                            "No results found for GenderAPI service call for name: {0}".format(
+                                full_name
+                            )
                         )
-                    )
-                    return results
-            return results
-        except Exception as e:
-            logger.exception("{0}: Failed to obtain gender from Gender-API call".format(e))
-            return results
+                if cache_updates:
+                    self.genderapi_cache_col.bulk_write(cache_updates, ordered=False)
+            except Exception as e:
+                logger.exception("{0}: Failed to obtain gender from Gender-API call".format(e))
+            return results, checked
+
+        results = {}
+        for batch_results, checked in self.client.map(get_batch, batches(list(original_names), GENDERAPI_BATCH_SIZE)):
+            results.update(batch_results)
+            self.checked["genderapi"].update(checked)
+        return results
 
     def run(self, session, results, unknowns):
         """
@@ -330,35 +547,176 @@ class ServiceGenderizer:
         """
         names = list(unknowns.keys())
         if GENDERAPI_ENABLED:
-            genderapi_results = self.get_genderapi_gender(session, names)
+            genderapi_results = self.get_genderapi_gender(names)
             results.update(genderapi_results)
         if GENDERIZE_ENABLED:
-            for name in names:
-                genderize_result = {name: self._get_genderize_gender(name)}
-                results.update(genderize_result)
+            genderize_results = self.get_genderize_gender(names)
+            results.update(genderize_results)
         return results
 
+    def checked_by_all(self, names):
+        """Return the names that all enabled services returned a result for"""
+        services = [
+            service
+            for service, enabled in [("genderapi", GENDERAPI_ENABLED), ("genderize", GENDERIZE_ENABLED)]
+            if enabled
+        ]
+        if not services:
+            return []
+        return [name for name in names if all(name in self.checked[service] for service in services)]
+
+
+class NegativeCache:
+    """
+    Names that no cache or gender service could find a gender for, so that they are not sent to
+    the (paid) gender services again for every article they appear in. Entries expire after a TTL
+    (from their lastChecked field), after which the services are tried once again.
+    Entries are removed by the admin dashboard when the name, or its first name, is added to the
+    manual or first name caches.
+
+    Expired entries are ignored by lookups, and are removed by the TTL index that manage_indexes.py
+    creates on the collection (along with its other indexes).
+    """
+
+    def __init__(self, db_client, negative_cache_col, ttl=NEGATIVE_CACHE_TTL):
+        self.col = db_client["genderCache"][negative_cache_col]
+        self.ttl = ttl
+
+    def key(self, name):
+        return utils.preprocess_text(name).lower()
+
+    def filter_known_unknowns(self, names):
+        """Return the names that are not in the negative cache (or whose entries expired)"""
+        keys = {name: self.key(name) for name in names}
+        query = {
+            "name": {"$in": list(set(keys.values()))},
+            # The TTL index only removes expired entries about once a minute, if it was created at all
+            "lastChecked": {"$gte": datetime.utcnow() - timedelta(seconds=self.ttl)},
+        }
+        found = {item["name"] for item in self.col.find(query, {"name": 1})}
+        return [name for name in names if keys[name] not in found]
+
+    def add(self, names):
+        now = datetime.utcnow()
+        updates = [
+            UpdateOne(
+                {"name": self.key(name)},
+                {"$set": {"firstName": " ".join(name.split()[:1]).lower(), "lastChecked": now}},
+                upsert=True,
+            )
+            for name in set(names)
+        ]
+        if updates:
+            try:
+                self.col.bulk_write(updates, ordered=False)
+            except BulkWriteError as e:
+                # Workers that upsert the same name at once can race on the unique index on names, and
+                # the name is in the cache either way
+                errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+                if errors:
+                    raise
+
 
 def get_genders(session, db_client, names):
     assert names, "Empty list passed to the get_genders function"
     # Define initial results mapping (every name's gender is unknown at the beginning)
-    unknowns = {name: "unknown" for name in names if not utils.name_length_is_invalid(name)}
     not_processed = {name: "unknown" for name in names if utils.name_length_is_invalid(name)}
-    results = unknowns
+    if SNAPSHOT is not None:
+        # Offline lookups, only in the snapshot of the caches
+        results, _ = SnapshotGenderizer(SNAPSHOT).run(names)
+        results.update(not_processed)
+        return results
+    results = {name: "unknown" for name in names}
+    # Only look up names in the database that aren't in this process's cache
+    NAME_CACHE.check_updates(db_client)
+    uncached = []
+    for name in names:
+        gender = NAME_CACHE.get(name) if name else None
+        if gender is None:
+            uncached.append(name)
+        else:
+            results[name] = gender
     cache_genderizer = CacheGenderizer(
         db_client, MANUAL_CACHE, GENDERAPI_CACHE, GENDERIZE_CACHE, FIRSTNAME_CACHE
     )
-    results, unknowns = cache_genderizer.run(names)
+    if uncached:
+        uncached_results, tiers = cache_genderizer.resolve(uncached)
+        for name, tier in tiers.items():
+            NAME_CACHE.put(name, uncached_results[name], tier)
+        results.update(uncached_results)
+    unknowns = cache_genderizer._update_unknowns(results)
+    if unknowns:
+        # Skip names that no gender service could find a gender for recently
+        negative_cache = NegativeCache(db_client, NEGATIVE_CACHE)
+        unknowns = {name: "unknown" for name in negative_cache.filter_known_unknowns(list(unknowns))}
     if unknowns:
         # Go to external services to try and obtain gender
-        service_genderizer = ServiceGenderizer(db_client, GENDERIZE_CACHE, GENDERAPI_CACHE)
+        service_genderizer = ServiceGenderizer(
+            db_client, GENDERIZE_CACHE, GENDERAPI_CACHE, get_service_client(session)
+        )
         results = service_genderizer.run(session, results, unknowns)
+        still_unknown = [name for name in unknowns if results.get(name, "unknown") == "unknown"]
+        negative_cache.add(service_genderizer.checked_by_all(still_unknown))
 
     # Add names that were not processed due to length
     results.update(not_processed)
     return results
 
 
+class GenderResolver:
+    """
+    Resolve the genders of the names in many articles (e.g., a chunk of articles) at once.
+    Names are first collected from all articles with add(), the genders of all distinct names are
+    then looked up with a single call to get_genders() in resolve(), and each article finally gets
+    the genders of its own names with genders().
+
+    If the single lookup fails, the names of each add() call (i.e., of each article) are looked up
+    on their own instead, so that a failed lookup only fails the articles whose names it was for:
+    genders() raises an error for names whose genders could not be resolved.
+    """
+
+    def __init__(self, session, db_client):
+        self.session = session
+        self.db_client = db_client
+        self.pending = {}
+        self.batches = []
+        self.results = {}
+        self.failed = set()
+        self.lookups = 0
+
+    def add(self, names):
+        self.lookups += len(names)
+        names = [name for name in names if name not in self.results]
+        self.pending.update(dict.fromkeys(names))
+        self.batches.append(names)
+
+    def resolve(self):
+        if not self.pending:
+            return
+        pending, batches = list(self.pending), self.batches
+        self.pending, self.batches = {}, []
+        try:
+            self.results.update(get_genders(self.session, self.db_client, pending))
+            logger.debug(f"Resolved genders of {len(pending)} distinct names for {self.lookups} names")
+        except Exception:
+            logger.exception(f"Failed to resolve genders of {len(pending)} names at once, resolving them per article")
+            for names in batches:
+                names = [name for name in names if name not in self.results]
+                if not names:
+                    continue
+                try:
+                    self.results.update(get_genders(self.session, self.db_client, names))
+                except Exception:
+                    logger.exception(f"Failed to resolve genders of names: {names}")
+                    self.failed.update(names)
+
+    def genders(self, names):
+        failed = [name for name in names if name in self.failed and name not in self.results]
+        if failed:
+            raise RuntimeError(f"Failed to resolve genders of names: {failed}")
+        return {name: self.results.get(name, "unknown") for name in names}
+
+
 if __name__ == "__main__":
     # Test gender prediction on a list of names (requires connection to MongoDB)
     names = [
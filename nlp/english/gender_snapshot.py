@@ -0,0 +1,138 @@
+"""
+Read-only on-disk snapshot of the MongoDB gender caches, for offline runs and evaluation that
+should not depend on (or wait for) the live database.
+
+The snapshot stores one table per cache lookup that CacheGenderizer does (e.g., the manual cache
+by full name, or the GenderAPI cache by first name). Each table is a sorted array of UTF-8 encoded
+keys, along with the gender of each key, and is searched with a binary search on the memory-mapped
+file. The file is opened once, before the pool of worker processes is forked, so its pages are
+shared by all workers.
+
+Export a snapshot of the caches with:
+    python3 gender_snapshot.py --out gender_cache.snapshot
+"""
+import argparse
+import importlib
+import json
+import mmap
+import struct
+
+MAGIC = b"GGTSNAP1"
+HEADER = struct.Struct("<8sI")
+# Collection (config key) and field that each table's keys are read from, in CacheGenderizer's priority order
+TABLES = [
+    ("manual", "MANUAL_CACHE", "name"),
+    ("genderapi_fullname", "GENDERAPI_CACHE", "q"),
+    ("genderize_firstname", "GENDERIZE_CACHE", "name"),
+    ("genderapi_firstname", "GENDERAPI_CACHE", "name"),
+    ("firstname", "FIRSTNAME_CACHE", "name"),
+]
+
+
+def write_snapshot(path, tables):
+    """Write a snapshot of tables given as {table name: {key: gender}}"""
+    genders = sorted({gender for table in tables.values() for gender in table.values()})
+    gender_ids = {gender: i for i, gender in enumerate(genders)}
+    sections = []
+    meta = {}
+    position = 0
+    for name, table in tables.items():
+        keys = sorted((key.encode("utf-8"), gender_ids[gender]) for key, gender in table.items())
+        offsets = [0]
+        for key, _ in keys:
+            offsets.append(offsets[-1] + len(key))
+        offsets_data = struct.pack(f"<{len(offsets)}I", *offsets)
+        genders_data = bytes(gender_id for _, gender_id in keys)
+        keys_data = b"".join(key for key, _ in keys)
+        meta[name] = {
+            "count": len(keys),
+            "offsets": position,
+            "genders": position + len(offsets_data),
+            "keys": position + len(offsets_data) + len(genders_data),
+        }
+        sections.extend([offsets_data, genders_data, keys_data])
+        position += len(offsets_data) + len(genders_data) + len(keys_data)
+        # Keep the offsets of every table aligned
+        padding = -position % 4
+        sections.append(b"\0" * padding)
+        position += padding
+    header = json.dumps({"genders": genders, "tables": meta}).encode("utf-8")
+    header += b" " * (-(HEADER.size + len(header)) % 4)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        for section in sections:
+            f.write(section)
+
+
+class GenderSnapshot:
+    """Look up the genders of keys in the tables of a snapshot written by write_snapshot"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_length = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a gender cache snapshot")
+        header = json.loads(self.mm[HEADER.size : HEADER.size + header_length].decode("utf-8"))
+        base = HEADER.size + header_length
+        self.genders = header["genders"]
+        view = memoryview(self.mm)
+        self.tables = {}
+        for name, meta in header["tables"].items():
+            count = meta["count"]
+            offsets = view[base + meta["offsets"] : base + meta["offsets"] + 4 * (count + 1)].cast("I")
+            self.tables[name] = (count, offsets, base + meta["genders"], base + meta["keys"])
+
+    def __len__(self):
+        return sum(count for count, _, _, _ in self.tables.values())
+
+    def get(self, table, key):
+        """Return the gender of a key in a table, or None if the key isn't in the table"""
+        count, offsets, genders_start, keys_start = self.tables[table]
+        key = key.encode("utf-8")
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.mm[keys_start + offsets[mid] : keys_start + offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < count and self.mm[keys_start + offsets[lo] : keys_start + offsets[lo + 1]] == key:
+            return self.genders[self.mm[genders_start + lo]]
+        return None
+
+    def find(self, table, keys):
+        """Return (key, gender) for each of the keys that is in a table"""
+        found = ((key, self.get(table, key)) for key in keys)
+        return [(key, gender) for key, gender in found if gender is not None]
+
+
+def export_snapshot(db_client, gender_config, path):
+    """Export the gender caches in MongoDB to a snapshot file"""
+    tables = {}
+    for name, cache, field in TABLES:
+        collection = db_client["genderCache"][gender_config[cache]]
+        table = {}
+        # Like the cache lookups, later entries for the same key take precedence over earlier ones
+        for item in collection.find({field: {"$type": "string"}, "gender": {"$exists": True}}, {field: 1, "gender": 1}):
+            table[item[field]] = str(item["gender"])
+        tables[name] = table
+    write_snapshot(path, tables)
+    return {name: len(table) for name, table in tables.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the MongoDB gender caches to a read-only snapshot file")
+    parser.add_argument("--config_file", type=str, default="config", help="Name of config file")
+    parser.add_argument("--out", type=str, default="gender_cache.snapshot", help="Path to write the snapshot to")
+    args = vars(parser.parse_args())
+
+    import utils
+
+    config = importlib.import_module(args["config_file"]).config
+    db_client = utils.init_client(config["MONGO_ARGS"])
+    counts = export_snapshot(db_client, config["GENDER_RECOGNITION"], args["out"])
+    for name, count in counts.items():
+        print(f"{name}: {count} names")
+    print(f"Wrote snapshot of the gender caches to {args['out']}")
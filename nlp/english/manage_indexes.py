@@ -0,0 +1,199 @@
+"""
+This script creates the indexes that the NLP pipeline's queries rely on, in the gender cache
+collections and in the collection of articles, and checks how MongoDB runs these queries.
+
+Each query is run with `explain()`, and queries whose winning plan scans a whole collection
+(a `COLLSCAN` stage) are reported, since an unindexed lookup on one of the large gender caches
+slows down every chunk of articles without any error.
+
+Before a unique index is created, documents that share its keys (e.g., names that concurrent workers
+added to the unknown names cache before the index existed) are removed, except for the latest one.
+
+Create the missing indexes and check the queries with:
+    python3 manage_indexes.py --db mediaTracker --readcol media
+"""
+import argparse
+import importlib
+from datetime import datetime, timedelta
+
+import utils
+
+# Names that the gender cache lookups are explained with
+SAMPLE_NAMES = ["justin trudeau", "chrystia freeland"]
+SAMPLE_FIRST_NAMES = ["justin", "chrystia"]
+# Additional filters of the quote extractor and the entity gender annotator (see their arguments),
+# on top of the outlets and date range in utils.prepare_query
+PIPELINE_FILTERS = {
+    "quote_extractor": [
+        {"quotes": {"$exists": False}},
+        {"lastModifier": "mediaCollectors"},
+    ],
+    "entity_gender_annotator": [
+        {"quotes": {"$exists": True}},
+        {"lastModifier": "quote_extractor"},
+        {"quotesUpdated": {"$exists": False}},
+    ],
+    "entity_gender_annotator --force_update": [{"quotes": {"$exists": True}}],
+}
+
+
+def required_indexes(gender_config, db_name, read_col):
+    """Return the (database, collection, keys, options) of every index that the pipeline needs"""
+    return [
+        # Cache lookups of CacheGenderizer, and upserts of the gender services' results
+        ("genderCache", gender_config["MANUAL_CACHE"], [("name", 1)], {}),
+        ("genderCache", gender_config["GENDERAPI_CACHE"], [("q", 1)], {}),
+        ("genderCache", gender_config["GENDERAPI_CACHE"], [("name", 1)], {}),
+        ("genderCache", gender_config["GENDERIZE_CACHE"], [("name", 1)], {}),
+        ("genderCache", gender_config["FIRSTNAME_CACHE"], [("name", 1)], {}),
+        # Names are removed from the unknown names cache once they are NEGATIVE_CACHE_TTL seconds old
+        ("genderCache", gender_config["NEGATIVE_CACHE"], [("lastChecked", 1)], {"expireAfterSeconds": gender_config["NEGATIVE_CACHE_TTL"]}),
+        ("genderCache", gender_config["NEGATIVE_CACHE"], [("firstName", 1)], {}),
+        ("genderCache", gender_config["NEGATIVE_CACHE"], [("name", 1)], {"unique": True}),
+        # Articles by outlet and date (--force_update runs and the dashboards), and new articles for
+        # each stage of the pipeline by their last modifier
+        (db_name, read_col, [("outlet", 1), ("publishedAt", 1)], {}),
+        (db_name, read_col, [("lastModifier", 1), ("outlet", 1), ("publishedAt", 1)], {}),
+    ]
+
+
+def existing_indexes(db_client, db_name, col_name):
+    """Return the information of each existing index of a collection, by its keys"""
+    index_information = db_client[db_name][col_name].index_information()
+    return {
+        tuple((field, direction) for field, direction in index["key"]): index for index in index_information.values()
+    }
+
+
+def missing_indexes(db_client, indexes):
+    """Return the indexes whose keys are not yet indexed in their collection"""
+    existing = {}
+    missing = []
+    for db_name, col_name, keys, options in indexes:
+        if (db_name, col_name) not in existing:
+            existing[(db_name, col_name)] = existing_indexes(db_client, db_name, col_name)
+        if tuple(keys) not in existing[(db_name, col_name)]:
+            missing.append((db_name, col_name, keys, options))
+    return missing
+
+
+def duplicate_keys(collection, keys):
+    """Return the IDs of the documents of each group of documents that share the same keys, by their keys"""
+    pipeline = [
+        {"$group": {"_id": {field: f"${field}" for field, _ in keys}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    return {tuple(group["_id"].values()): group["ids"] for group in collection.aggregate(pipeline, allowDiskUse=True)}
+
+
+def remove_duplicates(collection, keys):
+    """Remove all but the most recently created document (by ObjectId) of each group of documents that share
+    the same keys, so that a unique index can be created on them. Return the number of removed documents.
+    """
+    removed = 0
+    for ids in duplicate_keys(collection, keys).values():
+        removed += collection.delete_many({"_id": {"$in": sorted(ids)[:-1]}}).deleted_count
+    return removed
+
+
+def ensure_indexes(db_client, indexes):
+    """Create the missing indexes, update the TTL of existing TTL indexes, and return the created indexes"""
+    missing = missing_indexes(db_client, indexes)
+    for db_name, col_name, keys, options in missing:
+        if options.get("unique"):
+            # Documents that were upserted at once before the index existed can share the same keys
+            removed = remove_duplicates(db_client[db_name][col_name], keys)
+            if removed:
+                print(f"Removed {removed} documents with duplicate {keys} from {db_name}.{col_name}")
+        print(f"Creating index {keys} on {db_name}.{col_name}...")
+        db_client[db_name][col_name].create_index(keys, **options)
+    for db_name, col_name, keys, options in indexes:
+        ttl = options.get("expireAfterSeconds")
+        if ttl is None:
+            continue
+        index = existing_indexes(db_client, db_name, col_name).get(tuple(keys))
+        if index is not None and index.get("expireAfterSeconds") != ttl:
+            # Creating the index again with a different TTL would fail, so change the TTL of the index instead
+            print(f"Updating the TTL of index {keys} on {db_name}.{col_name} to {ttl} seconds...")
+            db_client[db_name].command(
+                "collMod", col_name, index={"keyPattern": dict(keys), "expireAfterSeconds": ttl}
+            )
+    return missing
+
+
+def pipeline_queries(gender_config, db_name, read_col, days=7):
+    """Return the (description, database, collection, query, sort) of the queries that the pipeline runs"""
+    unexpired = datetime.utcnow() - timedelta(seconds=gender_config["NEGATIVE_CACHE_TTL"])
+    queries = [
+        ("manual cache lookup", "genderCache", gender_config["MANUAL_CACHE"], {"name": {"$in": SAMPLE_NAMES}}, None),
+        ("Gender-API full name lookup", "genderCache", gender_config["GENDERAPI_CACHE"], {"q": {"$in": SAMPLE_NAMES}}, None),
+        ("Gender-API first name lookup", "genderCache", gender_config["GENDERAPI_CACHE"], {"name": {"$in": SAMPLE_FIRST_NAMES}}, None),
+        ("Genderize first name lookup", "genderCache", gender_config["GENDERIZE_CACHE"], {"name": {"$in": SAMPLE_FIRST_NAMES}}, None),
+        ("first name cache lookup", "genderCache", gender_config["FIRSTNAME_CACHE"], {"name": {"$in": SAMPLE_FIRST_NAMES}}, None),
+        ("unknown name lookup", "genderCache", gender_config["NEGATIVE_CACHE"], {"name": {"$in": SAMPLE_NAMES}, "lastChecked": {"$gte": unexpired}}, None),
+    ]
+    date_filters = [{"publishedAt": {"$gte": datetime.utcnow() - timedelta(days=days)}}]
+    for stage, other_filters in PIPELINE_FILTERS.items():
+        filters = {"doc_id_list": None, "outlets": None, "date_filters": date_filters, "other_filters": other_filters}
+        # Article IDs are streamed from a cursor sorted by ID (see utils.stream_ids)
+        queries.append((f"{stage} articles", db_name, read_col, utils.prepare_query(filters), [("_id", 1)]))
+    return queries
+
+
+def plan_stages(plan):
+    """Return the names of all stages in a query plan, including the plans on each shard"""
+    stages = [plan["stage"]] if "stage" in plan else []
+    children = [plan[key] for key in ["inputStage", "queryPlan", "winningPlan"] if key in plan]
+    children += plan.get("inputStages", []) + plan.get("shards", [])
+    for child in children:
+        stages += plan_stages(child)
+    return stages
+
+
+def explain_queries(db_client, queries):
+    """Explain each query, and return the description and winning plan's stages of the queries that scan a collection"""
+    collection_scans = []
+    for description, db_name, col_name, query, sort in queries:
+        cursor = db_client[db_name][col_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = cursor.explain()
+        stages = plan_stages(explanation["queryPlanner"]["winningPlan"])
+        print(f"{description} ({db_name}.{col_name}): {' <- '.join(stages)}")
+        if "COLLSCAN" in stages:
+            collection_scans.append((description, stages))
+    return collection_scans
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the indexes that the NLP pipeline relies on, and report queries that scan whole collections")
+    parser.add_argument("--config_file", type=str, default="config", help="Name of config file")
+    parser.add_argument("--db", type=str, default="mediaTracker", help="Database name")
+    parser.add_argument("--readcol", type=str, default="media", help="Collection name of the articles")
+    parser.add_argument("--check_only", action="store_true", help="Only report missing indexes, without creating them")
+    args = vars(parser.parse_args())
+
+    config = importlib.import_module(args["config_file"]).config
+    GENDER_CONFIG = config["GENDER_RECOGNITION"]
+    db_client = utils.init_client(config["MONGO_ARGS"])
+
+    indexes = required_indexes(GENDER_CONFIG, args["db"], args["readcol"])
+    if args["check_only"]:
+        for db_name, col_name, keys, options in missing_indexes(db_client, indexes):
+            print(f"Missing index {keys} on {db_name}.{col_name}")
+            if options.get("unique"):
+                duplicates = duplicate_keys(db_client[db_name][col_name], keys)
+                if duplicates:
+                    print(
+                        f"WARNING: {len(duplicates)} {keys} values are shared by several documents in "
+                        f"{db_name}.{col_name}, which will be removed (except the latest) to create the index"
+                    )
+    else:
+        created = ensure_indexes(db_client, indexes)
+        print(f"Created {len(created)} missing indexes.")
+
+    collection_scans = explain_queries(db_client, pipeline_queries(GENDER_CONFIG, args["db"], args["readcol"]))
+    for description, _ in collection_scans:
+        print(f"WARNING: The {description} query scans the whole collection")
+    if not collection_scans:
+        print("No pipeline queries scan a whole collection.")
@@ -38,9 +38,14 @@ def chunker(iterable, chunksize):
         yield iterable[i:i + chunksize]
 
 
+def init_worker():
+    """Open one MongoDB client per worker process and reuse it for every chunk"""
+    global db_client
+    db_client = utils.init_client(MONGO_ARGS)
+
+
 def parse_chunks(chunk):
     """Pass through a chunk of document IDs and update fields"""
-    db_client = utils.init_client(MONGO_ARGS)
     existing_collection = db_client[DB_NAME][EXISTING_COL]
     new_collection = db_client[DB_NAME][NEW_COL]
     for idx in chunk:
@@ -54,10 +59,10 @@ def run_pool(poolsize, chunksize):
     new_col = db_client[DB_NAME][NEW_COL]
     new_old_ids = list(new_col.find({}, {'_id': 1, 'currentId': 1}))
     print('Obtained ID list of length {}.'.format(len(new_old_ids)))
-    # Process quotes using a pool of executors 
-    pool = Pool(processes=poolsize)
-    pool.map(parse_chunks, chunker(new_old_ids, chunksize=chunksize))
-    pool.close()
+    # Process quotes using a pool of persistent workers, handing out chunks as workers become free
+    with Pool(processes=poolsize, initializer=init_worker) as pool:
+        for _ in pool.imap_unordered(parse_chunks, chunker(new_old_ids, chunksize=chunksize)):
+            pass
 
 
 if __name__ == '__main__':
@@ -1,13 +1,23 @@
 import argparse
+import bisect
 import importlib
+import json
 import logging
+import os
 import traceback
 from bson import ObjectId
 from statistics import mean
 from datetime import datetime, timedelta
-from multiprocessing import Pool, cpu_count
+from functools import partial
+from itertools import islice
+from multiprocessing import Barrier, Pool, cpu_count
 
+import numpy
 import spacy
+from spacy.attrs import ORTH, POS
+from spacy.matcher import Matcher
+from spacy.symbols import VERB
+from doc_cache import DocCache, prune_cache
 import utils
 
 logger = utils.create_logger(
@@ -19,55 +29,194 @@ logger = utils.create_logger(
 
 
 def chunker(iterable, chunksize):
-    """Yield a smaller chunk of a large iterable"""
-    for i in range(0, len(iterable), chunksize):
-        yield iterable[i : i + chunksize]
+    """Yield a smaller chunk of a large iterable (which can also be a lazily-evaluated stream)"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunksize))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunksize))
+
+
+def init_worker(spacy_model, barrier):
+    """Load the spaCy model, quote extractor, MongoDB client and writer once per worker process,
+    so that they can be reused for every chunk the worker processes.
+    """
+    global nlp, extractor, db_client, writer, flush_barrier
+    nlp = spacy.load(spacy_model)
+    if DOC_CACHE:
+        # Reuse parses of previously processed article bodies from the on-disk cache
+        nlp = DocCache(DOC_CACHE, nlp)
+    extractor = QuoteExtractor({**config, "spacy_lang": nlp})
+    # Measurements are aggregated per worker, and returned to the main process with each chunk
+    extractor.profiler = utils.StageProfiler(enabled=PROFILE, keep_docs=bool(PROFILE_OUT))
+    db_client = utils.init_client(MONGO_ARGS)
+    # Writes are buffered across chunks, and each chunk is committed once all its writes are written
+    writer = utils.BulkWriter(db_client[DB_NAME][READ_COL], WRITE_BATCH_SIZE, WRITE_INTERVAL, logger)
+    flush_barrier = barrier
+    logger.info(f"Worker {os.getpid()} loaded spaCy language model: {spacy_model}")
 
 
 def process_chunks(chunk):
     """Pass through a chunk of document IDs and extract quotes"""
-    db_client = utils.init_client(MONGO_ARGS)
     collection = db_client[DB_NAME][READ_COL]
+    num_failed = 0
     for idx in chunk:
         mongo_doc = collection.find_one({"_id": idx})
-        extractor.run(collection, mongo_doc)
+        if mongo_doc is None:
+            logger.error(f"Document '{idx}' not found.")
+            num_failed += 1
+        elif not extractor.run(writer, mongo_doc):
+            num_failed += 1
+    # Chunks with failed documents are not committed, so that they are processed again with --resume
+    writer.mark(chunk[-1], num_failed)
+    return chunk, writer.pop_committed(), extractor.profiler.pop_stats()
+
+
+def process_chunks_batched(chunk):
+    """Fetch a chunk of documents with one query and parse their bodies in batches with nlp.pipe"""
+    collection = db_client[DB_NAME][READ_COL]
+    mongo_docs = list(collection.find({"_id": {"$in": chunk}}, {"body": 1}))
+    num_failed = len(chunk) - len(mongo_docs)
+    if num_failed:
+        logger.error(f"Found only {len(mongo_docs)} of {len(chunk)} documents in chunk.")
+    # Long documents are flagged without parsing, so they are kept out of the batches sent to spaCy
+    to_parse = []
+    for mongo_doc in mongo_docs:
+        if extractor.is_too_long(mongo_doc):
+            num_failed += not extractor.run(writer, mongo_doc)
+        else:
+            to_parse.append(mongo_doc)
+    texts = (utils.preprocess_text(mongo_doc["body"]) for mongo_doc in to_parse)
+    spacy_docs = extractor.profiler.time_iter("parse", nlp.pipe(texts, batch_size=BATCH_SIZE))
+    for mongo_doc, spacy_doc in zip(to_parse, spacy_docs):
+        num_failed += not extractor.run(writer, mongo_doc, spacy_doc=spacy_doc)
+    # Chunks with failed documents are not committed, so that they are processed again with --resume
+    writer.mark(chunk[-1], num_failed)
+    return chunk, writer.pop_committed(), extractor.profiler.pop_stats()
+
+
+def flush_worker(_):
+    """Flush the writes that a worker still buffers at the end of a run, and return the chunks this commits.
+    Each worker waits for all other workers first, so that every worker runs exactly one of these tasks.
+    """
+    flush_barrier.wait()
+    writer.close()
+    return writer.pop_committed()
+
+
+def write_profile(profiler, profile_file, stats):
+    """Merge the measurements returned by a worker, and write those of each document as JSON lines"""
+    if stats is None:
+        return
+    profiler.merge(stats)
+    if profile_file:
+        for record in stats["docs"]:
+            profile_file.write(json.dumps(record) + "\n")
 
 
 def run_pool(poolsize, chunksize):
     """Concurrently perform quote extraction based on a filter query"""
-    # Find ALL ids in the database within the query bounds (one-time only)
+    # Stream the ids of all documents within the query bounds from a sorted cursor, so that
+    # processing starts right away and memory use does not grow with the size of the backlog
     client = utils.init_client(MONGO_ARGS)
     id_collection = client[DB_NAME][READ_COL]
     query = utils.prepare_query(filters)
-    document_ids = id_collection.find(query).distinct("_id")
-    logger.info(f"Obtained ID list for {len(document_ids)} articles.")
-
-    # Check for doc limit
-    if DOC_LIMIT > 0:
-        document_ids = document_ids[:DOC_LIMIT]
-    logger.info(f"Processing {len(document_ids)} articles...")
 
-    # Process quotes using a pool of executors
-    pool = Pool(processes=poolsize)
-    pool.map(process_chunks, chunker(document_ids, chunksize=chunksize))
-    pool.close()
+    # Record progress in a checkpoint, and optionally resume from the last committed ID of an interrupted run
+    # (chunks are only handed out in ID order, which checkpoints rely on, when they are not scheduled by length)
+    checkpoint = None
+    if UPDATE_DB and SCHEDULE == "ids":
+        checkpoint = utils.RunCheckpoint(client[DB_NAME][CHECKPOINT_COL], "quote_extractor", RUN_PARAMS)
+        last_id = checkpoint.last_committed_id() if RESUME else None
+        if last_id is not None:
+            logger.info(f"Resuming interrupted run after document ID {last_id}")
+            query = {"$and": [query, {"_id": {"$gt": last_id}}]}
+        elif RESUME:
+            logger.warning("No interrupted run found with the same parameters, starting from the beginning.")
+        checkpoint.start(last_id)
+
+    scheduler = None
+    if SCHEDULE == "length":
+        # Balance the work in each chunk by the length of the articles, and hand out the longest chunks first
+        id_lengths = utils.fetch_body_lengths(id_collection, query, limit=DOC_LIMIT)
+        scheduler = utils.LengthScheduler(id_lengths, chunksize, logger=logger)
+        chunks = scheduler.chunks()
+        logger.info(f"Scheduled {len(id_lengths)} articles in {len(scheduler.work)} chunks by length.")
+    else:
+        document_ids = utils.stream_ids(id_collection, query, limit=DOC_LIMIT)
+        logger.info("Streaming article IDs from the database...")
+        chunks = chunker(document_ids, chunksize=chunksize)
+
+    # Process quotes using a pool of persistent workers, handing out chunks as workers become free
+    chunk_func = partial(utils.run_timed, process_chunks_batched if BATCHED else process_chunks)
+    # Only a few chunks are queued for the workers at any time (bounded queue)
+    if checkpoint:
+        chunks = checkpoint.track(chunks)
+    num_processed = 0
+    profiler = utils.StageProfiler(enabled=PROFILE)
+    profile_file = open(PROFILE_OUT, "a") if PROFILE_OUT else None
+    barrier = Barrier(poolsize)
+    try:
+        with Pool(processes=poolsize, initializer=init_worker, initargs=(SPACY_MODEL, barrier)) as pool:
+            for (chunk, committed, stats), seconds in utils.imap_bounded(
+                pool, chunk_func, chunks, max_pending=2 * poolsize
+            ):
+                num_processed += len(chunk)
+                write_profile(profiler, profile_file, stats)
+                if scheduler:
+                    scheduler.report(chunk, seconds)
+                if checkpoint:
+                    for last_id in committed:
+                        checkpoint.mark_done(last_id)
+            # Flush the writes that the workers still buffer
+            for committed in pool.map(flush_worker, range(poolsize), chunksize=1):
+                if checkpoint:
+                    for last_id in committed:
+                        checkpoint.mark_done(last_id)
+    finally:
+        if profile_file:
+            profile_file.close()
+    if checkpoint and not checkpoint.finish():
+        logger.warning("Some chunks were not written due to errors. Rerun with --resume to process them again.")
+    logger.info(f"Processed {num_processed} articles.")
+    if PROFILE:
+        logger.info("Profile summary (times in ms, doc_length in characters):")
+        for line in profiler.summary():
+            logger.info(line)
 
 
 class QuoteExtractor:
     def __init__(self, config) -> None:
         self.config = config
         self.nlp = config["spacy_lang"]
-        self.quote_verbs = [
-            verb for verb in open(config["NLP"]["QUOTE_VERBS"]).read().split()
-        ]
-
-    def get_pretty_index(self, key):
-        """Format span/token indexes like (123,127)"""
-        frmt = "({0},{1})"
+        with open(config["NLP"]["QUOTE_VERBS"]) as f:
+            self.quote_verbs = frozenset(f.read().split())
+        self._setup_matcher()
+        # Disabled unless replaced with an enabled profiler
+        self.profiler = utils.StageProfiler(enabled=False)
+        # Hashes of the token texts that the heuristic quote scanner looks for
+        strings = self.nlp.vocab.strings
+        self.quote_mark_orth = numpy.uint64(strings.add('"'))
+        self.verb_stop_orths = numpy.array([strings.add(text) for text in (".", '"')], dtype="uint64")
+        self.non_quote_verb_orths = numpy.array([strings.add(text) for text in ("is", "was", "be")], dtype="uint64")
+
+    def _setup_matcher(self):
+        """Set up a spaCy Matcher that finds the candidate tokens for syntactic quotes"""
+        self.matcher = Matcher(self.nlp.vocab)
+        # Heads of clausal complements. `word.dep_ in ("ccomp")` was originally a substring test, which
+        # also matched coordinating conjunctions ("cc"), so these are kept as candidates as well.
+        self.ccomp_match_id = self.nlp.vocab.strings.add("CCOMP")
+        self.matcher.add("CCOMP", None, [{"DEP": {"IN": ["ccomp", "cc"]}}])
+        # "to" as the preposition in "according to"
+        self.according_to_match_id = self.nlp.vocab.strings.add("ACCORDING_TO")
+        self.matcher.add("ACCORDING_TO", None, [{"DEP": "prep", "ORTH": "to"}])
+
+    def get_char_span(self, key):
+        """Get the (start, end) character offsets of a span/token"""
         if isinstance(key, spacy.tokens.span.Span):
-            return frmt.format(key.start_char, key.end_char)
+            return key.start_char, key.end_char
         elif isinstance(key, spacy.tokens.token.Token):
-            return frmt.format(key.idx, key.idx + len(key.text))
+            return key.idx, key.idx + len(key.text)
 
     def prettify(self, key):
         """Format span/token like 'Book (7,11)'"""
@@ -77,12 +226,12 @@ class QuoteExtractor:
         elif isinstance(key, spacy.tokens.token.Token):
             return frmt.format(str(key), key.idx, key.idx + len(key.text))
 
-    def is_quote_in_sent(self, quote_set, sent_set):
-        """Check if a detected quote in an specific sentence."""
-        quote_len = len(quote_set)
-        sent_len = len(sent_set)
+    def is_quote_in_sent(self, quote_span, sent_span):
+        """Check if a detected quote in an specific sentence, given their (start, end) character spans."""
+        quote_len = max(0, quote_span[1] - quote_span[0])
+        sent_len = max(0, sent_span[1] - sent_span[0])
         threshold = min(quote_len, sent_len) / 2
-        if len(quote_set.intersection(sent_set)) >= threshold:
+        if utils.span_overlap(quote_span, sent_span) >= threshold:
             return True
         else:
             return False
@@ -119,11 +268,11 @@ class QuoteExtractor:
             quote_endchar = sent.end_char
             quote_obj = {
                 "speaker": "",
-                "speaker_index": "",
+                **utils.span_fields("speaker"),
                 "quote": str(sent),
-                "quote_index": f"({quote_startchar},{quote_endchar})",
+                **utils.span_fields("quote", (quote_startchar, quote_endchar)),
                 "verb": "",
-                "verb_index": "",
+                **utils.span_fields("verb"),
                 "quote_token_count": quote_token_count,
                 "quote_type": "QCQ",
                 "is_floating_quote": True,
@@ -156,11 +305,11 @@ class QuoteExtractor:
                 quote_endchar = next_sent.end_char
                 quote_obj = {
                     "speaker": "",
-                    "speaker_index": "",
+                    **utils.span_fields("speaker"),
                     "quote": float_quote,
-                    "quote_index": f"({quote_startchar},{quote_endchar})",
+                    **utils.span_fields("quote", (quote_startchar, quote_endchar)),
                     "verb": "",
-                    "verb_index": "",
+                    **utils.span_fields("verb"),
                     "quote_token_count": quote_token_count,
                     "quote_type": "QCQ",
                     "is_floating_quote": True,
@@ -170,41 +319,65 @@ class QuoteExtractor:
         # It's better to start again from the next sentence.
         return 1, False, None
 
-    def is_qcqsv_or_qcqvs_csv(self, sent, quote_list):
-        """Return whether the given sentence is in a QCQSV, QCQVS or CSV quote."""
-        sent_start = sent.start_char
-        sent_end = sent.end_char
-        sent_set = set(range(sent_start, sent_end))
+    def index_qcqsv_or_qcqvs_csv(self, doc_sents, quote_list):
+        """
+        Find, for each sentence, the first QCQSV, QCQVS or CSV quote in the given list that the sentence is in
+          :params lst doc_sents: List of SpaCy sentence spans of the whole news file, in order
+          :params lst quote_list: List of quote objects
+          :return: List of the quote object (or None) found for each sentence
+        """
+        sent_quotes = [None] * len(doc_sents)
+        sent_starts = [sent.start_char for sent in doc_sents]
+        sent_ends = [sent.end_char for sent in doc_sents]
+        # Empty sentences are in any quote, so they are all assigned the first quote of a valid type
+        empty_sents = [i for i in range(len(doc_sents)) if sent_ends[i] <= sent_starts[i]]
+        unassigned = len(doc_sents)
         for q in quote_list:
-            quote_index = (q["quote_index"][1:-1]).split(",")
-            quote_index = [int(x) for x in quote_index]
-            # Check if quote and sentence have overlap. Because the quote may contain mutiple sentences(?),
-            # we do not check if the quote contains the sentence of vice versa
-            quote_set = set(range(quote_index[0], quote_index[1]))
-            if self.is_quote_in_sent(quote_set, sent_set):
-                quote_type = q["quote_type"]
-                if quote_type in ["QCQSV", "QCQVS", "CSV"]:
-                    return True, q
-        return False, None
-
-    def get_closest_verb(self, doc, sent, doc_len, threshold=5):
+            if unassigned == 0:
+                break
+            if q["quote_type"] not in ("QCQSV", "QCQVS", "CSV"):
+                continue
+            quote_index = utils.get_span(q, "quote")
+            if quote_index[1] <= quote_index[0]:
+                # Every sentence is in an empty quote
+                candidates = range(len(doc_sents))
+            else:
+                # Sentences are sorted and don't overlap, so only those between these bounds can overlap the quote.
+                # Because the quote may contain mutiple sentences(?), we do not check if the quote contains the
+                # sentence of vice versa
+                lo = bisect.bisect_right(sent_ends, quote_index[0])
+                hi = bisect.bisect_left(sent_starts, quote_index[1])
+                candidates = empty_sents + list(range(lo, hi))
+                empty_sents = []
+            for i in candidates:
+                if sent_quotes[i] is None and self.is_quote_in_sent(quote_index, (sent_starts[i], sent_ends[i])):
+                    sent_quotes[i] = q
+                    unassigned -= 1
+        return sent_quotes
+
+    def get_closest_verb(self, is_verb, is_stop, sent_start, sent_end, doc_len, threshold=5):
         """
         Get the closest verb associated with a quote
-          :params Doc doc: SpaCy Doc object of the whole news file
-          :params Span sent: SpaCy Span object that contains the quote
+          :params list is_verb: Whether each token of the doc is a verb (other than "is", "was" or "be")
+          :params list is_stop: Whether each token of the doc is a "." or '"' character
+          :params int sent_start: Index of the first token of the quote
+          :params int sent_end: Index of the token after the end of the quote
           :params int doc_len: Length of the entire SpaCy Doc
           :params int threshold: Threshold for window to search in
-          :return: The selected verb(spaCy token object) or None
+          :return: The token index of the selected verb or None
         """
-        for i in range(sent.start - 1, sent.start - threshold, -1):
-            if doc[i].pos_ == "VERB" and doc[i].text not in ("is", "was", "be"):
-                return doc[i]
-            elif doc[i].text in [".", '"']:
+        for i in range(sent_start - 1, sent_start - threshold, -1):
+            if i < -doc_len:
+                # Like the padding tokens of a spaCy Doc, positions before a (very short) doc are never verbs
+                break
+            if is_verb[i]:
+                return i
+            elif is_stop[i]:
                 break
-        for i in range(sent.end, min(sent.end + threshold, doc_len), 1):
-            if doc[i].pos_ == "VERB" and doc[i].text not in ("is", "was", "be"):
-                return doc[i]
-            elif doc[i].text in [".", '"']:
+        for i in range(sent_end, min(sent_end + threshold, doc_len), 1):
+            if is_verb[i]:
+                return i
+            elif is_stop[i]:
                 break
         return None
 
@@ -225,31 +398,24 @@ class QuoteExtractor:
           :params lst quote_list: List of quote objects which contain many auxillary attributes
           :return: List of de-duplicated quote objects
         """
-        quote_span_list = []
-        new_quote_span_list = []
-        remove_quotes = []
+        # Quotes are kept first-come: a quote is removed if it has fewer than 4 words, or if it overlaps
+        # a quote that was kept before it. Kept quotes never overlap each other, so their spans are stored
+        # sorted by start offset, and only the kept quote starting just before a quote's end can overlap it.
+        kept_starts = []
+        kept_ends = []
+        final_quote_list = []
         for quote in quote_list:
-            span = list(map(int, quote["quote_index"][1:-1].split(",")))
-            quote_span_list.append([span[0], span[1]])
-        for quote_idx, (start, end) in enumerate(quote_span_list):
-            quote_range = range(start, end)
-            not_duplicate = True
-            if len(quote_list[quote_idx]["quote"].split(" ")) < 4:
-                remove_quotes.append(quote_idx)
+            if len(quote["quote"].split(" ")) < 4:
                 continue
-            for ref_quote_idx, (ref_start, ref_end) in enumerate(new_quote_span_list):
-                ref_quote_range = range(ref_start, ref_end)
-                if len(set(quote_range).intersection(ref_quote_range)) > 0:
-                    not_duplicate = False
-                    remove_quotes.append(quote_idx)
-                    break
-            if not_duplicate:
-                new_quote_span_list.append([start, end])
-
-        final_quote_list = []
-        for idx, quote in enumerate(quote_list):
-            if idx not in remove_quotes:
-                final_quote_list.append(quote)
+            start, end = utils.get_span(quote, "quote")
+            if end > start:
+                pos = bisect.bisect_left(kept_starts, end)
+                if pos > 0 and kept_ends[pos - 1] > start:
+                    continue
+                kept_starts.insert(pos, start)
+                kept_ends.insert(pos, end)
+            # Empty spans can't overlap any quote, so they are always kept
+            final_quote_list.append(quote)
         return final_quote_list
 
     def get_quote_type(self, doc, quote, verb, speaker, subtree_span):
@@ -302,21 +468,22 @@ class QuoteExtractor:
 
     def extract_syntactic_quotes(self, doc):
         quote_list = []
-        for word in doc:
-            if word.dep_ in ("ccomp"):
+        # Candidate tokens are processed in document order
+        for match_id, start, _ in sorted(self.matcher(doc), key=lambda match: match[1]):
+            word = doc[start]
+            if match_id == self.ccomp_match_id:
                 if (word.right_edge.i + 1) < len(doc):
                     subtree_span = doc[word.left_edge.i : word.right_edge.i + 1]
                     sent = subtree_span
                     verb = subtree_span.root.head
+                    if verb.text.lower() not in self.quote_verbs:
+                        continue
                     nodes_to_look_for_nsubj = [
                         x for x in subtree_span.root.head.children
                     ] + [x for x in subtree_span.root.head.head.children]
                     # for child in subtree_span.root.head.children:
                     for child in nodes_to_look_for_nsubj:
-                        if (
-                            child.dep_ == "nsubj"
-                            and verb.text.lower() in self.quote_verbs
-                        ):
+                        if child.dep_ == "nsubj":
                             if child.right_edge.i + 1 < len(doc):
                                 subj_subtree_span = doc[
                                     child.left_edge.i : child.right_edge.i + 1
@@ -343,20 +510,20 @@ class QuoteExtractor:
                                     ):
                                         quote_obj = {
                                             "speaker": str(speaker),
-                                            "speaker_index": self.get_pretty_index(
-                                                speaker
+                                            **utils.span_fields(
+                                                "speaker", self.get_char_span(speaker)
                                             ),
                                             "quote": str(sent),
-                                            "quote_index": self.get_pretty_index(sent),
+                                            **utils.span_fields("quote", self.get_char_span(sent)),
                                             "verb": str(verb),
-                                            "verb_index": self.get_pretty_index(verb),
+                                            **utils.span_fields("verb", self.get_char_span(verb)),
                                             "quote_token_count": len(sent),
                                             "quote_type": quote_type,
                                             "is_floating_quote": False,
                                         }
                                         quote_list.append(quote_obj)
                                     break
-            elif word.dep_ in ("prep"):
+            elif match_id == self.according_to_match_id:
                 expression = doc[word.head.left_edge.i : word.i + 1]
                 if expression.text in ("according to", "According to"):
                     accnode = word.head
@@ -374,11 +541,11 @@ class QuoteExtractor:
                     # TODO: How to validate these quotes? what is the quote type?
                     quote_obj = {
                         "speaker": str(speaker),
-                        "speaker_index": self.get_pretty_index(speaker),
+                        **utils.span_fields("speaker", self.get_char_span(speaker)),
                         "quote": str(sent),
-                        "quote_index": self.get_pretty_index(sent),
+                        **utils.span_fields("quote", self.get_char_span(sent)),
                         "verb": "according to",
-                        "verb_index": self.get_pretty_index(expression),
+                        **utils.span_fields("verb", self.get_char_span(expression)),
                         "quote_token_count": len(sent),
                         "quote_type": "AccordingTo",
                         "is_floating_quote": False,
@@ -390,16 +557,17 @@ class QuoteExtractor:
         floating_quotes = []
         doc_sents = [x for x in doc.sents]
         if len(doc_sents) > 0:
-            last_sent = doc_sents[0]
+            # Look up the QCQSV, QCQVS or CSV quote (if any) of every sentence at once
+            sent_quotes = self.index_qcqsv_or_qcqvs_csv(doc_sents, syntactic_quotes)
+            last_sent_idx = 0
             i = 1
             while i < len(doc_sents):
                 sent = doc_sents[i]
+                sent_idx = i
                 # Check if there is a QCQSV or QCQVS quote before this sentence.
                 # The speaker and verb of this quote (if exists) will be used for possible floating quote
-                (
-                    sent_is_after_qcqsv_or_qcqvs_csv,
-                    last_quote,
-                ) = self.is_qcqsv_or_qcqvs_csv(last_sent, syntactic_quotes)
+                last_quote = sent_quotes[last_sent_idx]
+                sent_is_after_qcqsv_or_qcqvs_csv = last_quote is not None
 
                 if sent_is_after_qcqsv_or_qcqvs_csv:
                     # Search for sentence(s) in double quotes
@@ -417,10 +585,12 @@ class QuoteExtractor:
                 i += sents_processed
                 if sent_is_after_qcqsv_or_qcqvs_csv and found_floating_quote:
                     floating_quote["speaker"] = last_quote["speaker"]
-                    floating_quote["speaker_index"] = last_quote["speaker_index"]
+                    floating_quote.update(
+                        utils.span_fields("speaker", utils.get_span(last_quote, "speaker"))
+                    )
                     floating_quotes.append(floating_quote)
 
-                last_sent = sent
+                last_sent_idx = sent_idx
         return floating_quotes
 
     def extract_heuristic_quotes(self, doc):
@@ -432,44 +602,45 @@ class QuoteExtractor:
           :returns: List of quote objects containing the quotes and other information
         """
         quote_list = []
-        quote = False
-        for word in doc:
-            if str(word) == '"':
-                if not quote:
-                    start = word.i
-                    quote = True
+        # Look up the text and part-of-speech of all tokens at once, to find the quotation marks and verbs
+        token_attrs = doc.to_array([ORTH, POS])
+        orths, pos = token_attrs[:, 0], token_attrs[:, 1]
+        is_verb = ((pos == VERB) & ~numpy.isin(orths, self.non_quote_verb_orths)).tolist()
+        is_stop = numpy.isin(orths, self.verb_stop_orths).tolist()
+        quote_marks = numpy.flatnonzero(orths == self.quote_mark_orth).tolist()
+        # Quotation marks are paired in order, and an unpaired last mark is ignored
+        for start, end in zip(quote_marks[0::2], quote_marks[1::2]):
+            sent = doc[start : end + 1]
+            verb_i = self.get_closest_verb(is_verb, is_stop, start, end + 1, len(doc))
+            if verb_i is None:
+                verb = ""
+                verb_span = None
+                speaker = ""
+                speaker_span = (0, 0)  # Assign non-empty speaker span to avoid breaking parse
+            else:
+                verb = doc[verb_i]
+                speaker = self.get_closest_speaker(verb)
+                if speaker:
+                    speaker_span = self.get_char_span(speaker)
+                    speaker = speaker.text
                 else:
-                    sent = doc[start : word.i + 1]
-                    verb = self.get_closest_verb(doc, sent, len(doc))
-                    if verb is None:
-                        verb = ""
-                        verb_index = ""
-                        speaker = ""
-                        speaker_index = "(0,0)"  # Assign non-empty quote-index to avoid breaking parse
-                    else:
-                        speaker = self.get_closest_speaker(verb)
-                        if speaker:
-                            speaker_index = self.get_pretty_index(speaker)
-                            speaker = speaker.text
-                        else:
-                            speaker_index = "(0,0)"  # Assign non-empty quote-index to avoid breaking parse
-                            speaker = ""
-                        verb_index = self.get_pretty_index(verb)
-                        verb = verb.text
-                    if len(sent) > 6 and len(sent) < 100:
-                        quote_obj = {
-                            "speaker": speaker,
-                            "speaker_index": speaker_index,
-                            "quote": str(sent),
-                            "quote_index": self.get_pretty_index(sent),
-                            "verb": verb,
-                            "verb_index": verb_index,
-                            "quote_token_count": len(sent),
-                            "quote_type": "Heuristic",
-                            "is_floating_quote": False,
-                        }
-                        quote_list.append(quote_obj)
-                    quote = False
+                    speaker_span = (0, 0)  # Assign non-empty speaker span to avoid breaking parse
+                    speaker = ""
+                verb_span = self.get_char_span(verb)
+                verb = verb.text
+            if len(sent) > 6 and len(sent) < 100:
+                quote_obj = {
+                    "speaker": speaker,
+                    **utils.span_fields("speaker", speaker_span),
+                    "quote": str(sent),
+                    **utils.span_fields("quote", self.get_char_span(sent)),
+                    "verb": verb,
+                    **utils.span_fields("verb", verb_span),
+                    "quote_token_count": len(sent),
+                    "quote_type": "Heuristic",
+                    "is_floating_quote": False,
+                }
+                quote_list.append(quote_obj)
         return quote_list
 
     def extract_quotes(self, doc):
@@ -479,43 +650,89 @@ class QuoteExtractor:
           2. Extract floating quotes
           3. Extract heuristic quotes (using custom rules)
         """
-        syntactic_quotes = self.extract_syntactic_quotes(doc)
-        floating_quotes = self.extract_floating_quotes(doc, syntactic_quotes)
-        heuristic_quotes = self.extract_heuristic_quotes(doc)
+        with self.profiler.time("syntactic"):
+            syntactic_quotes = self.extract_syntactic_quotes(doc)
+        with self.profiler.time("floating"):
+            floating_quotes = self.extract_floating_quotes(doc, syntactic_quotes)
+        with self.profiler.time("heuristic"):
+            heuristic_quotes = self.extract_heuristic_quotes(doc)
         all_quotes = syntactic_quotes + floating_quotes + heuristic_quotes
-        final_quotes = self.find_global_duplicates(all_quotes)
+        with self.profiler.time("dedup"):
+            final_quotes = self.find_global_duplicates(all_quotes)
+        self.profiler.record("quotes_found", len(all_quotes))
         return final_quotes
 
-    def run(self, collection, mongo_doc):
-        """Run quote extraction on a MongoDB document, and write quotes to a specified collection in the database"""
-        try:
-            doc_id = str(mongo_doc["_id"])
+    def parse_windows(self, text):
+        """
+        Split a long (preprocessed) text into windows of paragraphs (see utils.split_windows), so that the
+        text doesn't have to be parsed all at once, and yield (offset of the window in the text, parsed window).
+        """
+        for offset, window in utils.split_windows(text, self.config["NLP"]["MAX_BODY_LENGTH"]):
+            yield offset, self.nlp(window)
 
+    def extract_quotes_windowed(self, window_docs):
+        """
+        Extract quotes from the parsed windows of a long text (see parse_windows), one window at a time.
+        The character offsets of the quotes are relative to the whole text, and the duplicate quotes found
+        in the overlap between windows are removed. The profiler records the measurements of all windows
+        as one document.
+        """
+        quotes = []
+        with self.profiler.combine():
+            for offset, doc in window_docs:
+                for quote in self.extract_quotes(doc):
+                    quotes.append(utils.shift_quote(quote, offset))
+            with self.profiler.time("dedup"):
+                return self.find_global_duplicates(quotes)
+
+    def is_too_long(self, mongo_doc):
+        """Check whether a document's body exceeds the maximum length we parse with spaCy"""
+        return len(mongo_doc["body"]) > self.config["NLP"]["MAX_BODY_LENGTH"]
+
+    def run(self, collection, mongo_doc, spacy_doc=None):
+        """Run quote extraction on a MongoDB document, and write quotes to a specified collection in the database.
+        The collection can also be a utils.BulkWriter that buffers the writes for the collection.
+        If the document was already parsed (e.g., in batches with nlp.pipe), pass it in as `spacy_doc`.
+        Returns whether the document was processed without errors.
+        """
+        doc_id = str(mongo_doc["_id"]) if mongo_doc is not None else None
+        try:
             if mongo_doc is None:
-                logger.error(f"Document '{doc_id}' not found.")
-            else:
-                text = mongo_doc["body"]
-                text_length = len(text)
-                if text_length > self.config["NLP"]["MAX_BODY_LENGTH"]:
-                    logger.warning(
-                        f"Skipping document {doc_id} due to long length {text_length} characters")
-                    if not self.config["dry_run"]:
-                        collection.update_one(
-                            {"_id": ObjectId(doc_id)},
-                            {
-                                "$set": {
-                                    "lastModifier": "max_body_len",
-                                    "lastModified": datetime.now(),
-                                },
-                                "$unset": {"quotes": 1},
+                logger.error("Document not found.")
+                return False
+            elif self.is_too_long(mongo_doc) and not self.config.get("windowed"):
+                text_length = len(mongo_doc["body"])
+                logger.warning(
+                    f"Skipping document {doc_id} due to long length {text_length} characters")
+                if not self.config["dry_run"]:
+                    collection.update_one(
+                        {"_id": ObjectId(doc_id)},
+                        {
+                            "$set": {
+                                "lastModifier": "max_body_len",
+                                "lastModified": datetime.now(),
                             },
-                            upsert=True,
-                        )
+                            "$unset": {"quotes": 1},
+                        },
+                        upsert=True,
+                    )
+            else:
                 # Process document
-                doc_text = utils.preprocess_text(mongo_doc["body"])
-                spacy_doc = nlp(doc_text)
-
-                quotes = self.extract_quotes(spacy_doc)
+                self.profiler.start_doc(doc_id)
+                self.profiler.record("doc_length", len(mongo_doc["body"]))
+                if self.is_too_long(mongo_doc):
+                    # Parse and extract quotes from long documents in windows of paragraphs
+                    doc_text = utils.preprocess_text(mongo_doc["body"])
+                    with self.profiler.time("windowed"):
+                        quotes = self.extract_quotes_windowed(self.parse_windows(doc_text))
+                else:
+                    if spacy_doc is None:
+                        doc_text = utils.preprocess_text(mongo_doc["body"])
+                        with self.profiler.time("parse"):
+                            spacy_doc = self.nlp(doc_text)
+                    self.profiler.record("tokens", len(spacy_doc))
+                    quotes = self.extract_quotes(spacy_doc)
+                self.profiler.record("quotes", len(quotes))
                 if not self.config["dry_run"]:
                     collection.update_one(
                         {"_id": ObjectId(doc_id)},
@@ -532,11 +749,15 @@ class QuoteExtractor:
                     print("=" * 20, " Quotes ", "=" * 20)
                     for q in quotes:
                         print(q, "\n")
-        except:
+            return True
+        except Exception:
             logger.exception(
-                f"Failed to process {mongo_doc['_id']} due to runtime exception!"
+                f"Failed to process {doc_id} due to runtime exception!"
             )
             traceback.print_exc()
+            return False
+        finally:
+            self.profiler.end_doc()
 
 
 if __name__ == "__main__":
@@ -555,8 +776,21 @@ if __name__ == "__main__":
     parser.add_argument("--ids", type=str, help="Comma-separated list of document ids to process. \
                                                By default, all documents in the collection are processed.")
     parser.add_argument("--spacy_model", type=str, default="en_core_web_lg", help="spaCy language model to use for NLP")
+    parser.add_argument("--doc_cache", type=str, default="", help="Path to a directory for caching parsed documents on disk")
+    parser.add_argument("--doc_cache_max_gb", type=float, default=20, help="Max. size of the doc cache, which is pruned to this size after each run (0 for no limit)")
     parser.add_argument("--poolsize", type=int, default=cpu_count() + 1, help="Size of the concurrent process pool for the given task")
     parser.add_argument("--chunksize", type=int, default=20, help="Number of articles IDs per chunk being processed concurrently")
+    parser.add_argument("--schedule", type=str, default="ids", choices=["ids", "length"],
+                        help="Chunk articles by ID ('ids', streamed), or into chunks of similar total body length, longest first ('length')")
+    parser.add_argument("--windowed", action="store_true", help="Process documents longer than MAX_BODY_LENGTH in windows of paragraphs instead of skipping them")
+    parser.add_argument("--batched", action="store_true", help="Fetch each chunk with one query and parse it in batches with nlp.pipe")
+    parser.add_argument("--batch_size", type=int, default=20, help="Number of articles per nlp.pipe batch in batched mode")
+    parser.add_argument("--write_batch_size", type=int, default=100, help="Max. number of buffered writes per bulk write to the database")
+    parser.add_argument("--write_interval", type=float, default=10.0, help="Max. number of seconds to buffer writes before a bulk write")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run with the same arguments from its last checkpoint")
+    parser.add_argument("--checkpoint_col", type=str, default="nlpCheckpoints", help="Collection name to store run checkpoints in")
+    parser.add_argument("--profile", action="store_true", help="Log a summary of the time spent in each quote extraction stage")
+    parser.add_argument("--profile_out", type=str, default="", help="Path to a JSONL file to append each document's profile to (implies --profile)")
     dargs = parser.parse_args()
     args = vars(dargs)
 
@@ -576,6 +810,25 @@ if __name__ == "__main__":
     OUT_DIR = args["out_dir"]
     POOLSIZE = args["poolsize"]
     CHUNKSIZE = args["chunksize"]
+    SPACY_MODEL = args["spacy_model"]
+    DOC_CACHE = args["doc_cache"]
+    DOC_CACHE_MAX_GB = args["doc_cache_max_gb"]
+    BATCHED = args["batched"]
+    BATCH_SIZE = args["batch_size"]
+    WRITE_BATCH_SIZE = args["write_batch_size"]
+    WRITE_INTERVAL = args["write_interval"]
+    RESUME = args["resume"]
+    SCHEDULE = args["schedule"]
+    if RESUME and SCHEDULE == "length":
+        parser.error("--resume relies on chunks being processed in ID order, and cannot be used with --schedule length")
+    CHECKPOINT_COL = args["checkpoint_col"]
+    PROFILE_OUT = args["profile_out"]
+    PROFILE = args["profile"] or bool(PROFILE_OUT)
+    # Arguments that identify a run, so that only a run with the same arguments is resumed
+    RUN_PARAMS = {
+        key: args[key]
+        for key in ["db", "readcol", "force_update", "limit", "begin_date", "end_date", "outlets", "ids", "spacy_model", "windowed"]
+    }
 
     date_begin = utils.convert_date(args["begin_date"]) if args["begin_date"] else None
     date_end = utils.convert_date(args["end_date"]) if args["begin_date"] else None
@@ -605,18 +858,17 @@ if __name__ == "__main__":
         "other_filters": other_filters,
     }
 
-    print(f"Loading spaCy language model: {args['spacy_model']}...")
-    nlp = spacy.load(args["spacy_model"])
-    args["spacy_lang"] = nlp
     config = {**args, **config}
-    print("Finished loading")
-
-    extractor = QuoteExtractor(config)
-    db_client = utils.init_client(MONGO_ARGS)
-    query = utils.prepare_query(filters)
 
     if IN_DIR:
         UPDATE_DB = False
+        print(f"Loading spaCy language model: {SPACY_MODEL}...")
+        nlp = spacy.load(SPACY_MODEL)
+        if DOC_CACHE:
+            nlp = DocCache(DOC_CACHE, nlp)
+        print("Finished loading")
+        extractor = QuoteExtractor({**config, "spacy_lang": nlp})
+        extractor.profiler = utils.StageProfiler(enabled=PROFILE, keep_docs=bool(PROFILE_OUT))
         # Add custom read/write logic for local machine here
         file_dict = utils.get_files_from_folder(folder_path=IN_DIR, limit=DOC_LIMIT)
         for idx, text in file_dict.items():
@@ -626,8 +878,21 @@ if __name__ == "__main__":
             if OUT_DIR:
                 utils.write_quotes_local(quote_dict=quote_dict, output_dir=OUT_DIR)
         print(f'Retrieveved {len(file_dict)} files from "{IN_DIR}"')
+        if PROFILE:
+            profiler = utils.StageProfiler()
+            profile_file = open(PROFILE_OUT, "a") if PROFILE_OUT else None
+            write_profile(profiler, profile_file, extractor.profiler.pop_stats())
+            if profile_file:
+                profile_file.close()
+            print("\n".join(profiler.summary()))
 
     else:
         # Directly parse documents from the db, and write back to db
+        # (each worker process loads its own spaCy model and database client)
         run_pool(POOLSIZE, CHUNKSIZE)
         logger.info("Finished processing quotes.")
+
+    if DOC_CACHE and DOC_CACHE_MAX_GB:
+        # Remove the least recently used docs, so that the cache doesn't keep growing with every run
+        num_removed, removed_bytes = prune_cache(DOC_CACHE, max_bytes=int(DOC_CACHE_MAX_GB * 1e9))
+        logger.info(f"Removed {num_removed} docs ({removed_bytes / 1e9:.2f} GB) from the doc cache.")
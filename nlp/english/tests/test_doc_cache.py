@@ -0,0 +1,41 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("srsly")
+pytest.importorskip("spacy")
+
+from doc_cache import clear_cache, prune_cache
+
+
+def write_file(path, size, age):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    used = time.time() - age
+    os.utime(path, (used, used))
+
+
+def test_prune_cache_removes_old_and_least_recently_used_docs(tmp_path):
+    cache_dir = str(tmp_path)
+    for name, age in [("aa/new.bin", 0), ("ab/recent.bin", 60), ("aa/old.bin", 3600), ("ff/oldest.bin", 7200)]:
+        write_file(os.path.join(cache_dir, name), 100, age)
+    # A write in progress, and one that was interrupted long ago
+    write_file(os.path.join(cache_dir, "ab", "writing.tmp"), 100, 0)
+    write_file(os.path.join(cache_dir, "ab", "interrupted.tmp"), 100, 7200)
+    assert prune_cache(cache_dir, max_age=5000) == (2, 200)
+    assert prune_cache(cache_dir, max_bytes=250) == (1, 100)
+    assert sorted(os.listdir(os.path.join(cache_dir, "aa")) + os.listdir(os.path.join(cache_dir, "ab"))) == [
+        "new.bin", "recent.bin", "writing.tmp"
+    ]
+    assert prune_cache(cache_dir, max_bytes=250) == (0, 0)
+
+
+def test_clear_cache_only_removes_shard_directories(tmp_path):
+    cache_dir = str(tmp_path)
+    write_file(os.path.join(cache_dir, "0f", "doc.bin"), 100, 0)
+    write_file(os.path.join(cache_dir, "notes", "keep.txt"), 100, 0)
+    clear_cache(cache_dir)
+    assert os.listdir(cache_dir) == ["notes"]
+    assert prune_cache(os.path.join(cache_dir, "missing")) == (0, 0)
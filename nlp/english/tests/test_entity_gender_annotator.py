@@ -0,0 +1,82 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("spacy")
+pytest.importorskip("neuralcoref")
+pytest.importorskip("pymongo")
+
+import utils
+from entity_gender_annotator import EntityGenderAnnotator
+
+
+@pytest.fixture(scope="module")
+def annotator():
+    # complex_merge doesn't use any state set up from the config
+    return EntityGenderAnnotator.__new__(EntityGenderAnnotator)
+
+
+def reference_complex_merge(annotator, ne_dict):
+    """Previous (quadratic) implementation of EntityGenderAnnotator.complex_merge"""
+    merged_nes = {}
+    changed = {}
+    for ne in ne_dict.keys():
+        found = False
+        for merged in merged_nes.keys():
+            if annotator.can_merge_nes(str(ne), str(merged)):
+                if len(ne) > len(merged):
+                    merged_nes[ne] = merged_nes[merged] + ne_dict[ne]["mentions"]
+                    changed[ne] = 1
+                    del merged_nes[merged]
+                elif len(ne) < len(merged):
+                    changed[merged] = 1
+                    merged_nes[merged] = merged_nes[merged] + ne_dict[ne]["mentions"]
+                found = True
+                break
+        if not found:
+            changed[ne] = 0
+            merged_nes[ne] = ne_dict[ne]["mentions"]
+    return merged_nes, changed
+
+
+def test_complex_merge_matches_reference(annotator):
+    rng = random.Random(17)
+    tokens = ["Al", "Bo", "Cy", "Eve", "Joe", "Ann", "al", "bo"]
+    for _ in range(2000):
+        ne_dict = {}
+        for i in range(rng.randint(0, 25)):
+            name = " ".join(rng.choice(tokens) for _ in range(rng.randint(1, 4)))
+            ne_dict[name] = {"mentions": [f"{name} {i}"]}
+        expected = reference_complex_merge(annotator, ne_dict)
+        merged_nes, changed = annotator.complex_merge(ne_dict)
+        assert list(merged_nes.items()) == list(expected[0].items())
+        assert changed == expected[1]
+
+
+def test_run_windowed_merges_named_entities_across_windows(annotator, monkeypatch):
+    def mention(start, end):
+        return SimpleNamespace(start_char=start, end_char=end)
+
+    # Named entities found in each window (the second window starts at offset 100 in the text)
+    window_nes = {
+        "first": {"Justin Trudeau": [mention(0, 14)], "Jagmeet Singh": [mention(30, 43)]},
+        "second": {"Justin": [mention(5, 11)], "Pierre Elliott Trudeau": [mention(40, 62)]},
+    }
+    window_docs = [(0, SimpleNamespace(name="first", ents=[])), (100, SimpleNamespace(name="second", ents=[]))]
+    monkeypatch.setattr(annotator, "merge_nes", lambda doc: window_nes[doc.name], raising=False)
+    monkeypatch.setattr(annotator, "annotate", lambda *args: args, raising=False)
+    quotes = [
+        {"quote": "a", **utils.span_fields("speaker", (105, 111))},
+        {"quote": "b", **utils.span_fields("speaker", (30, 43))},
+        {"quote": "c", **utils.span_fields("speaker", (170, 180))},
+    ]
+    _, _, people, _, nes_quotes, quotes_no_nes, _, _, _ = annotator.run_windowed(
+        None, "", [], quotes, "", 150, window_docs=window_docs
+    )
+    # "Justin" in the second window is the same person as "Justin Trudeau" in the first one
+    assert people == ["Justin Trudeau", "Jagmeet Singh", "Pierre Elliott Trudeau"]
+    assert {ne: [q["quote"] for q in ne_quotes] for ne, ne_quotes in nes_quotes.items()} == {
+        "Justin Trudeau": ["a"], "Jagmeet Singh": ["b"],
+    }
+    assert [q["quote"] for q in quotes_no_nes] == ["c"]
@@ -0,0 +1,341 @@
+import json
+import os
+import random
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip("pymongo")
+pytest.importorskip("requests")
+mongomock = pytest.importorskip("mongomock")
+
+import gender_predictor
+import utils
+from pymongo.errors import BulkWriteError
+from gender_predictor import (
+    CacheGenderizer,
+    GenderResolver,
+    GenderServiceClient,
+    NameGenderCache,
+    NegativeCache,
+    ServiceGenderizer,
+    SnapshotGenderizer,
+)
+from gender_snapshot import GenderSnapshot, export_snapshot
+
+FIRST_NAMES = ["justin", "chrystia", "françois", "francois", "jagmeet", "andrea", "kim", "sam"]
+LAST_NAMES = ["trudeau", "freeland", "legault", "singh", "horwath", "campbell"]
+GENDERS = ["male", "female", "unknown"]
+
+
+def reference_run(genderizer, names):
+    """Previous implementation of CacheGenderizer.run, with one sequential $or query per cache
+    (where names that share a full or first name are all given the gender found for it)
+    """
+
+    def find(collection, names_mapping, query_field):
+        query = {"$or": [{query_field: name} for name in names_mapping]}
+        return dict(
+            (name, item["gender"])
+            for item in collection.find(query, {"_id": 0})
+            for name in names_mapping[item[query_field]]
+        )
+
+    def mapping_by(key, names):
+        names_mapping = {}
+        for name in names:
+            names_mapping.setdefault(key(name), []).append(name)
+        return names_mapping
+
+    def full_name_mapping(names):
+        return mapping_by(lambda name: utils.preprocess_text(name).lower(), names)
+
+    def first_name_mapping(names):
+        return mapping_by(lambda name: name.split()[0].lower(), names)
+
+    results = {name: "unknown" for name in names}
+    names_mapping = full_name_mapping(names)
+    results.update(find(genderizer.manual_cache_col, names_mapping, "name"))
+    tiers = [
+        (genderizer.genderapi_cache_col, "q", False),
+        (genderizer.genderize_cache_col, "name", True),
+        (genderizer.genderapi_cache_col, "name", True),
+        (genderizer.firstname_cache_col, "name", True),
+    ]
+    for collection, query_field, by_first_name in tiers:
+        unknowns = genderizer._update_unknowns(results)
+        if not unknowns:
+            return results, unknowns
+        if by_first_name:
+            mapping = first_name_mapping(unknowns)
+        else:
+            mapping = full_name_mapping(unknowns)
+        results.update(find(collection, mapping, query_field))
+    return results, genderizer._update_unknowns(results)
+
+
+def random_name(rng):
+    name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    return name.title() if rng.random() < 0.5 else name
+
+
+def test_cache_genderizer_matches_sequential_lookups():
+    rng = random.Random(20)
+    for _ in range(50):
+        db_client = mongomock.MongoClient()
+        db = db_client["genderCache"]
+        for _ in range(rng.randint(0, 5)):
+            db["manual"].insert_one({"name": utils.preprocess_text(random_name(rng)).lower(), "gender": rng.choice(GENDERS)})
+        for _ in range(rng.randint(0, 5)):
+            db["genderAPI"].insert_one({"q": utils.preprocess_text(random_name(rng)).lower(), "gender": rng.choice(GENDERS)})
+        for collection, field in [("genderize", "name"), ("genderAPI", "name"), ("firstNames", "name")]:
+            for first_name in rng.sample(FIRST_NAMES, rng.randint(0, 3)):
+                db[collection].insert_one({field: first_name, "gender": rng.choice(GENDERS)})
+        genderizer = CacheGenderizer(db_client, "manual", "genderAPI", "genderize", "firstNames")
+        names = [random_name(rng) for _ in range(rng.randint(1, 8))]
+        assert genderizer.run(names) == reference_run(genderizer, names)
+
+
+def test_snapshot_genderizer_matches_cache_genderizer(tmp_path):
+    rng = random.Random(24)
+    gender_config = {
+        "MANUAL_CACHE": "manual",
+        "GENDERAPI_CACHE": "genderAPI",
+        "GENDERIZE_CACHE": "genderize",
+        "FIRSTNAME_CACHE": "firstNames",
+    }
+    for i in range(20):
+        db_client = mongomock.MongoClient()
+        db = db_client["genderCache"]
+        for _ in range(rng.randint(0, 5)):
+            db["manual"].insert_one({"name": utils.preprocess_text(random_name(rng)).lower(), "gender": rng.choice(GENDERS)})
+        for _ in range(rng.randint(0, 5)):
+            db["genderAPI"].insert_one({"q": utils.preprocess_text(random_name(rng)).lower(), "gender": rng.choice(GENDERS)})
+        for collection, field in [("genderize", "name"), ("genderAPI", "name"), ("firstNames", "name")]:
+            for first_name in rng.sample(FIRST_NAMES, rng.randint(0, 3)):
+                db[collection].insert_one({field: first_name, "gender": rng.choice(GENDERS)})
+        path = str(tmp_path / f"{i}.snapshot")
+        export_snapshot(db_client, gender_config, path)
+        genderizer = CacheGenderizer(db_client, "manual", "genderAPI", "genderize", "firstNames")
+        snapshot_genderizer = SnapshotGenderizer(GenderSnapshot(path))
+        names = [random_name(rng) for _ in range(rng.randint(1, 8))]
+        assert snapshot_genderizer.run(names) == genderizer.run(names)
+
+
+def test_get_genders_with_snapshot_skips_database(tmp_path, monkeypatch):
+    db_client = mongomock.MongoClient()
+    db_client["genderCache"][gender_predictor.GENDERIZE_CACHE].insert_one({"name": "kim", "gender": "female"})
+    db_client["genderCache"][gender_predictor.MANUAL_CACHE].insert_one({"name": "sam horwath", "gender": "male"})
+    path = str(tmp_path / "gender_cache.snapshot")
+    export_snapshot(db_client, gender_predictor.config["GENDER_RECOGNITION"], path)
+    monkeypatch.setattr(gender_predictor, "SNAPSHOT", None)
+    gender_predictor.load_snapshot(path)
+    names = ["Kim Campbell", "Sam Horwath", "Jane Roe", "K"]
+    # Neither the database nor the gender services are used
+    assert gender_predictor.get_genders(None, None, names) == {
+        "Kim Campbell": "female", "Sam Horwath": "male", "Jane Roe": "unknown", "K": "unknown",
+    }
+
+
+def test_cache_genderizer_names_sharing_a_first_name():
+    db_client = mongomock.MongoClient()
+    db_client["genderCache"]["genderize"].insert_one({"name": "kim", "gender": "female"})
+    db_client["genderCache"]["manual"].insert_one({"name": "kim singh", "gender": "unknown"})
+    genderizer = CacheGenderizer(db_client, "manual", "genderAPI", "genderize", "firstNames")
+    results, unknowns = genderizer.run(["Kim Campbell", "Kim Singh", "kim singh", "Sam Horwath"])
+    assert results == {"Kim Campbell": "female", "Kim Singh": "female", "kim singh": "female", "Sam Horwath": "unknown"}
+    assert unknowns == {"Sam Horwath": "unknown"}
+
+
+def test_gender_resolver_falls_back_to_each_article(monkeypatch):
+    calls = []
+
+    def get_genders(session, db_client, names):
+        calls.append(names)
+        if "Bad Name" in names:
+            raise RuntimeError("Lookup failed")
+        return {name: "female" for name in names}
+
+    monkeypatch.setattr(gender_predictor, "get_genders", get_genders)
+    resolver = GenderResolver(None, None)
+    resolver.add(["Jane Roe", "Kim Campbell"])
+    resolver.add(["Bad Name", "Jane Roe"])
+    resolver.add(["Sam Horwath"])
+    resolver.resolve()
+    # One lookup of all names, and then one lookup per article
+    assert calls == [
+        ["Jane Roe", "Kim Campbell", "Bad Name", "Sam Horwath"],
+        ["Jane Roe", "Kim Campbell"],
+        ["Bad Name"],
+        ["Sam Horwath"],
+    ]
+    assert resolver.genders(["Jane Roe", "Sam Horwath"]) == {"Jane Roe": "female", "Sam Horwath": "female"}
+    with pytest.raises(RuntimeError):
+        resolver.genders(["Bad Name", "Jane Roe"])
+
+
+def test_name_gender_cache_clears_on_cache_updates():
+    db_client = mongomock.MongoClient()
+    cache = NameGenderCache(max_size=2, ttl=60, check_interval=0)
+    cache.check_updates(db_client)
+    cache.put("Justin Trudeau", "male", "manual")
+    cache.put("Chrystia Freeland", "female", "genderapi_fullname")
+    assert cache.get("justin trudeau") == "male"
+    # The least recently used name is evicted
+    cache.put("Jagmeet Singh", "male", "firstname")
+    assert cache.get("Chrystia Freeland") is None
+    assert cache.get("Jagmeet Singh") == "male"
+    assert (cache.hits, cache.misses) == (2, 1)
+    db_client["genderCache"][gender_predictor.CACHE_UPDATES].update_one(
+        {"_id": "genderCache"}, {"$inc": {"version": 1}}, upsert=True
+    )
+    cache.check_updates(db_client)
+    assert cache.get("Justin Trudeau") is None
+
+
+class StubServiceHandler(BaseHTTPRequestHandler):
+    """Answers like Gender-API (POST) and Genderize (GET): names starting with "Jane" or "jane" are female,
+    and all other names are not found. The first request of each test is rate limited.
+    """
+
+    def send_json(self, status, body, headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode("utf-8"))
+
+    def handle_request(self, names, make_result):
+        with self.server.lock:
+            self.server.requests.append(names)
+            rate_limited = len(self.server.requests) == 1
+        if rate_limited:
+            self.send_json(429, {"error": "Too many requests"}, [("Retry-After", "0")])
+        else:
+            self.send_json(200, [make_result(name) for name in names])
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.handle_request(
+            [item["full_name"] for item in payload],
+            lambda name: {
+                "input": {"full_name": name},
+                "result_found": name.startswith("Jane"),
+                "gender": "female" if name.startswith("Jane") else None,
+            },
+        )
+
+    def do_GET(self):
+        names = parse_qs(urlparse(self.path).query)["name[]"]
+        self.handle_request(
+            names,
+            lambda name: {"name": name, "gender": "female" if name.startswith("jane") else None},
+        )
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def stub_service(monkeypatch):
+    server = StubServer(("127.0.0.1", 0), StubServiceHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    monkeypatch.setattr(gender_predictor, "GENDERAPI_URL", url)
+    monkeypatch.setattr(gender_predictor, "GENDERIZE_URL", url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def service_genderizer(db_client):
+    client = GenderServiceClient(concurrency=3, rate_limit=0, retries=2, timeout=5, backoff=0)
+    return ServiceGenderizer(db_client, "genderize", "genderAPI", client)
+
+
+def test_genderapi_requests_are_batched_and_retried(stub_service):
+    db_client = mongomock.MongoClient()
+    names = [f"Jane Doe{i}" for i in range(120)] + [f"John Doe{i}" for i in range(30)]
+    results = service_genderizer(db_client).get_genderapi_gender(names)
+    assert results == {f"Jane Doe{i}": "female" for i in range(120)}
+    # Two batches of at most 100 names, one of which was retried after being rate limited
+    assert sorted(len(batch) for batch in stub_service.requests) in ([50, 100, 100], [50, 50, 100])
+    assert db_client["genderCache"]["genderAPI"].count_documents({}) == 120
+
+
+def test_genderize_requests_are_batched_by_first_name(stub_service):
+    db_client = mongomock.MongoClient()
+    names = [f"Jane{i} Doe" for i in range(15)] + [f"Jane{i} Roe" for i in range(15)] + ["John Doe", "Madonna"]
+    results = service_genderizer(db_client).get_genderize_gender(names)
+    assert results == {**{name: "female" for name in names[:30]}, "John Doe": "unknown", "Madonna": "unknown"}
+    # 16 distinct first names are looked up in two batches of at most 10 names
+    assert sorted(len(batch) for batch in stub_service.requests[1:]) == [6, 10]
+    assert db_client["genderCache"]["genderize"].count_documents({}) == 16
+
+
+def test_service_genderizer_sends_all_names_to_both_services(stub_service, monkeypatch):
+    monkeypatch.setattr(gender_predictor, "GENDERAPI_ENABLED", True)
+    monkeypatch.setattr(gender_predictor, "GENDERIZE_ENABLED", True)
+    names = ["Jane Roe", "John Doe"]
+    results = service_genderizer(mongomock.MongoClient()).run(None, {}, dict.fromkeys(names, "unknown"))
+    assert results == {"Jane Roe": "female", "John Doe": "unknown"}
+    # Gender-API is sent the full names, and Genderize the first names, even those Gender-API found
+    requested = [name for batch in stub_service.requests[1:] for name in batch]
+    assert sorted(requested) == ["Jane Roe", "John Doe", "jane", "john"]
+
+
+def test_negative_cache_skips_gender_services(stub_service, monkeypatch):
+    monkeypatch.setattr(gender_predictor, "NAME_CACHE", NameGenderCache())
+    monkeypatch.setattr(gender_predictor, "GENDERAPI_ENABLED", True)
+    monkeypatch.setattr(gender_predictor, "GENDERIZE_ENABLED", False)
+    monkeypatch.setattr(gender_predictor, "_service_client", service_genderizer(mongomock.MongoClient()).client)
+    monkeypatch.setattr(gender_predictor, "_service_client_pid", os.getpid())
+    db_client = mongomock.MongoClient()
+    names = ["Jane Roe", "Acme Corp"]
+    assert gender_predictor.get_genders(None, db_client, names) == {"Jane Roe": "female", "Acme Corp": "unknown"}
+    negative_cache = NegativeCache(db_client, gender_predictor.NEGATIVE_CACHE)
+    assert negative_cache.filter_known_unknowns(["Acme Corp", "acme corp", "Jane Roe"]) == ["Jane Roe"]
+    # Jane Roe is now found in the Gender-API cache, and Acme Corp in the negative cache
+    num_requests = len(stub_service.requests)
+    assert gender_predictor.get_genders(None, db_client, names) == {"Jane Roe": "female", "Acme Corp": "unknown"}
+    assert len(stub_service.requests) == num_requests
+
+
+def test_negative_cache_ignores_expired_names():
+    negative_cache = NegativeCache(mongomock.MongoClient(), gender_predictor.NEGATIVE_CACHE, ttl=3600)
+    negative_cache.add(["Acme Corp", "Jane Roe"])
+    # Jane Roe's entry expired, but wasn't removed (as there is no TTL index)
+    negative_cache.col.update_one(
+        {"name": "jane roe"}, {"$set": {"lastChecked": datetime.utcnow() - timedelta(seconds=3601)}}
+    )
+    assert negative_cache.filter_known_unknowns(["Jane Roe", "Acme Corp"]) == ["Jane Roe"]
+
+
+class DuplicateKeyCollection:
+    def __init__(self, code):
+        self.code = code
+
+    def bulk_write(self, operations, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": self.code, "errmsg": "write failed"}]})
+
+
+def test_negative_cache_ignores_duplicate_names():
+    negative_cache = NegativeCache(mongomock.MongoClient(), gender_predictor.NEGATIVE_CACHE)
+    # Another worker inserted the same name at the same time
+    negative_cache.col = DuplicateKeyCollection(11000)
+    negative_cache.add(["Acme Corp"])
+    negative_cache.col = DuplicateKeyCollection(2)
+    with pytest.raises(BulkWriteError):
+        negative_cache.add(["Acme Corp"])
@@ -0,0 +1,32 @@
+import random
+
+import pytest
+
+from gender_snapshot import GenderSnapshot, write_snapshot
+
+
+def test_snapshot_round_trip(tmp_path):
+    rng = random.Random(24)
+    alphabet = "abcéèçğ -'"
+    tables = {
+        "manual": {"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 12))): rng.choice(["male", "female", "unknown"]) for _ in range(300)},
+        "firstname": {"kim": "female", "françois": "male"},
+        "genderize_firstname": {},
+    }
+    path = str(tmp_path / "gender_cache.snapshot")
+    write_snapshot(path, tables)
+    snapshot = GenderSnapshot(path)
+    assert len(snapshot) == sum(len(table) for table in tables.values())
+    for name, table in tables.items():
+        for key, gender in table.items():
+            assert snapshot.get(name, key) == gender
+    assert snapshot.get("manual", "not a name in the table") is None
+    assert snapshot.get("genderize_firstname", "kim") is None
+    assert snapshot.find("firstname", ["sam", "françois", "kim"]) == [("françois", "male"), ("kim", "female")]
+
+
+def test_snapshot_rejects_other_files(tmp_path):
+    path = tmp_path / "not_a_snapshot"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        GenderSnapshot(str(path))
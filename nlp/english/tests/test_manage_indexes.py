@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("pymongo")
+mongomock = pytest.importorskip("mongomock")
+
+from config import config
+from manage_indexes import duplicate_keys, ensure_indexes, missing_indexes, pipeline_queries, plan_stages, required_indexes
+
+
+def test_ensure_indexes_only_creates_missing_indexes():
+    db_client = mongomock.MongoClient()
+    db_client["mediaTracker"]["media"].create_index([("outlet", 1), ("publishedAt", 1)])
+    indexes = required_indexes(config["GENDER_RECOGNITION"], "mediaTracker", "media")
+    created = ensure_indexes(db_client, indexes)
+    assert len(created) == len(indexes) - 1
+    assert ("mediaTracker", "media", [("outlet", 1), ("publishedAt", 1)], {}) not in created
+    assert missing_indexes(db_client, indexes) == []
+    assert ensure_indexes(db_client, indexes) == []
+
+
+def test_ensure_indexes_removes_duplicates_before_creating_unique_indexes():
+    db_client = mongomock.MongoClient()
+    unknown_names = db_client["genderCache"][config["GENDER_RECOGNITION"]["NEGATIVE_CACHE"]]
+    unknown_names.insert_many([{"name": "acme corp"}, {"name": "jane roe"}, {"name": "acme corp"}, {"name": "acme corp"}])
+    latest = unknown_names.find_one({"name": "acme corp"}, sort=[("_id", -1)])["_id"]
+    assert list(duplicate_keys(unknown_names, [("name", 1)])) == [("acme corp",)]
+    ensure_indexes(db_client, required_indexes(config["GENDER_RECOGNITION"], "mediaTracker", "media"))
+    assert [item["_id"] for item in unknown_names.find({"name": "acme corp"})] == [latest]
+    assert unknown_names.count_documents({}) == 2
+    assert unknown_names.index_information()["name_1"]["unique"]
+
+
+def test_plan_stages_of_classic_and_sharded_plans():
+    plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "keyPattern": {"name": 1}}}
+    assert plan_stages(plan) == ["FETCH", "IXSCAN"]
+    sharded_plan = {
+        "stage": "SHARD_MERGE",
+        "shards": [
+            {"shardName": "rs0", "winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}},
+            {"shardName": "rs1", "winningPlan": {"queryPlan": {"stage": "OR", "inputStages": [plan, plan]}}},
+        ],
+    }
+    assert plan_stages(sharded_plan) == ["SHARD_MERGE", "SORT", "COLLSCAN", "OR", "FETCH", "IXSCAN", "FETCH", "IXSCAN"]
+
+
+def test_pipeline_queries_filter_articles_by_last_modifier():
+    queries = pipeline_queries(config["GENDER_RECOGNITION"], "mediaTracker", "media")
+    article_queries = {description: query for description, db_name, _, query, _ in queries if db_name == "mediaTracker"}
+    assert {"lastModifier": "quote_extractor"} in article_queries["entity_gender_annotator articles"]["$and"]
+    assert {"lastModifier": "mediaCollectors"} in article_queries["quote_extractor articles"]["$and"]
@@ -0,0 +1,332 @@
+import os
+import random
+from types import SimpleNamespace
+
+import pytest
+
+spacy = pytest.importorskip("spacy")
+pytest.importorskip("pymongo")
+
+import numpy
+from spacy.attrs import DEP, HEAD
+from spacy.tokens import Doc
+
+import utils
+from quote_extractor import QuoteExtractor
+
+RULES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rules")
+
+
+@pytest.fixture(scope="module")
+def extractor():
+    config = {"spacy_lang": spacy.blank("en"), "NLP": {"QUOTE_VERBS": os.path.join(RULES_DIR, "quote_verb_list.txt")}}
+    return QuoteExtractor(config)
+
+
+def reference_find_global_duplicates(quote_list):
+    """Previous (quadratic) implementation of QuoteExtractor.find_global_duplicates"""
+    quote_span_list = []
+    new_quote_span_list = []
+    remove_quotes = []
+    for quote in quote_list:
+        span = list(map(int, quote["quote_index"][1:-1].split(",")))
+        quote_span_list.append([span[0], span[1]])
+    for quote_idx, (start, end) in enumerate(quote_span_list):
+        quote_range = range(start, end)
+        not_duplicate = True
+        if len(quote_list[quote_idx]["quote"].split(" ")) < 4:
+            remove_quotes.append(quote_idx)
+            continue
+        for ref_quote_idx, (ref_start, ref_end) in enumerate(new_quote_span_list):
+            ref_quote_range = range(ref_start, ref_end)
+            if len(set(quote_range).intersection(ref_quote_range)) > 0:
+                not_duplicate = False
+                remove_quotes.append(quote_idx)
+                break
+        if not_duplicate:
+            new_quote_span_list.append([start, end])
+
+    final_quote_list = []
+    for idx, quote in enumerate(quote_list):
+        if idx not in remove_quotes:
+            final_quote_list.append(quote)
+    return final_quote_list
+
+
+def make_quote(start, end, num_words):
+    return {"quote": " ".join(["word"] * num_words), "quote_index": f"({start},{end})"}
+
+
+def test_find_global_duplicates_keeps_first_of_overlapping_quotes(extractor):
+    quotes = [
+        make_quote(10, 50, 5),
+        make_quote(40, 80, 5),
+        make_quote(50, 90, 5),
+        make_quote(0, 10, 5),
+        make_quote(95, 100, 2),
+        make_quote(95, 100, 4),
+    ]
+    result = extractor.find_global_duplicates(quotes)
+    assert result == [quotes[0], quotes[2], quotes[3], quotes[5]]
+
+
+def test_find_global_duplicates_keeps_empty_spans(extractor):
+    quotes = [make_quote(10, 50, 5), make_quote(20, 20, 5), make_quote(30, 25, 5), make_quote(20, 30, 5)]
+    assert extractor.find_global_duplicates(quotes) == quotes[:3]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_find_global_duplicates_matches_reference(extractor, seed):
+    rng = random.Random(seed)
+    quotes = []
+    for _ in range(rng.randint(0, 300)):
+        start = rng.randint(0, 5000)
+        end = start + rng.randint(-5, 300)
+        quotes.append(make_quote(start, end, rng.randint(1, 10)))
+    expected = reference_find_global_duplicates(quotes)
+    result = extractor.find_global_duplicates(quotes)
+    assert [id(q) for q in result] == [id(q) for q in expected]
+
+
+def reference_is_qcqsv_or_qcqvs_csv(sent, quote_list):
+    """Previous per-sentence lookup used by QuoteExtractor.extract_floating_quotes"""
+    sent_set = set(range(sent.start_char, sent.end_char))
+    for q in quote_list:
+        quote_index = [int(x) for x in (q["quote_index"][1:-1]).split(",")]
+        quote_set = set(range(quote_index[0], quote_index[1]))
+        threshold = min(len(quote_set), len(sent_set)) / 2
+        if len(quote_set.intersection(sent_set)) >= threshold:
+            if q["quote_type"] in ["QCQSV", "QCQVS", "CSV"]:
+                return True, q
+    return False, None
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_index_qcqsv_or_qcqvs_csv_matches_reference(extractor, seed):
+    rng = random.Random(seed)
+    sents = []
+    position = 0
+    for _ in range(rng.randint(1, 60)):
+        start = position + rng.randint(0, 2)
+        position = start + rng.choice([0, 1, 5, 20, 80])
+        sents.append(SimpleNamespace(start_char=start, end_char=position))
+    quotes = []
+    for _ in range(rng.randint(0, 30)):
+        start = rng.randint(0, position)
+        end = start + rng.choice([-1, 0, 1, 3, 30, 200])
+        quote = make_quote(start, end, 5)
+        quote["quote_type"] = rng.choice(["QCQSV", "QCQVS", "CSV", "SVC", "Heuristic"])
+        quotes.append(quote)
+    result = extractor.index_qcqsv_or_qcqvs_csv(sents, quotes)
+    for sent, quote in zip(sents, result):
+        found, expected = reference_is_qcqsv_or_qcqvs_csv(sent, quotes)
+        assert found == (quote is not None)
+        assert quote is expected
+
+
+def reference_extract_heuristic_quotes(extractor, doc):
+    """Previous token-by-token implementation of QuoteExtractor.extract_heuristic_quotes"""
+
+    def get_closest_verb(doc, sent, doc_len, threshold=5):
+        for i in range(sent.start - 1, sent.start - threshold, -1):
+            if doc[i].pos_ == "VERB" and doc[i].text not in ("is", "was", "be"):
+                return doc[i]
+            elif doc[i].text in [".", '"']:
+                break
+        for i in range(sent.end, min(sent.end + threshold, doc_len), 1):
+            if doc[i].pos_ == "VERB" and doc[i].text not in ("is", "was", "be"):
+                return doc[i]
+            elif doc[i].text in [".", '"']:
+                break
+        return None
+
+    quote_list = []
+    quote = False
+    for word in doc:
+        if str(word) == '"':
+            if not quote:
+                start = word.i
+                quote = True
+            else:
+                sent = doc[start : word.i + 1]
+                verb = get_closest_verb(doc, sent, len(doc))
+                if verb is None:
+                    verb, verb_span, speaker, speaker_span = "", None, "", (0, 0)
+                else:
+                    speaker = extractor.get_closest_speaker(verb)
+                    if speaker:
+                        speaker_span = extractor.get_char_span(speaker)
+                        speaker = speaker.text
+                    else:
+                        speaker_span = (0, 0)
+                        speaker = ""
+                    verb_span = extractor.get_char_span(verb)
+                    verb = verb.text
+                if len(sent) > 6 and len(sent) < 100:
+                    quote_list.append(
+                        {
+                            "speaker": speaker,
+                            **utils.span_fields("speaker", speaker_span),
+                            "quote": str(sent),
+                            **utils.span_fields("quote", extractor.get_char_span(sent)),
+                            "verb": verb,
+                            **utils.span_fields("verb", verb_span),
+                            "quote_token_count": len(sent),
+                            "quote_type": "Heuristic",
+                            "is_floating_quote": False,
+                        }
+                    )
+                quote = False
+    return quote_list
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_extract_heuristic_quotes_matches_reference(extractor, seed):
+    rng = random.Random(seed)
+    words = [rng.choice(['"', '"', ".", "is", "said", "told", "the", "minister"]) for _ in range(rng.randint(4, 150))]
+    doc = Doc(extractor.nlp.vocab, words=words)
+    for token in doc:
+        token.pos_ = rng.choice(["VERB", "NOUN", "PUNCT"])
+    expected = reference_extract_heuristic_quotes(extractor, doc)
+    assert extractor.extract_heuristic_quotes(doc) == expected
+
+
+def reference_extract_syntactic_quotes(extractor, doc):
+    """Previous token-by-token implementation of QuoteExtractor.extract_syntactic_quotes"""
+    quote_list = []
+    for word in doc:
+        if word.dep_ in ("ccomp"):
+            if (word.right_edge.i + 1) < len(doc):
+                subtree_span = doc[word.left_edge.i : word.right_edge.i + 1]
+                sent = subtree_span
+                verb = subtree_span.root.head
+                nodes_to_look_for_nsubj = [x for x in subtree_span.root.head.children] + [
+                    x for x in subtree_span.root.head.head.children
+                ]
+                for child in nodes_to_look_for_nsubj:
+                    if child.dep_ == "nsubj" and verb.text.lower() in extractor.quote_verbs:
+                        if child.right_edge.i + 1 < len(doc):
+                            speaker = doc[child.left_edge.i : child.right_edge.i + 1]
+                            quote_type = extractor.get_quote_type(doc, sent, verb, speaker, subtree_span)
+                            is_valid_speaker = str(speaker).strip().lower() not in ["i", "we"]
+                            is_valid_type = not (quote_type[0] == "Q" and quote_type[-1] == "Q")
+                            is_valid_quote = len(str(sent).strip()) > 0
+                            if is_valid_quote and is_valid_type and is_valid_speaker:
+                                quote_list.append(
+                                    {
+                                        "speaker": str(speaker),
+                                        **utils.span_fields("speaker", extractor.get_char_span(speaker)),
+                                        "quote": str(sent),
+                                        **utils.span_fields("quote", extractor.get_char_span(sent)),
+                                        "verb": str(verb),
+                                        **utils.span_fields("verb", extractor.get_char_span(verb)),
+                                        "quote_token_count": len(sent),
+                                        "quote_type": quote_type,
+                                        "is_floating_quote": False,
+                                    }
+                                )
+                            break
+        elif word.dep_ in ("prep"):
+            expression = doc[word.head.left_edge.i : word.i + 1]
+            if expression.text in ("according to", "According to"):
+                accnode = word.head
+                tonode = word
+                if accnode.i < accnode.head.i:
+                    sent = doc[accnode.right_edge.i + 1 : accnode.head.right_edge.i + 1]
+                    speaker = doc[tonode.i + 1 : accnode.right_edge.i + 1]
+                else:
+                    sent = doc[accnode.head.left_edge.i : accnode.i]
+                    speaker = doc[tonode.i + 1 : accnode.head.right_edge.i + 1]
+                quote_list.append(
+                    {
+                        "speaker": str(speaker),
+                        **utils.span_fields("speaker", extractor.get_char_span(speaker)),
+                        "quote": str(sent),
+                        **utils.span_fields("quote", extractor.get_char_span(sent)),
+                        "verb": "according to",
+                        **utils.span_fields("verb", extractor.get_char_span(expression)),
+                        "quote_token_count": len(sent),
+                        "quote_type": "AccordingTo",
+                        "is_floating_quote": False,
+                    }
+                )
+    return quote_list
+
+
+def make_parsed_doc(vocab, words, heads, deps, pos):
+    """Build a Doc with a dependency parse, given the (absolute) index of each token's head"""
+    doc = Doc(vocab, words=words)
+    rows = [[head - i, vocab.strings.add(dep)] for i, (head, dep) in enumerate(zip(heads, deps))]
+    doc.from_array([HEAD, DEP], numpy.array(rows, dtype="int64").astype("uint64"))
+    for token, tag in zip(doc, pos):
+        token.pos_ = tag
+    return doc
+
+
+def test_extract_syntactic_quotes_keeps_cc_candidates(extractor):
+    # `word.dep_ in ("ccomp")` was a substring test, so coordinating conjunctions ("cc") were candidates too
+    words = ["The", "minister", "said", "that", "taxes", "will", "rise", "and", "told", "reporters", "."]
+    heads = [1, 2, 2, 6, 6, 6, 2, 2, 2, 8, 2]
+    deps = ["det", "nsubj", "ROOT", "mark", "nsubj", "aux", "ccomp", "cc", "conj", "dobj", "punct"]
+    pos = ["DET", "NOUN", "VERB", "SCONJ", "NOUN", "AUX", "VERB", "CCONJ", "VERB", "NOUN", "PUNCT"]
+    doc = make_parsed_doc(extractor.nlp.vocab, words, heads, deps, pos)
+    quotes = extractor.extract_syntactic_quotes(doc)
+    assert quotes == reference_extract_syntactic_quotes(extractor, doc)
+    assert [(quote["quote"], quote["speaker"], quote["verb"]) for quote in quotes] == [
+        ("that taxes will rise", "The minister", "said"),
+        ("and", "The minister", "said"),
+    ]
+
+
+def test_extract_syntactic_quotes_finds_according_to(extractor):
+    words = ["Taxes", "will", "rise", ",", "according", "to", "the", "minister", "."]
+    heads = [2, 2, 2, 2, 2, 4, 7, 5, 2]
+    deps = ["nsubj", "aux", "ROOT", "punct", "prep", "prep", "det", "pobj", "punct"]
+    pos = ["NOUN", "AUX", "VERB", "PUNCT", "VERB", "ADP", "DET", "NOUN", "PUNCT"]
+    doc = make_parsed_doc(extractor.nlp.vocab, words, heads, deps, pos)
+    quotes = extractor.extract_syntactic_quotes(doc)
+    assert quotes == reference_extract_syntactic_quotes(extractor, doc)
+    assert [(quote["quote"], quote["speaker"], quote["quote_type"]) for quote in quotes] == [
+        ("Taxes will rise ,", "the minister .", "AccordingTo")
+    ]
+
+
+def random_parsed_sentence(rng):
+    """Return the (word, name, head name, dep) of the tokens of a random sentence with a quote"""
+    subject = rng.choice([["the", "minister"], ["I"], ["we"]])
+    form = rng.choice(["SVC", "CSV", "AccordingTo", "ToAccording"])
+    speaker_head, speaker_dep = ("verb", "nsubj") if form in ("SVC", "CSV") else ("to", "pobj")
+    speaker = [(word, None, "speaker", "det") for word in subject[:-1]] + [(subject[-1], "speaker", speaker_head, speaker_dep)]
+    clause_head, clause_dep = ("verb", rng.choice(["ccomp", "cc", "conj"])) if form in ("SVC", "CSV") else ("clause", "ROOT")
+    clause = [("taxes", None, "clause", "nsubj"), ("will", None, "clause", "aux"), ("rise", "clause", clause_head, clause_dep)]
+    if rng.random() < 0.5:
+        clause = [('"', None, "clause", "punct")] + clause + [('"', None, "clause", "punct")]
+    verb = [(rng.choice(["said", "told", "rose"]), "verb", "verb", "ROOT")]
+    according = [(rng.choice(["according", "According"]), "according", "clause", "prep"), ("to", "to", "according", "prep")]
+    root = "clause" if form in ("AccordingTo", "ToAccording") else "verb"
+    tokens = {
+        "SVC": speaker + verb + clause,
+        "CSV": clause + [(",", None, "verb", "punct")] + speaker + verb,
+        "AccordingTo": clause + [(",", None, "clause", "punct")] + according + speaker,
+        "ToAccording": according + speaker + [(",", None, "clause", "punct")] + clause,
+    }[form]
+    return tokens + [(".", None, root, "punct")]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_extract_syntactic_quotes_matches_reference(extractor, seed):
+    rng = random.Random(seed)
+    labels = ["ccomp", "cc", "prep", "nsubj", "dobj", "conj", "det", "pobj", "punct"]
+    words, heads, deps = [], [], []
+    for _ in range(rng.randint(1, 6)):
+        tokens = random_parsed_sentence(rng)
+        positions = {name: len(words) + i for i, (_, name, _, _) in enumerate(tokens) if name}
+        for word, _, head, dep in tokens:
+            words.append(word)
+            heads.append(positions[head])
+            # Mislabel some tokens, as the parser does
+            deps.append(rng.choice(labels) if dep != "ROOT" and rng.random() < 0.1 else dep)
+    pos = [rng.choice(["VERB", "NOUN", "ADP", "PUNCT"]) for _ in words]
+    doc = make_parsed_doc(extractor.nlp.vocab, words, heads, deps, pos)
+    expected = reference_extract_syntactic_quotes(extractor, doc)
+    assert extractor.extract_syntactic_quotes(doc) == expected
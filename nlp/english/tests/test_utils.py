@@ -0,0 +1,282 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pymongo")
+
+import utils
+from pymongo.errors import BulkWriteError
+
+RULES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rules")
+
+
+def test_span_fields_round_trip():
+    quote = {**utils.span_fields("quote", (12, 40)), **utils.span_fields("speaker")}
+    assert quote["quote_index"] == "(12,40)"
+    assert utils.get_span(quote, "quote") == (12, 40)
+    assert quote["speaker_index"] == ""
+    assert utils.get_span(quote, "speaker") is None
+
+
+def test_get_span_reads_legacy_index_strings():
+    quote = {"quote_index": "(123,127)", "speaker_index": "", "verb_index": "(0,0)"}
+    assert utils.get_span(quote, "quote") == (123, 127)
+    assert utils.get_span(quote, "speaker") is None
+    assert utils.get_span(quote, "verb") == (0, 0)
+
+
+def test_span_index_returns_first_added_overlapping_span():
+    index = utils.SpanIndex([((30, 40), "a"), ((0, 100), "b"), ((35, 36), "c"), ((38, 38), "d")])
+    assert index.overlapping((34, 39)) == ["a", "b", "c"]
+    assert index.overlapping((34, 39), min_overlap=2) == ["a", "b"]
+    assert index.first_overlapping((39, 45), min_overlap=2) == "b"
+    assert index.first_overlapping((100, 120)) is None
+
+
+def test_histogram_percentiles_are_within_one_bucket():
+    histogram = utils.Histogram()
+    for value in [0] + list(range(1, 1000)):
+        histogram.add(value)
+    assert histogram.count == 1000
+    assert histogram.percentile(0) == 0.0
+    assert 500 <= histogram.percentile(50) <= 500 * 2 ** 0.25
+    assert histogram.percentile(100) == 999
+
+
+def test_stage_profiler_merges_stats_across_profilers():
+    worker = utils.StageProfiler(keep_docs=True)
+    for parsed in worker.time_iter("parse", ["a", "b"]):
+        worker.start_doc(parsed)
+        with worker.time("syntactic"):
+            pass
+        worker.record("quotes", 2)
+        worker.end_doc()
+    stats = worker.pop_stats()
+    assert [doc["id"] for doc in stats["docs"]] == ["a", "b"]
+    assert set(stats["docs"][0]) == {"id", "parse_ms", "syntactic_ms", "quotes"}
+
+    main = utils.StageProfiler()
+    main.merge(stats)
+    main.merge(stats)
+    assert main.histograms["quotes"].count == 4
+    assert len(main.summary()) == 3
+    assert utils.StageProfiler(enabled=False).pop_stats() is None
+
+
+def test_stage_profiler_combines_windows_into_one_document():
+    profiler = utils.StageProfiler(keep_docs=True)
+    profiler.start_doc("long")
+    with profiler.combine():
+        for quotes_found in [3, 4]:
+            profiler.record("quotes_found", quotes_found)
+    profiler.record("quotes", 6)
+    profiler.end_doc()
+    stats = profiler.pop_stats()
+    assert stats["docs"] == [{"id": "long", "quotes_found": 7, "quotes": 6}]
+    assert stats["histograms"]["quotes_found"].count == 1
+
+
+class RecordingCollection:
+    """Stands in for a collection, recording the size of its bulk writes, which fail while `failing` is set"""
+
+    def __init__(self, name):
+        self.name = name
+        self.writes = []
+        self.failing = False
+
+    def bulk_write(self, operations, ordered=True):
+        self.writes.append(len(operations))
+        if self.failing:
+            raise BulkWriteError({"writeErrors": [{"index": i, "errmsg": "failed"} for i in range(len(operations))]})
+
+
+def test_bulk_writer_only_commits_written_chunks():
+    media, other = RecordingCollection("media"), RecordingCollection("other")
+    writer = utils.BulkWriter(media, max_ops=3, max_seconds=60)
+    other_writer = writer.for_collection(other)
+    writer.insert_one({"_id": 1})
+    other_writer.insert_one({"_id": 2})
+    writer.mark("chunk 1")
+    # A chunk is only committed once all of its writes are flushed, in one bulk write per collection
+    assert writer.pop_committed() == []
+    writer.insert_one({"_id": 3})
+    assert (media.writes, other.writes) == ([2], [1])
+    assert writer.pop_committed() == ["chunk 1"]
+    writer.insert_one({"_id": 4})
+    writer.mark("chunk 2")
+    assert writer.close() == 0
+    assert writer.pop_committed() == ["chunk 2"]
+    # Chunks with failed writes are not committed, even if the writes failed before the chunk ended
+    other.failing = True
+    other_writer.insert_one({"_id": 5})
+    assert writer.close() == 1
+    writer.insert_one({"_id": 6})
+    writer.mark("chunk 3")
+    assert writer.close() == 0
+    writer.mark("chunk 4")
+    other_writer.insert_one({"_id": 7})
+    writer.mark("chunk 5")
+    assert writer.close() == 1
+    assert writer.pop_committed() == ["chunk 4"]
+    assert (writer.num_written, writer.num_failed) == (5, 2)
+
+
+def test_bulk_writer_does_not_commit_chunks_with_failed_documents():
+    writer = utils.BulkWriter(RecordingCollection("media"), max_ops=10, max_seconds=60)
+    writer.insert_one({"_id": 1})
+    writer.mark("chunk 1", num_failed=1)
+    writer.mark("chunk 2", num_failed=1)
+    writer.insert_one({"_id": 2})
+    writer.mark("chunk 3")
+    assert writer.close() == 0
+    assert writer.pop_committed() == ["chunk 3"]
+
+
+def test_run_checkpoint_is_not_finished_while_chunks_are_pending():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient()["mediaTracker"]["runCheckpoints"]
+    checkpoint = utils.RunCheckpoint(collection, "quote_extractor", {"outlets": None})
+    checkpoint.start()
+    chunks = list(checkpoint.track([[1, 2], [3, 4], [5, 6]]))
+    checkpoint.mark_done(2)
+    checkpoint.mark_done(6)
+    # The writes of the second chunk failed, so the run can only be resumed after its first chunk
+    assert not checkpoint.finish()
+    assert checkpoint.last_committed_id() == 2
+    checkpoint.mark_done(4)
+    assert checkpoint.finish()
+    assert checkpoint.last_committed_id() is None
+    assert len(chunks) == 3
+
+
+def test_length_scheduler_balances_chunks_longest_first():
+    id_lengths = [(i, length) for i, length in enumerate([20000, 20000, 15000] + [500] * 57)]
+    scheduler = utils.LengthScheduler(id_lengths, chunksize=20, overhead=500)
+    chunks = list(scheduler.chunks())
+    assert len(chunks) == 3
+    assert sorted(doc_id for chunk in chunks for doc_id in chunk) == list(range(60))
+    work = [scheduler.work[chunk[0]] for chunk in chunks]
+    assert work == sorted(work, reverse=True)
+    assert max(work) - min(work) <= 20000 + 500
+    # Each of the longest articles is in a separate chunk
+    assert all(len({0, 1, 2} & set(chunk)) == 1 for chunk in chunks)
+
+
+def test_split_windows_covers_text_with_overlapping_paragraphs():
+    paragraphs = [f"Paragraph {i} has a few words in it.\n" for i in range(20)]
+    text = "".join(paragraphs)
+    windows = utils.split_windows(text, max_length=120)
+    assert all(len(window) <= 120 and text[offset : offset + len(window)] == window for offset, window in windows)
+    assert windows[0][0] == 0
+    assert windows[-1][0] + len(windows[-1][1]) == len(text)
+    for (offset, window), (next_offset, _) in zip(windows, windows[1:]):
+        # Each window starts with the last paragraph of the window before it
+        assert offset < next_offset < offset + len(window)
+        assert window.endswith(text[next_offset : offset + len(window)])
+    assert utils.split_windows("Short text.", max_length=120) == [(0, "Short text.")]
+
+
+def test_shift_quote_keeps_placeholder_spans():
+    quote = {
+        "speaker": "",
+        **utils.span_fields("speaker", (0, 0)),
+        "quote": '"A heuristic quote without a speaker."',
+        **utils.span_fields("quote", (10, 48)),
+        "verb": "",
+        **utils.span_fields("verb"),
+    }
+    utils.shift_quote(quote, 1000)
+    assert utils.get_span(quote, "quote") == (1010, 1048)
+    assert quote["quote_index"] == "(1010,1048)"
+    assert utils.get_span(quote, "speaker") == (0, 0)
+    assert utils.get_span(quote, "verb") is None
+
+
+def test_preprocess_text_normalizes_in_one_pass():
+    text = "“Jean Chrétien,” said François\xa0Legault.\nDoğḡan ŞAHİN wrote.\n\nA raw\\nline"
+    assert utils.preprocess_text(text) == (
+        '"Jean Chretien," said Francois Legault.\n Dogan SAHIN wrote.\n .\n A raw line'
+    )
+    assert utils.remove_accents("Valérie ĞḠ Ğ") == "Valerie G Ğ"
+    assert utils.remove_titles("Dr Jane Smith MBE") == "Jane Smith"
+
+
+class RecordingNLP:
+    """Stands in for a spaCy pipeline, recording the texts it is asked to parse. Its NER finds the
+    given entities (text: label) in each text.
+    """
+
+    def __init__(self, entities=None):
+        self.entities = entities or {}
+        self.texts = []
+
+    def pipe(self, texts, disable=None):
+        for text in texts:
+            self.texts.append(text)
+            ents = [Entity(ent, label) for ent, label in self.entities.items() if ent in text]
+            yield SimpleNamespace(text=text, ents=ents)
+
+
+class Entity(str):
+    """A named entity, whose length is its number of tokens"""
+
+    def __new__(cls, text, label):
+        entity = super().__new__(cls, text)
+        entity.text = text
+        entity.label_ = label
+        return entity
+
+    def __len__(self):
+        return len(self.text.split())
+
+
+def test_clean_authors_caches_names_found_by_ner():
+    nlp = RecordingNLP({"Jane Doe": "PERSON", "Canadian Press": "ORG", "Global News": "ORG", "Sam": "PERSON"})
+    cleaner = utils.CleanAuthors(nlp)
+    blocklist = {"Staff"}
+    authors = ["By Jane Doe", "Global News", "Jane Doe, The Canadian Press", "Canadian Press Staff", "Sam"]
+    # Only person names of more than one token are authors, as before
+    assert cleaner.clean(authors, blocklist) == ["Jane Doe"]
+    # Author strings with blocklisted words are not run through spaCy
+    assert nlp.texts == ["By Jane Doe", "Global News", "Jane Doe, The Canadian Press", "Sam"]
+    assert (cleaner.hits, cleaner.misses) == (0, 5)
+    assert cleaner.clean(authors, blocklist) == ["Jane Doe"]
+    assert len(nlp.texts) == 4
+    assert (cleaner.hits, cleaner.misses) == (5, 5)
+
+
+def test_clean_authors_resolves_outlet_bylines_without_spacy():
+    # NER would take any of these for people
+    nlp = RecordingNLP({"Jane Doe": "PERSON", "Global News": "PERSON", "Associated Press": "PERSON", "Sam Roe": "PERSON"})
+    cleaner = utils.CleanAuthors(nlp)
+    blocklist = utils.get_author_blocklist(os.path.join(RULES_DIR, "author_blocklist.txt"))
+    authors = [
+        "By Jane Doe, The Canadian Press",
+        "Global News",
+        "Associated Press",
+        "By Global News, The Canadian Press",
+        "By Associated Press, Reuters",
+        "By Sam Roe, Jane Doe",
+    ]
+    assert cleaner.clean(authors, blocklist) == ["Jane Doe", "Sam Roe"]
+    # Only the byline whose "outlet" isn't blocklisted is run through spaCy
+    assert nlp.texts == ["By Sam Roe, Jane Doe"]
+
+
+def test_clean_authors_de_duplicate_keeps_shortest_names():
+    cleaner = utils.CleanAuthors(RecordingNLP())
+    assert cleaner.de_duplicate(["Jane Doe", "Jane Doe Smith", "John Roe"]) == ["Jane Doe", "John Roe"]
+
+
+def test_token_bucket_limits_rate():
+    bucket = utils.TokenBucket(rate=50, capacity=2)
+    start = time.monotonic()
+    for _ in range(7):
+        bucket.acquire()
+    # The first two calls use up the burst capacity, the other five wait for new tokens
+    assert time.monotonic() - start >= 0.09
+    unlimited = utils.TokenBucket(rate=0)
+    for _ in range(1000):
+        unlimited.acquire()
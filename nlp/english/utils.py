@@ -1,6 +1,14 @@
+import bisect
+import hashlib
+import heapq
 import logging
+import math
 import os
 import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 from logging.handlers import TimedRotatingFileHandler
@@ -9,6 +17,8 @@ from urllib.request import urlparse
 import pymongo
 import json
 from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from typing import List, Dict
 
 
@@ -23,44 +33,100 @@ def get_author_blocklist(author_blocklist_file):
 class CleanAuthors:
     """Class containing methods to process and clean author names as valid
     person names.
+    Author strings are resolved in tiers: the names found in an author string are cached (most
+    outlets have a small set of recurring authors), bylines of a person's name and a blocklisted
+    outlet (e.g., "By Jane Doe, The Canadian Press") are resolved by a rule, other author strings
+    with blocklisted words are skipped, and only the remaining author strings are run through NER.
     """
 
-    def __init__(self, nlp):
+    # Bylines with an outlet: "By", two or three capitalized name parts, a comma and the outlet
+    NAME_PART = r"(?!(?:By|And|The|Of|For|From|With|In|At)\b)[A-Z][a-z]*(?:[-'][A-Z][a-z]+)*"
+    OUTLET_BYLINE = re.compile(r"By\s+((?:{0}\s+){{1,2}}{0})\s*,\s*(\S.*)".format(NAME_PART))
+
+    def __init__(self, nlp, cache_size=10000):
         self.nlp = nlp
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_blocklist = None
+        self.hits = 0
+        self.misses = 0
 
     def get_valid_names(self, author_list, blocklist):
         "Return a list of clean author names that do not have blocklisted words"
         if not isinstance(author_list, list):
             author_list = [str(author_list)]  # Authors must be of type list
+        if blocklist is not self.cache_blocklist:
+            # Names cached for another blocklist may not be valid anymore
+            self.cache.clear()
+            self.cache_blocklist = blocklist
 
-        authors = set()
-        for doc in self.nlp.pipe(
-            author_list, disable=["tagger", "parser", "neuralcoref"]
-        ):
-            if not self.contains_blocklist(doc.text, blocklist):
-                not_blocklist = [
-                    tok
-                    for tok in doc.ents
-                    if not self.contains_blocklist(tok.text, blocklist)
-                ]
-                for ent in not_blocklist:
-                    if ent.label_ == "PERSON" and len(ent) > 1:
-                        authors.add(ent.text)
+        authors = {}
+        uncached = []
+        for author in author_list:
+            names = self.cache.get(author)
+            if names is not None:
+                self.cache.move_to_end(author)
+                self.hits += 1
+                authors.update(dict.fromkeys(names))
+                continue
+            self.misses += 1
+            names = self.get_byline_name(author, blocklist)
+            if names:
+                self.cache_names(author, names)
+                authors.update(dict.fromkeys(names))
+                continue
+            if self.contains_blocklist(author, blocklist):
+                self.cache_names(author, ())
+                continue
+            uncached.append(author)
+
+        # Only author strings that are not cached are run through spaCy's NER
+        uncached = list(dict.fromkeys(uncached))
+        docs = self.nlp.pipe(uncached, disable=["tagger", "parser", "neuralcoref"])
+        for author, doc in zip(uncached, docs):
+            names = tuple(
+                ent.text
+                for ent in doc.ents
+                if ent.label_ == "PERSON" and len(ent) > 1 and not self.contains_blocklist(ent.text, blocklist)
+            )
+            self.cache_names(author, names)
+            authors.update(dict.fromkeys(names))
         clean_authors = list(authors)
         return clean_authors
 
+    def get_byline_name(self, author, blocklist):
+        """Return the name in a byline of a person's name and an outlet, if the outlet has a blocklisted word
+        (so that it is not a person) and the name doesn't. Otherwise, the author string is left to NER.
+        """
+        byline = self.OUTLET_BYLINE.fullmatch(author.strip())
+        if byline is None:
+            return ()
+        name, outlet = byline.groups()
+        if self.contains_blocklist(outlet, blocklist) and not self.contains_blocklist(name, blocklist):
+            return (" ".join(name.split()),)
+        return ()
+
+    def cache_names(self, author, names):
+        "Store the names found in an author string, evicting the least recently seen author string"
+        self.cache[author] = names
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
     def contains_blocklist(self, parent, blocklist):
         "Identify if a given author name contains a word from the blocklist."
-        return any(token in parent.split() for token in blocklist)
+        if not isinstance(blocklist, (set, frozenset)):
+            blocklist = set(blocklist)
+        return not blocklist.isdisjoint(parent.split())
 
     def de_duplicate(self, authors):
         "If an author name is a subset of another author name, keep only the subset."
+        lowered = [(author, author.lower()) for author in set(authors)]
         repeated = set()
-        for author1 in authors:
-            for author2 in authors:
-                if author1.lower() in author2.lower() and author1 != author2:
+        for author1, lower1 in lowered:
+            for author2, lower2 in lowered:
+                if len(lower1) <= len(lower2) and author1 != author2 and lower1 in lower2:
                     repeated.add(author2)
-        return list(set(authors) - repeated)
+        return [author for author in dict.fromkeys(authors) if author not in repeated]
 
     def clean_author_ne(self, author_list):
         "Clean author names by removing extra spaces and symbols"
@@ -104,6 +170,41 @@ def string_contains_digit(inputString):
     return bool(re.search(r"\d", inputString))
 
 
+# Accented characters and their regular English equivalents
+ACCENT_TABLE = str.maketrans(
+    {
+        **dict.fromkeys("àáâãäåā", "a"),
+        **dict.fromkeys("èéêëē", "e"),
+        **dict.fromkeys("ìíîïıī", "i"),
+        **dict.fromkeys("òóôõöō", "o"),
+        **dict.fromkeys("ùúûüū", "u"),
+        **dict.fromkeys("ýÿȳ", "y"),
+        "ç": "c",
+        "ñ": "n",
+        "ş": "s",
+        # Capitals
+        **dict.fromkeys("ÀÁÂÃÄÅĀ", "A"),
+        **dict.fromkeys("ÈÉÊËĒ", "E"),
+        **dict.fromkeys("ÌÍÎÏİĪ", "I"),
+        **dict.fromkeys("ÒÓÔÕÖŌ", "O"),
+        **dict.fromkeys("ÙÚÛÜŪ", "U"),
+        **dict.fromkeys("ÝŸȲ", "Y"),
+        "Ç": "C",
+        "Ñ": "N",
+        "Ş": "S",
+    }
+)
+# Character replacements applied by preprocess_text in a single pass: non-breaking spaces,
+# accents and double quotes (none of which are affected by the newline fixes in between)
+PREPROCESS_TABLE = str.maketrans(
+    {
+        **{chr(k): v for k, v in ACCENT_TABLE.items()},
+        "\xa0": " ",
+        **dict.fromkeys("”“〝〞", '"'),
+    }
+)
+
+
 def remove_accents(txt):
     """Certain outlets (CTV News) do not use accented characters in person names.
     Others (CBC News and Global news), always use accented characters in names.
@@ -114,89 +215,82 @@ def remove_accents(txt):
      * Valérie Plante <-> Valerie Plante
      * Jean Chrétien <-> Jean Chretien
     """
-    txt = re.sub("[àáâãäåā]", "a", txt)
-    txt = re.sub("[èéêëē]", "e", txt)
-    txt = re.sub("[ìíîïıī]", "i", txt)
-    txt = re.sub("[òóôõöō]", "o", txt)
-    txt = re.sub("[ùúûüū]", "u", txt)
-    txt = re.sub("[ýÿȳ]", "y", txt)
-    txt = re.sub("ç", "c", txt)
-    txt = re.sub("ğḡ", "g", txt)
-    txt = re.sub("ñ", "n", txt)
-    txt = re.sub("ş", "s", txt)
-
-    # Capitals
-    txt = re.sub("[ÀÁÂÃÄÅĀ]", "A", txt)
-    txt = re.sub("[ÈÉÊËĒ]", "E", txt)
-    txt = re.sub("[ÌÍÎÏİĪ]", "I", txt)
-    txt = re.sub("[ÒÓÔÕÖŌ]", "O", txt)
-    txt = re.sub("[ÙÚÛÜŪ]", "U", txt)
-    txt = re.sub("[ÝŸȲ]", "Y", txt)
-    txt = re.sub("Ç", "C", txt)
-    txt = re.sub("ĞḠ", "G", txt)
-    txt = re.sub("Ñ", "N", txt)
-    txt = re.sub("Ş", "S", txt)
+    return replace_accent_pairs(txt.translate(ACCENT_TABLE))
+
+
+def replace_accent_pairs(txt):
+    """The breve and macron g's are only replaced when they appear together (as "ğḡ" or "ĞḠ"),
+    as they always were in remove_accents, so they are not part of the translation table.
+    """
+    if "ğḡ" in txt:
+        txt = txt.replace("ğḡ", "g")
+    if "ĞḠ" in txt:
+        txt = txt.replace("ĞḠ", "G")
     return txt
 
 
+TITLE_PATTERN = re.compile(
+    r"\b({})\b".format(
+        r"|".join(
+            [
+                # Honorifics
+                "Mr",
+                "Ms",
+                "Mrs",
+                "Miss",
+                "Dr",
+                "Sir",
+                "Dame",
+                "Hon",
+                "Professor",
+                "Prof",
+                "Rev",
+                # Titles
+                "QC",
+                "CBE",
+                "MBE",
+                "BM",
+                "MD",
+                "DM",
+                "BHB",
+                "CBC",
+                "Reverend",
+                "Recorder",
+                "Headteacher",
+                "Councillor",
+                "Cllr",
+                "Father",
+                "Fr",
+                "Mother",
+                "Grandmother",
+                "Grandfather",
+                "Creator",
+                # Extras
+                "et al",
+                "www",
+                "href",
+                "http",
+                "https",
+                "Ref",
+                "rel",
+                "eu",
+                "span",
+                "Rd",
+                "St",
+            ]
+        )
+    )
+)
+
+
 def remove_titles(txt):
     """Method to clean special titles that appear as prefixes or suffixes to
     people's names (common especially in articles from British/European sources).
     The words that are marked as titles are chosen such that they can never appear
     in any form as a person's name (e.g., "Mr", "MBE" or "Headteacher").
     """
-    honorifics = [
-        "Mr",
-        "Ms",
-        "Mrs",
-        "Miss",
-        "Dr",
-        "Sir",
-        "Dame",
-        "Hon",
-        "Professor",
-        "Prof",
-        "Rev",
-    ]
-    titles = [
-        "QC",
-        "CBE",
-        "MBE",
-        "BM",
-        "MD",
-        "DM",
-        "BHB",
-        "CBC",
-        "Reverend",
-        "Recorder",
-        "Headteacher",
-        "Councillor",
-        "Cllr",
-        "Father",
-        "Fr",
-        "Mother",
-        "Grandmother",
-        "Grandfather",
-        "Creator",
-    ]
-    extras = [
-        "et al",
-        "www",
-        "href",
-        "http",
-        "https",
-        "Ref",
-        "rel",
-        "eu",
-        "span",
-        "Rd",
-        "St",
-    ]
-    banned_words = r"|".join(honorifics + titles + extras)
     # Ensure only whole words are replaced (\b is word boundary)
-    pattern = re.compile(r"\b({})\b".format(banned_words))
-    txt = pattern.sub("", txt)
-    return txt.strip()
+    return TITLE_PATTERN.sub("", txt).strip()
 
 
 # ========== Text Processing functions ==========
@@ -206,41 +300,484 @@ def preprocess_text(txt):
     """Apply a series of cleaning operations to news text to better process
     quotes and named entities downstream.
     """
-    # Fix non-breaking space in unicode
-    txt = txt.replace(u"\xa0", u" ")
-    # Remove accents to normalize names and get more accurate source counts
-    txt = remove_accents(txt)
+    # Fix non-breaking space in unicode, remove accents to normalize names and get more
+    # accurate source counts, and normalize double quotes
+    txt = replace_accent_pairs(txt.translate(PREPROCESS_TABLE))
+    # NOTE: We keep single quotes for now as they are very common outside quotes
 
     # # Remove titles and honorifics to reduce ambiguity for gender prediction
     # # Currently deactivated because it did not help improve F1-scores in our Canadian news data
     # txt = remove_titles(txt)
 
-    # To fix the problem of not breaking at \n
-    txt = txt.replace("\n", ".\n ")
-    # To remove potential duplicate dots
-    txt = txt.replace("..\n ", ".\n ")
-    txt = txt.replace(". .\n ", ".\n ")
+    if "\n" in txt:
+        # To fix the problem of not breaking at \n
+        txt = txt.replace("\n", ".\n ")
+        # To remove potential duplicate dots
+        txt = txt.replace("..\n ", ".\n ")
+        txt = txt.replace(". .\n ", ".\n ")
     txt = txt.replace("  ", " ")
     # Fix newlines for raw string literals
-    txt = txt.replace("\\n", " ")
-    txt = txt.replace("\\n\\n", " ")
-    # Normalize double quotes
-    txt = txt.replace("”", '"')
-    txt = txt.replace("“", '"')
-    txt = txt.replace("〝", '"')
-    txt = txt.replace("〞", '"')
-    # NOTE: We keep single quotes for now as they are very common outside quotes
-    # txt = txt.replace("‘", "'")
-    # txt = txt.replace("’", "'")
+    if "\\n" in txt:
+        txt = txt.replace("\\n", " ")
     return txt
 
 
+def split_windows(txt, max_length, overlap=1):
+    """Split a long (preprocessed) text into windows of whole paragraphs with at most `max_length`
+    characters, so that each window can be processed separately. Every window repeats the last
+    `overlap` paragraph(s) of the window before it, so that quotes and named entities near the
+    boundary of a window are also seen together with their context in the next one. Paragraphs
+    longer than `max_length` are split after the last sentence that fits.
+    Returns a list of (offset of the window in the text, window text).
+    """
+    # (start, end) offsets of the paragraphs, including their newline
+    paragraphs = []
+    start = 0
+    for match in re.finditer("\n", txt):
+        paragraphs.append((start, match.end()))
+        start = match.end()
+    if start < len(txt):
+        paragraphs.append((start, len(txt)))
+    pieces = []
+    for start, end in paragraphs:
+        while end - start > max_length:
+            cut = txt.rfind(". ", start, start + max_length)
+            cut = cut + 2 if cut != -1 else start + max_length
+            pieces.append((start, cut))
+            start = cut
+        pieces.append((start, end))
+
+    windows = []
+    i = 0
+    while i < len(pieces):
+        start = pieces[i][0]
+        j = i
+        while j + 1 < len(pieces) and pieces[j + 1][1] - start <= max_length:
+            j += 1
+        windows.append((start, txt[start : pieces[j][1]]))
+        if j + 1 == len(pieces):
+            break
+        # Always move forward, even if the window holds fewer paragraphs than the overlap
+        i = max(j + 1 - overlap, i + 1)
+    return windows or [(0, txt)]
+
+
+# ========== Span comparison functions ==========
+def span_overlap(span_1, span_2):
+    """Return the number of characters that two (start, end) character spans have in common"""
+    return max(0, min(span_1[1], span_2[1]) - max(span_1[0], span_2[0]))
+
+
+def has_coverage(span_1, span_2):
+    """Check if span_1 has at least two overlapping characters with span_2"""
+    return span_overlap(span_1, span_2) >= 2
+
+
+def span_fields(name, span=None):
+    """Return the fields that store a (start, end) character span in a quote object: the integer
+    `<name>_start` and `<name>_end` fields, and the legacy "(start,end)" `<name>_index` string.
+    An empty span (None) is stored as None and "" respectively.
+    """
+    if span is None:
+        return {f"{name}_index": "", f"{name}_start": None, f"{name}_end": None}
+    start, end = span
+    return {f"{name}_index": f"({start},{end})", f"{name}_start": start, f"{name}_end": end}
+
+
+def get_span(quote, name):
+    """Return the (start, end) character span of a quote object's `name` field ("quote", "speaker"
+    or "verb") as integers, or None if it's empty. Quotes written before the integer fields were
+    added only have the "(start,end)" `<name>_index` string, which is parsed instead.
+    """
+    start = quote.get(f"{name}_start")
+    if start is not None:
+        return start, quote[f"{name}_end"]
+    index = quote.get(f"{name}_index")
+    if not index:
+        return None
+    start, end = index.strip("()").split(",")
+    return int(start), int(end)
+
+
+def shift_quote(quote, offset):
+    """Shift the character spans of a quote object by an offset, e.g., from a window of a text to the
+    whole text. The spans of empty fields (like the "(0,0)" speaker of heuristic quotes that have no
+    speaker) are placeholders, and are left as they are.
+    """
+    for name in ("quote", "speaker", "verb"):
+        span = get_span(quote, name)
+        if span is not None and quote.get(name):
+            quote.update(span_fields(name, (span[0] + offset, span[1] + offset)))
+    return quote
+
+
+class SpanIndex:
+    """Sorted index of (start, end) character spans, each with an associated value, to quickly
+    find which spans overlap a given span. Overlapping values are returned in the order in which
+    their spans were added, so the first one is the same as that found by a linear scan.
+    """
+
+    def __init__(self, spans_with_values=()):
+        # Empty spans can never overlap another span, so they aren't indexed
+        items = [
+            (start, end, order, value)
+            for order, ((start, end), value) in enumerate(spans_with_values)
+            if end > start
+        ]
+        items.sort(key=lambda item: item[0])
+        self.items = items
+        self.starts = [item[0] for item in items]
+        self.max_length = max((end - start for start, end, _, _ in items), default=0)
+
+    def overlapping(self, span, min_overlap=1):
+        """Return the values of all indexed spans that share at least `min_overlap` characters with a span"""
+        start, end = span
+        # An indexed span can only overlap enough if it starts within this window
+        lo = bisect.bisect_left(self.starts, start + min_overlap - self.max_length)
+        hi = bisect.bisect_right(self.starts, end - min_overlap)
+        matches = [
+            (order, value)
+            for item_start, item_end, order, value in self.items[lo:hi]
+            if min(end, item_end) - max(start, item_start) >= min_overlap
+        ]
+        matches.sort(key=lambda match: match[0])
+        return [value for _, value in matches]
+
+    def first_overlapping(self, span, min_overlap=1):
+        """Return the value of the first added span that shares at least `min_overlap` characters with a span"""
+        matches = self.overlapping(span, min_overlap)
+        return matches[0] if matches else None
+
+
 # ========== DB functions ==========
 def init_client(MONGO_ARGS):
     _db_client = pymongo.MongoClient(**MONGO_ARGS)
     return _db_client
 
 
+class BulkWriter:
+    """Write-behind buffer that collects write operations and sends them to the database as
+    unordered bulk writes (one per collection). The buffer is flushed once it holds `max_ops`
+    operations or `max_seconds` have passed since the last flush, and once more on close().
+
+    The update_one() and insert_one() methods mirror those of a pymongo collection, so a
+    writer can be passed to code that otherwise writes to a collection directly. Writes to
+    another collection can be buffered in the same writer with for_collection().
+
+    A writer is meant to be kept for many chunks of documents: mark() the end of each chunk,
+    and pop_committed() returns the chunks whose writes were all written without errors. Chunks
+    with failed writes are never committed, so that they are not checkpointed as done.
+    """
+
+    def __init__(self, collection, max_ops=100, max_seconds=10.0, logger=None):
+        self.collection = collection
+        self.max_ops = max_ops
+        self.max_seconds = max_seconds
+        self.logger = logger or logging.getLogger(__name__)
+        # (collection, operation) of the buffered writes
+        self.operations = []
+        self.last_flush = time.monotonic()
+        self.num_written = 0
+        self.num_failed = 0
+        # Chunks whose writes are (partly) still buffered, and chunks whose writes were all written
+        self.marks = []
+        self.committed = []
+        # Number of buffered writes of the chunk in progress, and whether any of its writes failed
+        self.unmarked_ops = 0
+        self.unmarked_failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def for_collection(self, collection):
+        """Return a writer that buffers the writes for another collection in this writer"""
+        return CollectionWriter(self, collection)
+
+    def update_one(self, filter, update, upsert=False):
+        self.add(UpdateOne(filter, update, upsert=upsert))
+
+    def insert_one(self, document):
+        self.add(InsertOne(document))
+
+    def add(self, operation, collection=None):
+        self.operations.append((collection if collection is not None else self.collection, operation))
+        self.unmarked_ops += 1
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if (
+            len(self.operations) >= self.max_ops
+            or time.monotonic() - self.last_flush >= self.max_seconds
+        ):
+            self.flush()
+
+    def mark(self, key, num_failed=0):
+        """Mark the end of a chunk (identified by `key`): the chunk is committed once all of its writes are written.
+        Chunks in which `num_failed` documents failed to be processed are not committed.
+        """
+        if num_failed:
+            self.logger.error(f"Not committing chunk {key}, as {num_failed} of its documents failed.")
+        elif self.unmarked_failed:
+            self.logger.error(f"Not committing chunk {key}, as some of its writes failed.")
+        elif self.operations:
+            self.marks.append(key)
+        else:
+            self.committed.append(key)
+        self.unmarked_ops = 0
+        self.unmarked_failed = False
+        self.flush_if_due()
+
+    def flush(self):
+        """Send all buffered operations in one unordered bulk write per collection, and log their latency and
+        failures. Return the number of failed operations.
+        """
+        self.last_flush = time.monotonic()
+        if not self.operations:
+            return 0
+        operations, self.operations = self.operations, []
+        marks, self.marks = self.marks, []
+        # Collections aren't hashable, so group the operations by the identity of their collection
+        by_collection = {}
+        for collection, operation in operations:
+            by_collection.setdefault(id(collection), (collection, []))[1].append(operation)
+        failed = 0
+        for collection, collection_operations in by_collection.values():
+            failed += self.bulk_write(collection, collection_operations)
+        self.num_written += len(operations) - failed
+        self.num_failed += failed
+        if failed:
+            if marks:
+                self.logger.error(f"Not committing chunks {marks}, as some of their writes failed.")
+            self.unmarked_failed = self.unmarked_failed or self.unmarked_ops > 0
+        else:
+            self.committed.extend(marks)
+        return failed
+
+    def bulk_write(self, collection, operations):
+        """Write operations to a collection in one unordered bulk write, and return the number of failed operations"""
+        start = time.monotonic()
+        try:
+            collection.bulk_write(operations, ordered=False)
+            failed = 0
+        except BulkWriteError as e:
+            failed = len(e.details.get("writeErrors", []))
+            for error in e.details.get("writeErrors", [])[:5]:
+                self.logger.error(f"Bulk write error: {error.get('errmsg')}")
+        except Exception:
+            failed = len(operations)
+            self.logger.exception(f"Bulk write of {len(operations)} operations failed!")
+        latency = time.monotonic() - start
+        self.logger.info(
+            f"Flushed {len(operations)} writes to {collection.name} in {latency:.3f}s ({failed} failed)"
+        )
+        return failed
+
+    def pop_committed(self):
+        """Return the chunks committed since the last call"""
+        committed, self.committed = self.committed, []
+        return committed
+
+    def close(self):
+        return self.flush()
+
+
+class CollectionWriter:
+    """Buffers the writes for a collection in a BulkWriter that is shared with other collections"""
+
+    def __init__(self, writer, collection):
+        self.writer = writer
+        self.collection = collection
+
+    def update_one(self, filter, update, upsert=False):
+        self.writer.add(UpdateOne(filter, update, upsert=upsert), self.collection)
+
+    def insert_one(self, document):
+        self.writer.add(InsertOne(document), self.collection)
+
+
+def stream_ids(collection, query, limit=0, batch_size=1000):
+    """Stream the IDs of all documents matching a query from a cursor sorted by ID, without
+    materializing the full list of IDs in memory.
+    """
+    cursor = collection.find(
+        query, {"_id": 1}, no_cursor_timeout=True, batch_size=batch_size
+    ).sort("_id", pymongo.ASCENDING)
+    if limit > 0:
+        cursor = cursor.limit(limit)
+    try:
+        for doc in cursor:
+            yield doc["_id"]
+    finally:
+        cursor.close()
+
+
+def fetch_body_lengths(collection, query, limit=0):
+    """Return the (ID, body length in characters) of all documents matching a query, sorted by ID.
+    Only the lengths are sent back from the database, not the bodies themselves.
+    """
+    pipeline = [{"$match": query}, {"$sort": {"_id": 1}}]
+    if limit > 0:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": {"length": {"$strLenCP": {"$ifNull": ["$body", ""]}}}})
+    return [(doc["_id"], doc["length"]) for doc in collection.aggregate(pipeline, allowDiskUse=True)]
+
+
+class LengthScheduler:
+    """Split documents into chunks with similar amounts of work, so that the workers of a pool
+    finish at around the same time instead of a few of them processing the longest documents
+    long after all others are done.
+
+    The work for a document is estimated as its body length plus a fixed per-document overhead.
+    Documents are assigned to chunks longest first, each to the chunk with the least work so far,
+    and the chunks are handed out in order of decreasing work. Chunks are not sorted by ID.
+    """
+
+    def __init__(self, id_lengths, chunksize, overhead=500, logger=None):
+        self.overhead = overhead
+        self.logger = logger
+        num_chunks = max(1, math.ceil(len(id_lengths) / chunksize))
+        heap = [(0, i, []) for i in range(num_chunks)]
+        for doc_id, length in sorted(id_lengths, key=lambda item: item[1], reverse=True):
+            work, i, chunk = heapq.heappop(heap)
+            chunk.append(doc_id)
+            heapq.heappush(heap, (work + length + overhead, i, chunk))
+        self._chunks = sorted(((work, chunk) for work, _, chunk in heap if chunk), key=lambda item: -item[0])
+        # Work of each chunk (identified by its first ID), and seconds of processing per unit of work so far
+        self.work = {chunk[0]: work for work, chunk in self._chunks}
+        self.total_work = 0
+        self.total_seconds = 0.0
+
+    def chunks(self):
+        for _, chunk in self._chunks:
+            yield chunk
+
+    def report(self, chunk, seconds):
+        """Log the estimated duration of a processed chunk (based on the chunks processed before it) against its actual duration"""
+        work = self.work.pop(chunk[0])
+        if self.logger:
+            if self.total_work:
+                estimate = f"{work * self.total_seconds / self.total_work:.1f}s"
+            else:
+                estimate = "n/a"
+            self.logger.info(
+                f"Chunk of {len(chunk)} articles ({work} characters of estimated work): "
+                f"estimated {estimate}, actual {seconds:.1f}s"
+            )
+        self.total_work += work
+        self.total_seconds += seconds
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """Apply a function to an iterable with Pool.imap_unordered, while never having more than
+    `max_pending` items handed to the pool at once. This bounds memory use when the iterable is
+    a lazily-evaluated stream (Pool.imap_unordered would otherwise consume it as fast as it can).
+    """
+    semaphore = threading.BoundedSemaphore(max_pending)
+    stopped = threading.Event()
+
+    def throttled():
+        for item in iterable:
+            # Wake up periodically so that the pool's task handler can exit if we stop early
+            while not semaphore.acquire(timeout=1):
+                if stopped.is_set():
+                    return
+            yield item
+
+    try:
+        for result in pool.imap_unordered(func, throttled()):
+            semaphore.release()
+            yield result
+    finally:
+        stopped.set()
+
+
+def run_timed(func, arg):
+    """Call func(arg) and return its result along with the number of seconds it took"""
+    start = time.perf_counter()
+    result = func(arg)
+    return result, time.perf_counter() - start
+
+
+class RunCheckpoint:
+    """Record the progress of a long-running pipeline run in a MongoDB collection, so that an
+    interrupted run can later be resumed where it stopped.
+
+    Runs are identified by the script name and their parameters. Documents are handed out in
+    chunks of IDs sorted in ascending order, but chunks can finish out of order, so the checkpoint
+    is the last ID of the latest chunk for which all earlier chunks were committed as well.
+    """
+
+    def __init__(self, collection, run_name, params):
+        self.collection = collection
+        self.params = params
+        params_hash = hashlib.md5(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+        self.run_id = f"{run_name}-{params_hash}"
+        self._pending = deque()
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def last_committed_id(self):
+        """Return the last committed ID of an unfinished earlier run with the same parameters (or None)"""
+        checkpoint = self.collection.find_one({"_id": self.run_id})
+        if checkpoint and not checkpoint.get("finished"):
+            return checkpoint.get("lastId")
+        return None
+
+    def start(self, last_id=None):
+        """Start (or resume, when `last_id` is given) recording the progress of this run"""
+        self.collection.update_one(
+            {"_id": self.run_id},
+            {
+                "$set": {
+                    "params": self.params,
+                    "lastId": last_id,
+                    "finished": False,
+                    "lastModified": datetime.now(),
+                }
+            },
+            upsert=True,
+        )
+
+    def track(self, chunks):
+        """Register chunks of IDs in the order in which they are handed out to the workers"""
+        for chunk in chunks:
+            with self._lock:
+                self._pending.append(chunk[-1])
+            yield chunk
+
+    def mark_done(self, last_id):
+        """Mark a chunk (identified by its last ID) as committed, and move the checkpoint
+        past all chunks that were committed without gaps before it.
+        """
+        committed_id = None
+        with self._lock:
+            self._done.add(last_id)
+            while self._pending and self._pending[0] in self._done:
+                committed_id = self._pending.popleft()
+                self._done.discard(committed_id)
+        if committed_id is not None:
+            self.collection.update_one(
+                {"_id": self.run_id},
+                {"$set": {"lastId": committed_id, "lastModified": datetime.now()}},
+            )
+
+    def finish(self):
+        """Mark the run as finished, unless some chunks were never committed (e.g., because their writes
+        failed), so that the run can still be resumed from the first of them. Returns whether it finished.
+        """
+        with self._lock:
+            if self._pending:
+                return False
+        self.collection.update_one(
+            {"_id": self.run_id},
+            {"$set": {"finished": True, "lastModified": datetime.now()}},
+        )
+        return True
+
+
 def prepare_query(filters):
     if filters["outlets"]:
         # Assumes that the user provided outlets as a comma-separated list
@@ -271,9 +808,197 @@ def prepare_query(filters):
     return query
 
 
+# ========== Profiling functions ==========
+class Histogram:
+    """Histogram of non-negative values in logarithmic buckets (4 per doubling of the value), that
+    can be merged with histograms from other processes and summarized by approximate percentiles.
+    """
+
+    BUCKETS_PER_DOUBLING = 4
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.zeros = 0
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if value <= 0:
+            self.zeros += 1
+        else:
+            bucket = math.floor(math.log2(value) * self.BUCKETS_PER_DOUBLING)
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.zeros += other.zeros
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Return an upper bound for the p-th percentile (0-100) of the values, accurate to within one bucket"""
+        rank = math.ceil(self.count * p / 100)
+        seen = self.zeros
+        if rank <= seen:
+            return 0.0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** ((bucket + 1) / self.BUCKETS_PER_DOUBLING), self.max)
+        return self.max
+
+
+class StageProfiler:
+    """Record measurements of each processed document, such as the time spent in each processing stage (in ms),
+    its length and its number of quotes, and aggregate them into histograms. Measurements can optionally be kept
+    per document as well. A disabled profiler records nothing, so it can be left in place at no cost.
+    """
+
+    def __init__(self, enabled=True, keep_docs=False):
+        self.enabled = enabled
+        self.keep_docs = keep_docs
+        self.histograms = {}
+        self.docs = []
+        self.current = None
+        self.pending = {}
+        self.combined = None
+
+    def start_doc(self, doc_id):
+        """Start recording the measurements of a document. Values recorded while no document was started
+        (e.g., parse times of documents parsed in batches) are attributed to the next document.
+        """
+        if self.enabled:
+            self.current = {"id": doc_id, **self.pending}
+            self.pending = {}
+
+    def end_doc(self):
+        if self.current is not None and self.keep_docs:
+            self.docs.append(self.current)
+        self.current = None
+
+    def record(self, name, value):
+        if not self.enabled:
+            return
+        if self.combined is not None:
+            self.combined[name] = self.combined.get(name, 0) + value
+            return
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].add(value)
+        if self.current is not None:
+            self.current[name] = value
+        else:
+            self.pending[name] = value
+
+    @contextmanager
+    def combine(self):
+        """Sum the values recorded in the enclosed block (e.g., for each window of a long document),
+        and record each sum once at the end of the block
+        """
+        if not self.enabled or self.combined is not None:
+            yield
+            return
+        self.combined = {}
+        try:
+            yield
+        finally:
+            combined, self.combined = self.combined, None
+            for name, value in combined.items():
+                self.record(name, value)
+
+    @contextmanager
+    def time(self, stage):
+        """Record the wall time of the enclosed block as `<stage>_ms`"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(f"{stage}_ms", 1000 * (time.perf_counter() - start))
+
+    def time_iter(self, stage, iterable):
+        """Yield the items of an iterable (e.g., nlp.pipe), recording the wall time to produce each of them"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            if self.enabled:
+                self.record(f"{stage}_ms", 1000 * (time.perf_counter() - start))
+            yield item
+
+    def pop_stats(self):
+        """Return the histograms and documents recorded so far (or None if disabled), and start over"""
+        if not self.enabled:
+            return None
+        stats = {"histograms": self.histograms, "docs": self.docs}
+        self.histograms = {}
+        self.docs = []
+        return stats
+
+    def merge(self, stats):
+        """Merge in the histograms of stats returned by pop_stats (e.g., in another process)"""
+        for name, histogram in stats["histograms"].items():
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].merge(histogram)
+
+    def summary(self):
+        """Return one line per measurement, with its count, mean, approximate percentiles and max"""
+        lines = []
+        for name in sorted(self.histograms):
+            h = self.histograms[name]
+            lines.append(
+                f"{name}: n={h.count} mean={h.mean():.2f} p50={h.percentile(50):.2f} "
+                f"p90={h.percentile(90):.2f} p99={h.percentile(99):.2f} max={h.max:.2f}"
+            )
+        return lines
+
+
 # ========== Other functions ==========
 
 
+class TokenBucket:
+    """Thread-safe rate limiter that allows `rate` calls per second on average, in bursts of up to
+    `capacity` calls. A rate of 0 (or None) disables rate limiting.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed"""
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
 def get_article_type(url):
     result = None
     if url:
@@ -1,6 +1,5 @@
 import os, json, re
 import argparse
-from ast import literal_eval
 
 import pandas as pd
 import Levenshtein as lev
@@ -98,7 +97,7 @@ def get_file_stats(text, quote_objects):
             referenceless += 1
 
         if speaker_index:
-            start, end = literal_eval(speaker_index)
+            start, end = utils.get_span(quote_object, "speaker")
             speaker_span = doc.char_span(start, end, alignment_mode="expand")
             speaker_root = speaker_span.root
             is_mention = False
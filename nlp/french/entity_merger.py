@@ -4,7 +4,6 @@ import argparse
 import json
 import os
 import re
-from ast import literal_eval
 
 import coreferee
 import Levenshtein as lev
@@ -787,7 +786,7 @@ def compare_outputs(quote_objects, entities, text):
             for quote in quote_objects:
                 if not quote["speaker_index"]:
                     continue
-                start_speaker, end_speaker = literal_eval(quote["speaker_index"])
+                start_speaker, end_speaker = utils.get_span(quote, "speaker")
                 reference = (
                     quote["reference"].replace("’", "'").replace("ÔøΩ", "é").lower()
                 )
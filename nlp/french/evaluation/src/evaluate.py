@@ -1,13 +1,12 @@
 import json
 import os
 import argparse
-from ast import literal_eval
 from pathlib import Path
 from statistics import harmonic_mean
 
 import Levenshtein as lev
 
-from evaluate_quotes import evaluate_quotes
+from evaluate_quotes import evaluate_quotes, get_span
 
 """
 Display performance metrics for each stage of the gender annotation pipeline
@@ -55,8 +54,8 @@ def compare_speakers_and_verbs(target_quotes, pred_quotes):
                 target_quote["speaker_index"]
                 and pred_quote["speaker_index"]
                 and has_coverage(
-                    literal_eval(target_quote["speaker_index"]),
-                    literal_eval(pred_quote["speaker_index"]),
+                    get_span(target_quote, "speaker"),
+                    get_span(pred_quote, "speaker"),
                 )
             ):
                 speaker_true_pos += 1
@@ -66,8 +65,8 @@ def compare_speakers_and_verbs(target_quotes, pred_quotes):
                 target_quote["verb_index"]
                 and pred_quote["verb_index"]
                 and has_coverage(
-                    literal_eval(target_quote["verb_index"]),
-                    literal_eval(pred_quote["verb_index"]),
+                    get_span(target_quote, "verb"),
+                    get_span(pred_quote, "verb"),
                 )
             ):
                 verb_true_pos += 1
@@ -160,9 +159,8 @@ def has_coverage(span_1: tuple, span_2: tuple) -> bool:
     Checks if span_1 has at least two overlapping characters
     with span_2
     """
-    span_1_char_indexes = set(range(*span_1))
-    span_2_char_indexes = set(range(*span_2))
-    return len(span_1_char_indexes & span_2_char_indexes) >= 2
+    overlap = min(span_1[1], span_2[1]) - max(span_1[0], span_2[0])
+    return overlap >= 2
 
 
 def are_almost_same(name_a: str, name_b: str, max_dist: int = 1) -> bool:
@@ -175,7 +173,7 @@ def are_almost_same(name_a: str, name_b: str, max_dist: int = 1) -> bool:
 def compare_speaker_reference(target_quotes, pred_quotes):
     true_pos, target_human_refs = 0, 0
     for target_quote in target_quotes:
-        target_quote_span = literal_eval(target_quote["quote_index"])
+        target_quote_span = get_span(target_quote, "quote")
         target_reference = target_quote["reference"].lower()
         if target_quote["speaker_gender"] == "unknown":
             continue
@@ -184,7 +182,7 @@ def compare_speaker_reference(target_quotes, pred_quotes):
         if target_quote["speaker"] == "":
             continue
         for pred_quote in pred_quotes:
-            pred_quote_span = literal_eval(pred_quote["quote_index"])
+            pred_quote_span = get_span(pred_quote, "quote")
             # Since it's not possible to have nested quotes
             # We can consider pred and  the same quote when they overlap
             if has_coverage(target_quote_span, pred_quote_span):
@@ -129,17 +129,17 @@ class QuoteExtractor:
             comps.append((quote_span.end - 1, "Q"))
 
         verb_text = ""
-        verb_index = ""
+        verb_chars = None
         if verb_span:
             comps.append((verb_span.start, "V"))
             verb_text = verb_span.text
-            verb_index = str((verb_span.start_char, verb_span.end_char))
+            verb_chars = (verb_span.start_char, verb_span.end_char)
         speaker_text = ""
-        speaker_index = ""
+        speaker_chars = None
         if speaker_span:
             comps.append((speaker_span.start, "S"))
             speaker_text = speaker_span.text
-            speaker_index = str((speaker_span.start_char, speaker_span.end_char))
+            speaker_chars = (speaker_span.start_char, speaker_span.end_char)
         else:
             is_floating_quote = True
 
@@ -148,11 +148,11 @@ class QuoteExtractor:
 
         quote_obj = {
             "speaker": speaker_text,
-            "speaker_index": speaker_index,
+            **utils.span_fields("speaker", speaker_chars),
             "quote": quote_span.text,
-            "quote_index": str((quote_span.start_char, quote_span.end_char)),
+            **utils.span_fields("quote", (quote_span.start_char, quote_span.end_char)),
             "verb": verb_text,
-            "verb_index": verb_index,
+            **utils.span_fields("verb", verb_chars),
             "quote_token_count": len(quote_span),
             "quote_type": quote_type,
             "is_floating_quote": is_floating_quote,
@@ -89,18 +89,22 @@ class Highlighter:
         quotes = {}
         speakers = {}
         for quote in doc_quotes:
-            start_char, end_char = [
-                int(r) for r in re.findall("[0-9]+", quote["quote_index"])
-            ]
+            start_char, end_char = self._get_span(quote, "quote")
             quotes[start_char] = end_char - start_char
-            if "speaker_index" in quote:
-                if quote["speaker_index"]:
-                    start_char, end_char = [
-                        int(r) for r in re.findall("[0-9]+", quote["speaker_index"])
-                    ]
-                    speakers[start_char] = end_char - start_char
+            if quote.get("speaker_start") is not None or quote.get("speaker_index"):
+                start_char, end_char = self._get_span(quote, "speaker")
+                speakers[start_char] = end_char - start_char
         return quotes, speakers
 
+    @staticmethod
+    def _get_span(quote, name):
+        """Get the (start, end) span of a quote's `name` field, from its integer `<name>_start`/`<name>_end`
+        fields, or from its `<name>_index` string for quotes that don't have them.
+        """
+        if quote.get(f"{name}_start") is not None:
+            return quote[f"{name}_start"], quote[f"{name}_end"]
+        return [int(r) for r in re.findall("[0-9]+", quote[f"{name}_index"])]
+
     def _make_html(self, file_id):
         """Create the HTML file from input txt files, prediction quotes and optionally target quotes. Save as `file_id`.
 
@@ -4,7 +4,6 @@ import argparse
 import importlib
 import json
 import os
-from ast import literal_eval
 from datetime import timedelta
 from multiprocessing import cpu_count
 from typing import Union
@@ -98,7 +97,7 @@ class FrenchQuoteMerger:
         doc: Doc
         )-> tuple[str, Union[list[str],str]]:
         if quote["speaker_index"]:
-            speaker_span = literal_eval(quote["speaker_index"])
+            speaker_span = utils.get_span(quote, "speaker")
             speaker_heads_span = self.get_heads_span(speaker_span, doc)
             for entity in entities:
                 for mention_heads_span in entities[entity][0]:
@@ -197,12 +196,12 @@ def compare_speaker_reference(
     ) -> tuple[int, int, int]:
     true_pos, target_human_refs = 0, 0
     for target_quote in target_quotes:
-        target_quote_span = literal_eval(target_quote["quote_index"])
+        target_quote_span = utils.get_span(target_quote, "quote")
         target_reference = target_quote["reference"].replace("ÔøΩ", "é").lower()
         if target_quote["speaker_gender"] == "unknown" or not target_quote["speaker"]:
             continue
         for pred_quote in pred_quotes:
-            pred_quote_span = literal_eval(pred_quote["quote_index"])
+            pred_quote_span = utils.get_span(pred_quote, "quote")
             # Since it's not possible to have nested quotes
             # We can consider pred and  the same quote when they overlap
             if has_coverage(target_quote_span, pred_quote_span):
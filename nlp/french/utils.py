@@ -65,12 +65,20 @@ class CleanAuthors:
 
 
 # ========== Text Processing functions ==========
+# Character replacements applied by preprocess_text in a single pass: non-breaking spaces and
+# double quotes (neither of which are affected by the newline fixes in between)
+PREPROCESS_TABLE = str.maketrans({"\xa0": " ", **dict.fromkeys("”“〝〞", '"')})
+DOTS_PATTERN = re.compile(r"(\.)([ \n\r]+)(\.)")
+APOSTROPHE_PATTERN = re.compile("\\b’\\b")
+
+
 def preprocess_text(txt):
     """Apply a series of cleaning operations to news text to better process
     quotes and named entities downstream.
     """
-    # Fix non-breaking space in unicode
-    txt = txt.replace("\xa0", " ")
+    # Fix non-breaking space in unicode, and normalize double quotes
+    txt = txt.translate(PREPROCESS_TABLE)
+    # NOTE: We keep single quotes for now as they are very common outside quotes
     # Remove accents to normalize names and get more accurate source counts
     # txt = remove_accents(txt)
 
@@ -86,10 +94,9 @@ def preprocess_text(txt):
     txt = txt.replace(". .\n ", ".\n ")
     txt = txt.replace("  ", " ")
     # Fix newlines for raw string literals
-    txt = txt.replace("\\n", " ")
-    txt = txt.replace("\\n\\n", " ")
-    p = re.compile(r"(\.)([ \n\r]+)(\.)")
-    txt = p.sub(".\\2 ", txt)
+    if "\\n" in txt:
+        txt = txt.replace("\\n", " ")
+    txt = DOTS_PATTERN.sub(".\\2 ", txt)
     # ======================================= NEW
     # txt = re.sub("[\r\n]+", " ", txt)
     # txt = re.sub("\.( |\.)+",". ", txt)
@@ -97,16 +104,8 @@ def preprocess_text(txt):
     # txt = txt.strip()
     # ======================================= END
 
-    # Normalize double quotes
-    txt = txt.replace("”", '"')
-    txt = txt.replace("“", '"')
-    txt = txt.replace("〝", '"')
-    txt = txt.replace("〞", '"')
-    # NOTE: We keep single quotes for now as they are very common outside quotes
-    # txt = txt.replace("‘", "'")
-    # txt = txt.replace("’", "'")
-
-    txt = re.sub("\\b’\\b", "'", txt)  # apostrophes
+    txt = APOSTROPHE_PATTERN.sub("'", txt)  # apostrophes
+    # Asterisks become spaces only at the end, so that they don't affect the space fixes above
     txt = txt.replace("*", " ")
     return txt
 
@@ -170,9 +169,8 @@ def has_coverage(span_1: tuple, span_2: tuple) -> bool:
     Checks if span_1 has at least two overlapping characters
     with span_2
     """
-    span_1_char_indexes = set(range(*span_1))
-    span_2_char_indexes = set(range(*span_2))
-    return len(span_1_char_indexes & span_2_char_indexes) >= 2
+    overlap = min(span_1[1], span_2[1]) - max(span_1[0], span_2[0])
+    return overlap >= 2
 
 
 def has_coverage_for_all(spans_1: tuple[tuple[int]], spans_2: tuple[tuple[int]]) -> bool:
@@ -189,6 +187,35 @@ def get_list_of_spans(token_indexes: list[int], doc) -> list[tuple[int]]:
     return [(doc[i].idx, doc[i].idx + len(doc[i])) for i in token_indexes]
 
 
+def span_fields(name: str, span: tuple[int, int] = None) -> dict:
+    """
+    Returns the fields that store a (start, end) character span in a quote
+    object: integer `<name>_start` and `<name>_end` fields, along with the
+    legacy "(start, end)" `<name>_index` string
+    """
+    if span is None:
+        return {f"{name}_index": "", f"{name}_start": None, f"{name}_end": None}
+    start, end = span
+    return {f"{name}_index": str((start, end)), f"{name}_start": start, f"{name}_end": end}
+
+
+def get_span(quote: dict, name: str) -> Union[tuple[int, int], None]:
+    """
+    Returns the (start, end) character span of a quote object's `name` field
+    ("quote", "speaker" or "verb"), or None if it is empty. Quotes without the
+    integer `<name>_start`/`<name>_end` fields fall back to the legacy
+    `<name>_index` string
+    """
+    start = quote.get(f"{name}_start")
+    if start is not None:
+        return start, quote[f"{name}_end"]
+    index = quote.get(f"{name}_index")
+    if not index:
+        return None
+    start, end = index.strip("()").split(",")
+    return int(start), int(end)
+
+
 # ========== Other functions ==========
 def create_logger(
     logger_name, log_dir="logs", logger_level=logging.WARN, file_log_level=logging.INFO
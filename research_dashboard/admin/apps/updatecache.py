@@ -15,6 +15,8 @@ MONGO_ARGS = config['MONGO_ARGS']
 GENDER_DB = config['DB']['GENDER_DB']
 MANUAL_NAME_COL = config['DB']['MANUAL_NAME_COL']
 FIRST_NAME_COL = config['DB']['FIRST_NAME_COL']
+CACHE_UPDATES_COL = config['DB']['CACHE_UPDATES_COL']
+NEGATIVE_NAME_COL = config['DB']['NEGATIVE_NAME_COL']
 
 
 # ========== Functions ================
@@ -45,6 +47,30 @@ def upsert_cache(gender_cache_col, name, gender):
     )
 
 
+def mark_cache_updated(connection):
+    """
+    Increment the version of the gender caches, so that running NLP pipelines clear the
+    names they cached in memory and look up the updated names in the database again.
+    """
+    connection[GENDER_DB][CACHE_UPDATES_COL].update_one(
+        {'_id': 'genderCache'},
+        {'$inc': {'version': 1}, '$currentDate': {'updatedAt': True}},
+        upsert=True,
+    )
+
+
+def clear_negative_cache(connection, name, field='name'):
+    """
+    Remove a name from the cache of names that no gender service could find a gender for, so
+    that the NLP pipeline looks up the name again. Names are matched with and without accents.
+    Use field='firstName' to remove all names with the given first name.
+    """
+    name = name.lower()
+    names = {name, utils.remove_accents(name), utils.remove_accents(utils.clean_ne(name))}
+    result = connection[GENDER_DB][NEGATIVE_NAME_COL].delete_many({field: {'$in': list(names)}})
+    return result.deleted_count
+
+
 # ========== App Layout ================
 
 def layout():
@@ -144,6 +170,31 @@ def layout():
                     html.P(id='first-name-result')
                 ], type='default'
             ),
+            html.Hr(),
+            html.H4('Clear unknown name'),
+            html.P('''
+                Names that no gender service could find a gender for are remembered for a month,
+                so that they are not sent to the gender services again for every article. Enter a
+                full name to clear it, so that it is looked up again the next time it appears in
+                the news. Names are also cleared when they are written to the manual cache above
+                (or, for all names with that first name, to the first name cache).
+            '''),
+            html.Div(
+                html.Table([
+                    html.Tr([
+                        html.Td(dcc.Markdown('__Enter full name__')),
+                        html.Td(dcc.Input(id='unknown-name-input', size='20')),
+                    ]),
+                ])
+            ),
+            html.Div([html.Button(id='unknown-name-clear-button', n_clicks=0, children='Clear unknown name')],
+                     style={'display': 'flex'}),
+            dcc.Loading(
+                id='loading-progress-3',
+                children=[
+                    html.P(id='unknown-name-result')
+                ], type='default'
+            ),
         ])
     ]
     return children_list
@@ -162,6 +213,8 @@ def update_manual_db(n_clicks, gender, name):
             collection = connection[GENDER_DB][MANUAL_NAME_COL]
             # Overwrite (i.e. upsert) existing name with new name-gender pair
             upsert_cache(collection, name, gender)
+            mark_cache_updated(connection)
+            clear_negative_cache(connection, name)
             return "Updated manual cache.."
 
 
@@ -177,5 +230,18 @@ def update_first_name_db(n_clicks, gender, name):
             collection = connection[GENDER_DB][FIRST_NAME_COL]
             # Overwrite (i.e. upsert) existing name with new name-gender pair
             upsert_cache(collection, name, gender)
+            mark_cache_updated(connection)
+            clear_negative_cache(connection, name, field='firstName')
             return "Updated first name cache.."
 
+
+@app.callback(Output('unknown-name-result', 'children'),
+              [Input('unknown-name-clear-button', 'n_clicks')],
+              [State('unknown-name-input', 'value')])
+def clear_unknown_name(n_clicks, name):
+    """Take a full name input from the user and clear it from the cache of unknown names"""
+    ctx = dash.callback_context
+    if "unknown-name-clear-button" in ctx.triggered[0]["prop_id"] and name:
+        with MongoClient(**MONGO_ARGS) as connection:
+            deleted_count = clear_negative_cache(connection, name)
+            return f"Cleared {deleted_count} unknown name(s).."
@@ -16,5 +16,7 @@ config = {
         'GENDER_DB': 'genderCache',
         'MANUAL_NAME_COL': 'manual',
         'FIRST_NAME_COL': 'firstNamesCleaned',
+        'CACHE_UPDATES_COL': 'cacheUpdates',
+        'NEGATIVE_NAME_COL': 'unknownNames',
     }
 }
\ No newline at end of file